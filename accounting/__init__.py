@@ -1,11 +1,31 @@
-#You will need to pip install flask and the sqlalchemy extension for flask.
-from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
+import os
 
-# Initialize the application.
-app = Flask(__name__)
-app.config.from_pyfile('config.py')
-db = SQLAlchemy(app)
+# The models, the DB binding and PolicyAccounting load without Flask.
+# The web stack is only imported by create_app().
+from database import db
 
-# Import the views file for routing.
-import views
+# Audit mode: record every statement for audit_queries.py
+if os.environ.get('ACCOUNTING_QUERY_LOG'):
+	from queryplan import record_to
+	record_to(os.environ['ACCOUNTING_QUERY_LOG'])
+
+
+def create_app(config=None):
+	"""
+	 Application factory: creates the Flask application,
+	 binds the database and registers the views.
+	"""
+	from flask import Flask
+	from views import api
+
+	# Initialize the application.
+	app = Flask(__name__)
+	app.config.from_pyfile('config.py')
+	if config:
+		app.config.update(config)
+
+	# Bind the database and register the views for routing.
+	db.init_app(app)
+	app.register_blueprint(api)
+
+	return app
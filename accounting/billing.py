@@ -0,0 +1,199 @@
+#!/user/bin/env python2.7
+
+import Queue
+import sys
+import threading
+
+from accounting import db
+from models import Contact, Invoice, Policy
+
+"""
+#######################################################
+Portfolio billing-run feed.
+
+Streams every non-deleted invoice billed, due or hitting
+its cancel date in a date window, with its policy and
+named insured, for the whole book. Each date column has
+its own index, so the window is read one column at a
+time, in pages keyed on (date, id) that are index ranges:
+the work grows with the invoices in the window, not with
+the policies. An invoice is read with the first of its
+columns in the window. Every page is a short read of its
+own, so the feed holds no lock between pages and writers
+are not blocked by a slow client. The shards are read in
+parallel and the named insureds come from the main
+database.
+#######################################################
+"""
+
+# Rows read per page
+FETCH_SIZE = 500
+
+# Fetched chunks waiting to be streamed, per shard
+QUEUED_CHUNKS = 4
+
+# Date columns of the window, in the order they are read
+DATE_COLUMNS = ('bill_date', 'due_date', 'cancel_date')
+
+def billing_run_query(start_date, end_date, column='bill_date', after=None):
+	"""
+	 Returns the select for a page of the invoices with
+	 `column` between start_date and end_date, after the
+	 (date, id) of the last row of the previous page.
+	 Invoices with an earlier date column in the window
+	 belong to that column's pages.
+	"""
+	invoices = Invoice.__table__
+	policies = Policy.__table__
+	date_column = invoices.c[column]
+
+	query = db.select([invoices.c.id,
+					invoices.c.policy_id,
+					invoices.c.bill_date,
+					invoices.c.due_date,
+					invoices.c.cancel_date,
+					invoices.c.amount_due,
+					policies.c.policy_number,
+					policies.c.status,
+					policies.c.billing_schedule,
+					policies.c.named_insured],
+			from_obj=[invoices.join(policies, policies.c.id == invoices.c.policy_id)])\
+		.where(date_column.between(start_date, end_date))\
+		.where(invoices.c.deleted == False)
+
+	for earlier in DATE_COLUMNS[:DATE_COLUMNS.index(column)]:
+		query = query.where(db.not_(invoices.c[earlier].between(start_date, end_date)))
+
+	if after is not None:
+		last_date, last_id = after
+		query = query.where(date_column >= last_date)\
+			.where(db.or_(date_column > last_date, invoices.c.id > last_id))
+
+	return query.order_by(date_column, invoices.c.id).limit(FETCH_SIZE)
+
+def _fetch_chunks(engine, start_date, end_date):
+	"""
+	 Yields the rows of the window, a page at a time.
+	"""
+	for column in DATE_COLUMNS:
+		after = None
+		while True:
+			# Each page is read to the end and its connection
+			# returned before it is yielded
+			connection = engine.connect()
+			try:
+				rows = connection.execute(billing_run_query(start_date, end_date,
+															column, after)).fetchall()
+			finally:
+				connection.close()
+
+			if rows:
+				yield rows
+			if len(rows) < FETCH_SIZE:
+				break
+			after = (rows[-1][column], rows[-1].id)
+
+def _fan_out_chunks(start_date, end_date):
+	"""
+	 Yields the row chunks of every shard as they are
+	 fetched, reading the shards in parallel.
+	"""
+	if db.shards == 1:
+		for rows in _fetch_chunks(db.shard_engine(0), start_date, end_date):
+			yield rows
+		return
+
+	chunks = Queue.Queue(QUEUED_CHUNKS * db.shards)
+	stopped = threading.Event()
+
+	def put(item):
+		# Gives up once the consumer is gone
+		while not stopped.is_set():
+			try:
+				chunks.put(item, timeout=0.1)
+				return True
+			except Queue.Full:
+				pass
+		return False
+
+	def read(shard):
+		try:
+			for rows in _fetch_chunks(db.shard_engine(shard), start_date, end_date):
+				if not put(rows):
+					return
+			put(None)
+		except Exception:
+			put(sys.exc_info())
+
+	readers = [threading.Thread(target=read, args=(shard,)) for shard in range(db.shards)]
+	for reader in readers:
+		reader.daemon = True
+		reader.start()
+
+	# Stop the readers if the consumer goes away
+	try:
+		running = len(readers)
+		while running:
+			rows = chunks.get()
+			if rows is None:
+				running -= 1
+			elif isinstance(rows, tuple):
+				raise rows[0], rows[1], rows[2]
+			else:
+				yield rows
+	finally:
+		stopped.set()
+
+def contact_names(contact_ids, names=None):
+	"""
+	 Returns the names of the contacts by id, reading only
+	 the ones missing from `names` (which is updated).
+	"""
+	if names is None:
+		names = {}
+
+	contacts = Contact.__table__
+	missing = list(set(contact_id for contact_id in contact_ids
+						if contact_id is not None and contact_id not in names))
+	if not missing:
+		return names
+
+	connection = db.engine.connect()
+	try:
+		for i in range(0, len(missing), FETCH_SIZE):
+			names.update(connection.execute(db.select([contacts.c.id, contacts.c.name])
+				.where(contacts.c.id.in_(missing[i:i + FETCH_SIZE]))).fetchall())
+	finally:
+		connection.close()
+	return names
+
+def billing_run(start_date, end_date):
+	"""
+	 Yields a dict per invoice in the window, with the events
+	 (billed, due, cancel) that fall in it, as rows are fetched.
+	"""
+	names = {}
+	for rows in _fan_out_chunks(start_date, end_date):
+		contact_names([row.named_insured for row in rows], names)
+
+		for row in rows:
+			events = [event for event, event_date in (('billed', row.bill_date),
+														('due', row.due_date),
+														('cancel', row.cancel_date))
+						if start_date <= event_date <= end_date]
+			yield {
+				'invoice_id': row.id,
+				'bill_date': str(row.bill_date),
+				'due_date': str(row.due_date),
+				'cancel_date': str(row.cancel_date),
+				'amount_due': row.amount_due,
+				'events': events,
+				'policy': {
+					'id': row.policy_id,
+					'policy_number': row.policy_number,
+					'status': row.status,
+					'billing_schedule': row.billing_schedule,
+					'named_insured': row.named_insured,
+					'named_insured_name': names.get(row.named_insured),
+				},
+			}
@@ -0,0 +1,247 @@
+#!/user/bin/env python2.7
+
+from sqlalchemy import event, orm
+
+from accounting import db
+from database import IN_CLAUSE_CHUNK
+from models import Change, Invoice, Payment, Policy
+
+"""
+#######################################################
+Change feed of the policies, invoices and payments.
+
+Every write to those tables adds a row to the changes
+table of its shard, in the same transaction: ORM flushes
+through the after_flush hook below and core writes
+explicitly. SQLite serializes the writers of a database,
+so each shard's sequence numbers commit in order and a
+reader never skips one. The cursor is the last sequence
+number read on each shard, joined with dots.
+
+A page returns the current state of the rows changed
+after the cursor, so a row changed twice is sent once,
+or again in a later page if it changed again. Rows that
+no longer exist are listed as deleted.
+#######################################################
+"""
+
+# Change rows per page
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+
+TABLES = {
+	u'policies': Policy,
+	u'invoices': Invoice,
+	u'payments': Payment,
+}
+
+def record_changes(session, changes):
+	"""
+	 Records (policy_id, table name, row id) changes
+	 made through core statements.
+	"""
+	changes = [{'policy_id': policy_id, 'table_name': table_name, 'row_id': row_id}
+				for policy_id, table_name, row_id in changes]
+	if changes:
+		session.execute(Change.__table__.insert(), changes)
+
+def record_policies(session, policy_ids=None):
+	"""
+	 Records the policies with all their invoices and
+	 payments, or every row of the shard without ids.
+	 Used after bulk inserts and to start a feed on
+	 existing data.
+	"""
+	statements = [
+		"INSERT INTO changes (policy_id, table_name, row_id) "
+		"SELECT id, 'policies', id FROM policies%s ORDER BY id",
+		"INSERT INTO changes (policy_id, table_name, row_id) "
+		"SELECT policy_id, 'invoices', id FROM invoices%s ORDER BY id",
+		"INSERT INTO changes (policy_id, table_name, row_id) "
+		"SELECT policy_id, 'payments', id FROM payments%s ORDER BY id",
+	]
+
+	if policy_ids is None:
+		for statement in statements:
+			session.execute(statement % '')
+		return
+
+	# Ids are ints, so they can be inlined
+	policy_ids = [int(policy_id) for policy_id in policy_ids]
+	for i in range(0, len(policy_ids), IN_CLAUSE_CHUNK):
+		ids = ', '.join(str(policy_id) for policy_id in policy_ids[i:i + IN_CLAUSE_CHUNK])
+		for position, statement in enumerate(statements):
+			key = 'id' if position == 0 else 'policy_id'
+			session.execute(statement % (' WHERE %s IN (%s)' % (key, ids)))
+
+@event.listens_for(orm.Session, 'after_flush')
+def _record_flushed_rows(session, flush_context):
+	# The new rows have their ids by now. Dirty instances
+	# without column changes wrote nothing
+	changes = []
+	modified = [instance for instance in session.dirty
+				if session.is_modified(instance, include_collections=False)]
+	for instance in list(session.new) + modified + list(session.deleted):
+		if isinstance(instance, Policy):
+			changes.append((instance.id, u'policies', instance.id))
+		elif isinstance(instance, Invoice):
+			changes.append((instance.policy_id, u'invoices', instance.id))
+		elif isinstance(instance, Payment):
+			changes.append((instance.policy_id, u'payments', instance.id))
+
+	record_changes(session, changes)
+
+
+################################
+# Feed
+################################
+def parse_cursor(cursor):
+	"""
+	 Returns the sequence number of each shard. An empty
+	 cursor starts from the beginning of the feed.
+	"""
+	if not cursor:
+		return [0] * db.shards
+
+	try:
+		sequences = [int(seq) for seq in cursor.split('.')]
+	except ValueError:
+		raise ValueError('Invalid cursor %s!' % cursor)
+	if len(sequences) != db.shards or min(sequences) < 0:
+		raise ValueError('Cursor %s is not from this feed, sync again from the start!' % cursor)
+	return sequences
+
+def format_cursor(sequences):
+	return '.'.join(str(seq) for seq in sequences)
+
+def _date(value):
+	return str(value) if value else None
+
+def _serialize(table_name, row, shard):
+	if table_name == u'policies':
+		return {
+			'id': row.id,
+			'policy_number': row.policy_number,
+			'effective_date': _date(row.effective_date),
+			'status': row.status,
+			'billing_schedule': row.billing_schedule,
+			'annual_premium': row.annual_premium,
+			'named_insured': row.named_insured,
+			'agent': row.agent,
+			'cancellation_date': _date(row.cancellation_date),
+			'cancellation_description': row.cancellation_description,
+		}
+
+	# Invoice and payment ids are only unique within a shard
+	if table_name == u'invoices':
+		return {
+			'id': row.id,
+			'shard': shard,
+			'policy_id': row.policy_id,
+			'bill_date': _date(row.bill_date),
+			'due_date': _date(row.due_date),
+			'cancel_date': _date(row.cancel_date),
+			'amount_due': row.amount_due,
+			'deleted': bool(row.deleted),
+		}
+	return {
+		'id': row.id,
+		'shard': shard,
+		'policy_id': row.policy_id,
+		'contact_id': row.contact_id,
+		'amount_paid': row.amount_paid,
+		'transaction_date': _date(row.transaction_date),
+	}
+
+def _read_shard(shard, since, limit):
+	"""
+	 Returns the first `limit` changes of a shard after
+	 `since`, as (seq, policy_id, table name, row id).
+	"""
+	changes = Change.__table__
+	session = db.shard_session(shard)
+	return [tuple(row) for row in session.execute(db.select([changes.c.seq,
+															changes.c.policy_id,
+															changes.c.table_name,
+															changes.c.row_id])
+		.where(changes.c.seq > since)
+		.order_by(changes.c.seq)
+		.limit(limit)).fetchall()]
+
+def _load_rows(shard, changes):
+	"""
+	 Returns the current rows of the changes of a shard,
+	 plus the changed rows that were deleted since.
+	"""
+	session = db.shard_session(shard)
+
+	wanted = {}
+	policy_ids = {}
+	for seq, policy_id, table_name, row_id in changes:
+		wanted.setdefault(table_name, set()).add(row_id)
+		policy_ids[(table_name, row_id)] = policy_id
+
+	rows = {}
+	deleted = []
+	for table_name in sorted(wanted):
+		table = TABLES[table_name].__table__
+		ids = sorted(wanted[table_name])
+		found = {}
+		for i in range(0, len(ids), IN_CLAUSE_CHUNK):
+			for row in session.execute(db.select([table])
+					.where(table.c.id.in_(ids[i:i + IN_CLAUSE_CHUNK]))):
+				found[row.id] = _serialize(table_name, row, shard)
+
+		rows[table_name] = [found[row_id] for row_id in ids if row_id in found]
+		deleted.extend({'table': table_name, 'id': row_id, 'shard': shard,
+						'policy_id': policy_ids[(table_name, row_id)]}
+						for row_id in ids if row_id not in found)
+	return rows, deleted
+
+def changes_since(cursor=None, limit=DEFAULT_LIMIT):
+	"""
+	 Returns a page of at most `limit` changes after the
+	 cursor, with the cursor to ask for the next page.
+	"""
+	if not 0 < limit <= MAX_LIMIT:
+		raise ValueError('The limit must be between 1 and %d!' % MAX_LIMIT)
+	sequences = parse_cursor(cursor)
+
+	# Each shard could hold the whole page. One more
+	# change tells whether there is a next page
+	fetched = [_read_shard(shard, sequences[shard], limit + 1)
+				for shard in range(db.shards)]
+
+	# Share the page between the shards, one change at a time
+	taken = [0] * db.shards
+	total = 0
+	while total < limit:
+		progressed = False
+		for shard in range(db.shards):
+			if total < limit and taken[shard] < len(fetched[shard]):
+				taken[shard] += 1
+				total += 1
+				progressed = True
+		if not progressed:
+			break
+
+	page = {'policies': [], 'invoices': [], 'payments': [], 'deleted': []}
+	more = False
+	for shard in range(db.shards):
+		changes = fetched[shard][:taken[shard]]
+		more = more or len(fetched[shard]) > taken[shard]
+		if not changes:
+			continue
+
+		sequences[shard] = changes[-1][0]
+		rows, deleted = _load_rows(shard, changes)
+		for table_name, table_rows in rows.items():
+			page[table_name].extend(table_rows)
+		page['deleted'].extend(deleted)
+
+	return {
+		'changes': page,
+		'count': total,
+		'cursor': format_cursor(sequences),
+		'more': more,
+	}
@@ -1,3 +1,14 @@
 import os
 
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath("accounting.sqlite")
+
+# Databases holding the policies, their invoices and payments,
+# picked by policy_id % len(SHARD_DATABASE_URIS). Contacts, jobs
+# and the id sequences stay in SQLALCHEMY_DATABASE_URI. When empty,
+# everything lives in SQLALCHEMY_DATABASE_URI. Use reshard.py to
+# move existing data when this list changes.
+SHARD_DATABASE_URIS = []
+
+# Ledger snapshot published by publish_snapshot.py and
+# memory-mapped by the report workers (see accounting.snapshot)
+LEDGER_SNAPSHOT_PATH = os.path.abspath("ledger.snapshot")
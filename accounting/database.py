@@ -0,0 +1,310 @@
+#!/user/bin/env python2.7
+
+import sys
+import threading
+
+import sqlalchemy
+from sqlalchemy import orm
+from sqlalchemy.ext.declarative import declarative_base
+
+"""
+#######################################################
+Database binding for the accounting models.
+
+It exposes the part of the Flask-SQLAlchemy API that the
+models use (db.Model, db.Column, db.session, ...) on top of
+plain SQLAlchemy, so the models and PolicyAccounting can be
+loaded by batch jobs and workers without the Flask stack.
+
+It also routes the per-policy data to its shard database,
+see Database.session_for() and Database.fan_out().
+#######################################################
+"""
+
+# SQLite limits the number of bound parameters per statement,
+# so long IN lists are sent in chunks of this size
+IN_CLAUSE_CHUNK = 500
+
+class Database(object):
+	"""
+	 Lazily configured engines plus thread-local sessions.
+
+	 The main database holds the shared data (contacts, jobs).
+	 Policies and everything keyed by policy id (the tables
+	 flagged with info={'sharded': True}) live in the shard
+	 picked by policy_id % number of shards. Without shards,
+	 the main database is the only shard.
+	"""
+	def __init__(self):
+		self.uri = None
+		self.shard_uris = None
+		self._engine = None
+		self._shards = None
+
+		# Include the SQLAlchemy names (Column, INTEGER, relation, ...)
+		for module in sqlalchemy, orm:
+			for key in module.__all__:
+				if not hasattr(self, key):
+					setattr(self, key, getattr(module, key))
+
+		# Sessions always bind to the current engine
+		database = self
+
+		class Session(orm.Session):
+			def get_bind(self, mapper=None, clause=None):
+				return database.engine
+
+		self.session = orm.scoped_session(orm.sessionmaker(class_=Session))
+
+		# Declarative base with the Model.query property
+		self.Model = declarative_base(name='Model')
+		self.Model.query = self.session.query_property()
+
+	@property
+	def engine(self):
+		"""
+		 Returns the engine, creating it from
+		 the config file on first use.
+		"""
+		if self._engine is None:
+			if self.uri is None:
+				import config
+				self.uri = config.SQLALCHEMY_DATABASE_URI
+				self.shard_uris = list(getattr(config, 'SHARD_DATABASE_URIS', None) or [])
+			self._engine = sqlalchemy.create_engine(self.uri)
+		return self._engine
+
+	def configure(self, uri, shard_uris=None):
+		"""
+		 Points the binding to another database,
+		 and optionally to its shards.
+		"""
+		self.remove()
+		self.dispose()
+
+		self.uri = uri
+		self.shard_uris = list(shard_uris or [])
+		self._engine = None
+		self._shards = None
+
+	def init_app(self, app):
+		"""
+		 Binds to the app's databases and removes the
+		 sessions at the end of every request.
+		"""
+		uri = app.config.get('SQLALCHEMY_DATABASE_URI')
+		shard_uris = list(app.config.get('SHARD_DATABASE_URIS') or [])
+		if uri and (uri != self.uri or shard_uris != self.shard_uris):
+			self.configure(uri, shard_uris)
+
+		@app.teardown_appcontext
+		def shutdown_session(response_or_exc):
+			self.remove()
+			return response_or_exc
+
+	def remove(self):
+		"""
+		 Removes the current thread's sessions.
+		"""
+		self.session.remove()
+		for engine, session in self._shards or []:
+			session.remove()
+
+	def dispose(self):
+		"""
+		 Closes the pooled connections, e.g. before forking.
+		"""
+		if self._engine is not None:
+			self._engine.dispose()
+		for engine, session in self._shards or []:
+			if engine is not self._engine:
+				engine.dispose()
+
+	################################
+	# Shards
+	################################
+	def _load_shards(self):
+		engine = self.engine
+		shards = []
+		for uri in self.shard_uris or [self.uri]:
+			# A shard on the main database shares its session
+			if uri == self.uri:
+				shards.append((engine, self.session))
+			else:
+				shard_engine = sqlalchemy.create_engine(uri)
+				shards.append((shard_engine, orm.scoped_session(
+					orm.sessionmaker(bind=shard_engine))))
+		self._shards = shards
+
+	@property
+	def shards(self):
+		"""
+		 Returns the number of shards.
+		"""
+		if self._shards is None:
+			self._load_shards()
+		return len(self._shards)
+
+	@property
+	def sharded(self):
+		"""
+		 Returns whether policies live outside the main database.
+		"""
+		if self._shards is None:
+			self._load_shards()
+		return self._shards[0][1] is not self.session or len(self._shards) > 1
+
+	def shard_for(self, policy_id):
+		"""
+		 Returns the shard of a policy.
+		"""
+		return int(policy_id) % self.shards
+
+	def shard_engine(self, shard):
+		"""
+		 Returns the engine of a shard.
+		"""
+		if self._shards is None:
+			self._load_shards()
+		return self._shards[shard][0]
+
+	def shard_session(self, shard):
+		"""
+		 Returns the scoped session of a shard.
+		"""
+		if self._shards is None:
+			self._load_shards()
+		return self._shards[shard][1]
+
+	def session_for(self, policy_id):
+		"""
+		 Returns the session of the shard holding a policy.
+		"""
+		return self.shard_session(self.shard_for(policy_id))
+
+	def fan_out(self, function):
+		"""
+		 Calls function(session) on every shard in parallel
+		 and returns the results in shard order. The sessions
+		 are removed afterwards, so return plain values.
+		"""
+		if self.shards == 1:
+			return [function(self.shard_session(0))]
+
+		results = [None] * self.shards
+		errors = []
+
+		def run(shard):
+			session = self.shard_session(shard)
+			try:
+				results[shard] = function(session)
+			except Exception:
+				errors.append(sys.exc_info())
+			finally:
+				session.remove()
+
+		threads = [threading.Thread(target=run, args=(shard,))
+					for shard in range(self.shards)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		if errors:
+			raise errors[0][0], errors[0][1], errors[0][2]
+		return results
+
+	################################
+	# Schema
+	################################
+	def _tables(self, sharded):
+		return [table for table in self.Model.metadata.sorted_tables
+				if bool(table.info.get('sharded')) == sharded]
+
+	def create_all(self):
+		if not self.sharded:
+			self.Model.metadata.create_all(bind=self.engine)
+			return
+
+		self.Model.metadata.create_all(bind=self.engine, tables=self._tables(False))
+		for shard in range(self.shards):
+			self.Model.metadata.create_all(bind=self.shard_engine(shard),
+											tables=self._tables(True))
+
+	def _upgrade(self, engine, tables):
+		"""
+		 Creates the missing tables, columns and indexes of an
+		 existing database. Returns the names of the new tables.
+		"""
+		created = []
+		compiler = engine.dialect.ddl_compiler(engine.dialect, None)
+		connection = engine.connect()
+
+		def pragma(statement):
+			# Read through the DBAPI cursor, as a pragma with
+			# no rows doesn't return a result to SQLAlchemy
+			cursor = connection.connection.cursor()
+			try:
+				return cursor.execute(statement).fetchall()
+			finally:
+				cursor.close()
+
+		try:
+			for table in tables:
+				if not engine.dialect.has_table(connection, table.name):
+					table.create(bind=connection)
+					created.append(table.name)
+					continue
+
+				# SQLite can add columns, but not their UNIQUE constraints
+				columns = set(row[1] for row in pragma('PRAGMA table_info(%s)' % table.name))
+				for column in table.columns:
+					if column.name not in columns:
+						connection.execute('ALTER TABLE %s ADD COLUMN %s'
+							% (table.name, compiler.get_column_specification(column)))
+
+				indexes = {}
+				for row in pragma('PRAGMA index_list(%s)' % table.name):
+					indexes[row[1]] = (row[2], [info[2] for info in
+										pragma('PRAGMA index_info(%s)' % row[1])])
+				for index in table.indexes:
+					if index.name not in indexes:
+						index.create(bind=connection)
+
+				unique = set(index_columns[0] for is_unique, index_columns in indexes.values()
+							if is_unique and len(index_columns) == 1)
+				for column in table.columns:
+					if column.unique and column.name not in unique:
+						connection.execute('CREATE UNIQUE INDEX uq_%s_%s ON %s (%s)'
+							% (table.name, column.name, table.name, column.name))
+		finally:
+			connection.close()
+		return created
+
+	def upgrade_all(self):
+		"""
+		 Brings databases made by older versions up to the
+		 models, keeping their data. Safe to run again.
+		 Returns the new tables by shard, None being the
+		 main database of a sharded setup.
+		"""
+		if not self.sharded:
+			return {0: self._upgrade(self.engine, self.Model.metadata.sorted_tables)}
+
+		created = {None: self._upgrade(self.engine, self._tables(False))}
+		for shard in range(self.shards):
+			created[shard] = self._upgrade(self.shard_engine(shard), self._tables(True))
+		return created
+
+	def drop_all(self):
+		if not self.sharded:
+			self.Model.metadata.drop_all(bind=self.engine)
+			return
+
+		for shard in range(self.shards):
+			self.Model.metadata.drop_all(bind=self.shard_engine(shard),
+										tables=self._tables(True))
+		self.Model.metadata.drop_all(bind=self.engine, tables=self._tables(False))
+
+
+db = Database()
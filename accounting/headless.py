@@ -0,0 +1,26 @@
+#!/user/bin/env python2.7
+
+from accounting import db
+from models import Contact, Invoice, Payment, Policy
+from utils import PolicyAccounting, ReadOnlyError, build_or_refresh_db, insert_data
+
+"""
+#######################################################
+Headless entry point for batch jobs, cron scripts and
+process-pool workers. It loads the models, the DB binding
+and PolicyAccounting only, without the Flask web stack.
+#######################################################
+"""
+
+__all__ = ['db', 'init', 'Contact', 'Invoice', 'Payment', 'Policy',
+			'PolicyAccounting', 'ReadOnlyError',
+			'build_or_refresh_db', 'insert_data']
+
+def init(database_uri=None, shard_uris=None):
+	"""
+	 Binds to the given database and shards, or to
+	 the ones in config.py when none is given.
+	"""
+	if database_uri:
+		db.configure(database_uri, shard_uris)
+	return db
@@ -0,0 +1,415 @@
+#!/user/bin/env python2.7
+
+import inspect
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from accounting import db
+from ledger import AGING_BUCKETS
+from models import Job, Policy
+from snapshot import get_snapshot
+from utils import BILLING_SCHEDULES, PolicyAccounting
+
+"""
+#######################################################
+Persistent job queue for heavy accounting operations.
+
+Jobs are rows of the jobs table. Workers claim them with
+a lease that they renew while reporting progress, so the
+jobs of a crashed worker go back to the queue once their
+lease expires. Failed jobs are retried up to max_attempts.
+#######################################################
+"""
+
+# How long a claimed job stays with its worker without news
+LEASE = timedelta(minutes=5)
+
+# How often workers look for jobs of crashed workers, in seconds
+RECOVERY_INTERVAL = 30
+
+# Registered operations: name -> (function, concurrency limit)
+OPERATIONS = {}
+
+def operation(name, limit=None):
+	"""
+	 Registers a job operation. At most `limit` jobs
+	 of the operation run at the same time.
+	"""
+	def register(function):
+		OPERATIONS[name] = (function, limit)
+		return function
+	return register
+
+def _parse_date(value):
+	if not value:
+		return datetime.now().date()
+	return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class LeaseLost(Exception):
+	"""
+	 Raised when a worker reports on a job that is no
+	 longer running with it, e.g. after its lease expired
+	 and the job was recovered.
+	"""
+	pass
+
+
+def _held_job(job_id, worker):
+	# The job's row, while it is running with this worker
+	jobs = Job.__table__
+	return db.and_(jobs.c.id == job_id,
+					jobs.c.worker == worker,
+					jobs.c.status == u'Running')
+
+
+class JobContext(object):
+	"""
+	 Passed to the operations to report their progress,
+	 which also renews the job's lease.
+	"""
+	def __init__(self, job_id, worker):
+		self.job_id = job_id
+		self.worker = worker
+
+	def progress(self, done, total):
+		"""
+		 Raises LeaseLost, stopping the operation, once
+		 the job was taken from this worker.
+		"""
+		percent = 100 * done / total if total else 100
+		result = db.session.execute(Job.__table__.update()
+			.where(_held_job(self.job_id, self.worker))
+			.values(progress=percent, lease_expires=datetime.now() + LEASE))
+		db.session.commit()
+
+		if result.rowcount == 0:
+			raise LeaseLost('Job %d is no longer running with %s!' % (self.job_id, self.worker))
+
+
+################################
+# Operations
+################################
+@operation('change_schedule')
+def change_schedule(context, policy_ids, billing_schedule):
+	for done, policy_id in enumerate(policy_ids, 1):
+		PolicyAccounting(policy_id).change_schedule(billing_schedule)
+		context.progress(done, len(policy_ids))
+	return {'changed': len(policy_ids)}
+
+@operation('make_invoices')
+def make_invoices(context, policy_ids):
+	for done, policy_id in enumerate(policy_ids, 1):
+		PolicyAccounting(policy_id).make_invoices()
+		context.progress(done, len(policy_ids))
+	return {'invoiced': len(policy_ids)}
+
+@operation('cancel_policies')
+def cancel_policies(context, policy_ids, description, date=None):
+	date_cursor = _parse_date(date)
+
+	canceled = []
+	for done, policy_id in enumerate(policy_ids, 1):
+		if PolicyAccounting(policy_id).cancel_policy(description, date_cursor):
+			canceled.append(policy_id)
+		context.progress(done, len(policy_ids))
+	return {'canceled': canceled}
+
+def _report_source(policy_ids, snapshot):
+	"""
+	 Returns the snapshot to read from (or None for the live
+	 ledgers) and the policy ids, all of them by default.
+	 snapshot is True for config.py's snapshot, or a path.
+	"""
+	if snapshot:
+		published = get_snapshot(snapshot if snapshot is not True else None)
+		if published is None:
+			raise ValueError('No ledger snapshot was published!')
+		if policy_ids is None:
+			policy_ids = list(published.policy_ids)
+		return published, policy_ids
+
+	if policy_ids is None:
+		policy_ids = sorted(policy_id for shard_ids in db.fan_out(
+								lambda session: session.query(Policy.id).all())
+							for policy_id, in shard_ids)
+	return None, policy_ids
+
+def _report(context, policy_ids, snapshot, read):
+	"""
+	 Calls read(ledger) for each policy, with the snapshot's
+	 ledger when it has the policy and the live one otherwise.
+	"""
+	results = {}
+	for done, policy_id in enumerate(policy_ids, 1):
+		if snapshot is not None and policy_id in snapshot:
+			ledger = snapshot.ledger(policy_id)
+		else:
+			ledger = PolicyAccounting.for_reading(policy_id).ledger
+		results[str(policy_id)] = read(ledger)
+		if done % 100 == 0 or done == len(policy_ids):
+			context.progress(done, len(policy_ids))
+	return results
+
+@operation('balance_report', limit=1)
+def balance_report(context, date=None, policy_ids=None, snapshot=False):
+	"""
+	 With snapshot=True, the balances are read from the
+	 published ledger snapshot, as of its version.
+	"""
+	date_cursor = _parse_date(date)
+	snapshot, policy_ids = _report_source(policy_ids, snapshot)
+
+	balances = _report(context, policy_ids, snapshot,
+						lambda ledger: ledger.balance(date_cursor))
+	return {'date': str(date_cursor),
+			'snapshot': snapshot.version if snapshot is not None else None,
+			'balances': balances}
+
+@operation('aging_report', limit=1)
+def aging_report(context, date=None, policy_ids=None, snapshot=False):
+	"""
+	 Open amounts of each policy by days past due, plus
+	 the portfolio totals. snapshot=True as in balance_report.
+	"""
+	date_cursor = _parse_date(date)
+	snapshot, policy_ids = _report_source(policy_ids, snapshot)
+
+	aging = _report(context, policy_ids, snapshot,
+					lambda ledger: ledger.aging(date_cursor))
+
+	totals = OrderedDict((label, 0) for label, days in AGING_BUCKETS)
+	for buckets in aging.values():
+		for label, amount in buckets.items():
+			totals[label] += amount
+
+	return {'date': str(date_cursor),
+			'snapshot': snapshot.version if snapshot is not None else None,
+			'aging': aging,
+			'totals': totals}
+
+
+################################
+# Queue
+################################
+def check_arguments(operation_name, arguments):
+	"""
+	 Raises ValueError unless the arguments fit the
+	 operation, so a bad job fails when it is queued
+	 rather than on every attempt.
+	"""
+	function, limit = OPERATIONS[operation_name]
+	names, varargs, keywords, defaults = inspect.getargspec(function)
+	# The first one is the JobContext
+	names = names[1:]
+	required = names[:len(names) - len(defaults or ())]
+
+	unknown = sorted(set(arguments) - set(names))
+	if unknown:
+		raise ValueError('Unknown arguments for %s: %s!' % (operation_name, ', '.join(unknown)))
+	missing = [name for name in required if name not in arguments]
+	if missing:
+		raise ValueError('Missing arguments for %s: %s!' % (operation_name, ', '.join(missing)))
+
+	if 'billing_schedule' in arguments and arguments['billing_schedule'] not in BILLING_SCHEDULES:
+		raise ValueError('A valid billing schedule is required!')
+	if arguments.get('date'):
+		try:
+			_parse_date(arguments['date'])
+		except (TypeError, ValueError):
+			raise ValueError('The date must be YYYY-MM-DD!')
+
+def enqueue(operation_name, arguments=None, max_attempts=3):
+	"""
+	 Queues an operation and returns the job id.
+	"""
+	if operation_name not in OPERATIONS:
+		raise ValueError('Unknown operation %s!' % operation_name)
+	check_arguments(operation_name, arguments or {})
+
+	job = Job(operation_name, json.dumps(arguments or {}), max_attempts)
+	db.session.add(job)
+	db.session.commit()
+
+	return job.id
+
+def job_dict(job):
+	"""
+	 Returns the status, progress and result of a job.
+	"""
+	return {
+		'id': job.id,
+		'operation': job.operation,
+		'status': job.status,
+		'progress': job.progress,
+		'attempts': job.attempts,
+		'result': json.loads(job.result) if job.result else None,
+		'error': job.error,
+		'created_at': str(job.created_at),
+		'started_at': str(job.started_at) if job.started_at else None,
+		'finished_at': str(job.finished_at) if job.finished_at else None,
+	}
+
+def recover_jobs():
+	"""
+	 Requeues the running jobs whose lease expired,
+	 failing the ones without attempts left.
+	 Returns the number of recovered jobs.
+	"""
+	jobs = Job.__table__
+	expired = db.and_(jobs.c.status == u'Running',
+					jobs.c.lease_expires < datetime.now())
+
+	db.session.execute(jobs.update()
+		.where(db.and_(expired, jobs.c.attempts >= jobs.c.max_attempts))
+		.values(status=u'Failed', error=u'Worker lost', finished_at=datetime.now()))
+	result = db.session.execute(jobs.update()
+		.where(expired)
+		.values(status=u'Queued', worker=None, lease_expires=None))
+	db.session.commit()
+
+	return result.rowcount
+
+def claim_job(worker):
+	"""
+	 Claims the oldest queued job whose operation is under
+	 its concurrency limit. Returns its id or None.
+	"""
+	jobs = Job.__table__
+	queued = jobs.alias('queued')
+	running = jobs.alias('running')
+
+	# Skip the operations already at their limit
+	candidates = db.select([queued.c.id]).where(queued.c.status == u'Queued')
+	for name, (function, limit) in OPERATIONS.items():
+		if limit is not None:
+			running_count = db.select([db.func.count()])\
+								.where(running.c.status == u'Running')\
+								.where(running.c.operation == name)
+			candidates = candidates.where(db.or_(queued.c.operation != name,
+												running_count.as_scalar() < limit))
+	candidates = candidates.order_by(queued.c.id).limit(1)
+
+	# A single UPDATE, so SQLite's write lock makes the claim atomic
+	now = datetime.now()
+	result = db.session.execute(jobs.update()
+		.where(jobs.c.id == candidates.as_scalar())
+		.values(status=u'Running', worker=worker, attempts=jobs.c.attempts + 1,
+				started_at=now, lease_expires=now + LEASE, error=None))
+	db.session.commit()
+
+	if result.rowcount != 1:
+		return None
+
+	# Workers run one job at a time
+	return db.session.execute(db.select([jobs.c.id])
+		.where(jobs.c.status == u'Running')
+		.where(jobs.c.worker == worker)).scalar()
+
+def run_job(job_id, worker):
+	"""
+	 Runs a claimed job, retrying it later if it fails
+	 and has attempts left. The outcome is only recorded
+	 while the job is still running with this worker.
+	"""
+	jobs = Job.__table__
+	job = Job.query.filter_by(id=job_id).one()
+	function, limit = OPERATIONS[job.operation]
+	arguments = json.loads(job.arguments)
+	attempts, max_attempts = job.attempts, job.max_attempts
+
+	try:
+		result = function(JobContext(job.id, worker), **arguments)
+	except LeaseLost:
+		# Another worker has the job now
+		db.session.rollback()
+		return False
+	except Exception:
+		db.session.rollback()
+		values = {'error': traceback.format_exc(), 'worker': None, 'lease_expires': None}
+		if attempts < max_attempts:
+			values['status'] = u'Queued'
+		else:
+			values['status'] = u'Failed'
+			values['finished_at'] = datetime.now()
+		db.session.execute(jobs.update().where(_held_job(job_id, worker)).values(**values))
+		db.session.commit()
+		return False
+
+	finished = db.session.execute(jobs.update()
+		.where(_held_job(job_id, worker))
+		.values(status=u'Done', progress=100, result=json.dumps(result),
+				finished_at=datetime.now(), lease_expires=None))
+	db.session.commit()
+	return finished.rowcount == 1
+
+def work(worker=None, poll_interval=1.0, once=False):
+	"""
+	 Claims and runs jobs until stopped. With once=True,
+	 returns when the queue is empty.
+	"""
+	worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+
+	last_recovery = 0
+	while True:
+		# Requeue the jobs of crashed workers
+		if time.time() - last_recovery > RECOVERY_INTERVAL:
+			recover_jobs()
+			last_recovery = time.time()
+
+		job_id = claim_job(worker)
+
+		if job_id is None:
+			if once:
+				return
+			time.sleep(poll_interval)
+			continue
+
+		run_job(job_id, worker)
+		db.remove()
+
+def run_pool(concurrency=2, poll_interval=1.0):
+	"""
+	 Runs `concurrency` worker processes and
+	 restarts the ones that die.
+	"""
+	def start_worker(number):
+		process = multiprocessing.Process(target=_worker_process,
+										args=(db.uri, db.shard_uris, poll_interval),
+										name='accounting-worker-%d' % number)
+		process.start()
+		return process
+
+	# Workers get their own connections
+	db.remove()
+	db.dispose()
+
+	# Stop the workers along with the pool
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	processes = [start_worker(number) for number in range(concurrency)]
+	try:
+		while True:
+			for number, process in enumerate(processes):
+				if not process.is_alive():
+					print 'Worker %d died, restarting it.' % number
+					processes[number] = start_worker(number)
+			time.sleep(poll_interval)
+	finally:
+		for process in processes:
+			process.terminate()
+
+def _worker_process(database_uri, shard_uris, poll_interval):
+	db.configure(database_uri, shard_uris)
+	try:
+		work(poll_interval=poll_interval)
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,308 @@
+#!/user/bin/env python2.7
+
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+from sqlalchemy import event, orm
+from sqlalchemy.orm.exc import NoResultFound
+
+from accounting import db
+from database import IN_CLAUSE_CHUNK
+from models import Invoice, Payment, Policy, new_version
+
+"""
+#######################################################
+Process-level cache of the policy ledgers.
+
+A ledger holds a policy's fields with its invoices and
+payments sorted by date, so PolicyAccounting answers any
+date question without loading rows. Each entry carries
+the policy's version stamp, which every write changes:
+ORM flushes through the before_flush hook below and core
+writes explicitly. A lookup only reads the stamp and
+reloads the ledger when it changed.
+#######################################################
+"""
+
+# Cached invoice and payment rows, plus one per policy
+MAX_ROWS = 200000
+
+# Aging buckets: (label, most days past due)
+AGING_BUCKETS = [('current', 0), ('1-30', 30), ('31-60', 60), ('61-90', 90), ('90+', None)]
+
+class Ledger(object):
+	"""
+	 Read-only snapshot of a policy's accounting.
+	"""
+	def __init__(self, policy, invoices, payments):
+		self.policy = policy
+		self.version = policy['version']
+
+		# (bill_date, due_date, cancel_date, amount_due) sorted by bill date
+		self.invoices = invoices
+		self.bill_dates = [invoice[0] for invoice in invoices]
+		self.due_totals = _running_totals(invoice[3] for invoice in invoices)
+
+		# (transaction_date, amount_paid) sorted by transaction date
+		self.payments = payments
+		self.transaction_dates = [payment[0] for payment in payments]
+		self.paid_totals = _running_totals(payment[1] for payment in payments)
+
+	@property
+	def rows(self):
+		return 1 + len(self.invoices) + len(self.payments)
+
+	def due_amount(self, date_cursor):
+		"""
+		 Total of the invoices billed by date_cursor.
+		"""
+		return self.due_totals[bisect_right(self.bill_dates, date_cursor)]
+
+	def paid_amount(self, date_cursor):
+		"""
+		 Total of the payments made by date_cursor.
+		"""
+		return self.paid_totals[bisect_right(self.transaction_dates, date_cursor)]
+
+	def balance(self, date_cursor):
+		return self.due_amount(date_cursor) - self.paid_amount(date_cursor)
+
+	def aging(self, date_cursor):
+		"""
+		 Open amounts of the invoices billed by date_cursor,
+		 by days past their due date.
+		"""
+		billed = self.invoices[:bisect_right(self.bill_dates, date_cursor)]
+		return aging([((date_cursor - due_date).days, amount_due)
+						for bill_date, due_date, cancel_date, amount_due in billed],
+					self.paid_amount(date_cursor))
+
+
+def aging(invoices, paid_amount):
+	"""
+	 Applies the paid amount to the (days past due, amount
+	 due) invoices oldest first, and sums what's left open
+	 in each aging bucket.
+	"""
+	buckets = OrderedDict((label, 0) for label, days in AGING_BUCKETS)
+	for days_past_due, amount_due in invoices:
+		covered = min(amount_due, paid_amount)
+		paid_amount -= covered
+		if amount_due == covered:
+			continue
+
+		for label, days in AGING_BUCKETS:
+			if days is None or days_past_due <= days:
+				buckets[label] += amount_due - covered
+				break
+	return buckets
+
+def _running_totals(amounts):
+	totals = [0]
+	for amount in amounts:
+		totals.append(totals[-1] + amount)
+	return totals
+
+def load_ledger(policy_id, session):
+	"""
+	 Loads the ledger of a policy from its shard.
+	"""
+	policies = Policy.__table__
+	invoices = Invoice.__table__
+	payments = Payment.__table__
+
+	# The stamp is read before the rows, so a concurrent
+	# write can only leave the entry already outdated
+	policy = session.execute(db.select([policies])
+		.where(policies.c.id == policy_id)).first()
+	if policy is None:
+		raise NoResultFound('Policy %s not found!' % policy_id)
+
+	invoice_rows = session.execute(db.select([invoices.c.bill_date,
+											invoices.c.due_date,
+											invoices.c.cancel_date,
+											invoices.c.amount_due])
+		.where(invoices.c.policy_id == policy_id)
+		.where(invoices.c.deleted == False)
+		.order_by(invoices.c.bill_date, invoices.c.id)).fetchall()
+
+	payment_rows = session.execute(db.select([payments.c.transaction_date,
+											payments.c.amount_paid])
+		.where(payments.c.policy_id == policy_id)
+		.order_by(payments.c.transaction_date, payments.c.id)).fetchall()
+
+	return Ledger(dict(policy),
+					[tuple(row) for row in invoice_rows],
+					[tuple(row) for row in payment_rows])
+
+def load_ledgers(policy_ids, session):
+	"""
+	 Loads the ledgers of many policies of a shard with
+	 three queries per IN_CLAUSE_CHUNK policies. Returns
+	 them by policy id, missing policies are left out.
+	"""
+	policies = Policy.__table__
+	invoices = Invoice.__table__
+	payments = Payment.__table__
+
+	policy_ids = list(policy_ids)
+	ledgers = {}
+	for i in range(0, len(policy_ids), IN_CLAUSE_CHUNK):
+		chunk = policy_ids[i:i + IN_CLAUSE_CHUNK]
+
+		policy_rows = session.execute(db.select([policies])
+			.where(policies.c.id.in_(chunk))).fetchall()
+
+		invoice_rows = {}
+		for row in session.execute(db.select([invoices.c.policy_id,
+											invoices.c.bill_date,
+											invoices.c.due_date,
+											invoices.c.cancel_date,
+											invoices.c.amount_due])
+				.where(invoices.c.policy_id.in_(chunk))
+				.where(invoices.c.deleted == False)
+				.order_by(invoices.c.policy_id, invoices.c.bill_date, invoices.c.id)):
+			invoice_rows.setdefault(row[0], []).append(tuple(row)[1:])
+
+		payment_rows = {}
+		for row in session.execute(db.select([payments.c.policy_id,
+											payments.c.transaction_date,
+											payments.c.amount_paid])
+				.where(payments.c.policy_id.in_(chunk))
+				.order_by(payments.c.policy_id, payments.c.transaction_date, payments.c.id)):
+			payment_rows.setdefault(row[0], []).append(tuple(row)[1:])
+
+		for policy in policy_rows:
+			ledgers[policy.id] = Ledger(dict(policy),
+										invoice_rows.get(policy.id, []),
+										payment_rows.get(policy.id, []))
+	return ledgers
+
+
+class LedgerCache(object):
+	"""
+	 LRU cache of ledgers keyed by policy id, bounded
+	 by the number of rows it holds.
+	"""
+	def __init__(self, max_rows=MAX_ROWS):
+		self.max_rows = max_rows
+		self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+		self._entries = OrderedDict()
+		self._rows = 0
+		self._lock = threading.Lock()
+
+	def get(self, policy_id, session):
+		"""
+		 Returns the ledger of a policy, reloading it
+		 if its version stamp changed.
+		"""
+		policy_id = int(policy_id)
+		policies = Policy.__table__
+
+		# Pending ORM changes are flushed, as a query would
+		if session.autoflush:
+			session.flush()
+
+		version = session.execute(db.select([policies.c.version])
+			.where(policies.c.id == policy_id)).scalar()
+
+		with self._lock:
+			ledger = self._entries.get(policy_id)
+			if ledger is not None and version is not None and ledger.version == version:
+				# Most recently used go last
+				del self._entries[policy_id]
+				self._entries[policy_id] = ledger
+				self.stats['hits'] += 1
+				return ledger
+			self.stats['misses'] += 1
+
+			# Deleted policies leave the cache
+			if version is None:
+				self._discard(policy_id)
+
+		ledger = load_ledger(policy_id, session)
+		self._store(policy_id, ledger)
+		return ledger
+
+	def _store(self, policy_id, ledger):
+		with self._lock:
+			self._discard(policy_id)
+			if ledger.rows > self.max_rows:
+				return
+
+			self._entries[policy_id] = ledger
+			self._rows += ledger.rows
+
+			# Evict the least recently used ledgers
+			while self._rows > self.max_rows:
+				oldest = next(iter(self._entries))
+				self._discard(oldest)
+				self.stats['evictions'] += 1
+
+	def _discard(self, policy_id):
+		ledger = self._entries.pop(policy_id, None)
+		if ledger is not None:
+			self._rows -= ledger.rows
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._rows = 0
+
+	def info(self):
+		"""
+		 Returns the stats with the current size.
+		"""
+		with self._lock:
+			info = dict(self.stats)
+			info['entries'] = len(self._entries)
+			info['rows'] = self._rows
+			info['max_rows'] = self.max_rows
+		return info
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_ledger_cache():
+	"""
+	 Returns the process-wide ledger cache.
+	"""
+	global _cache
+	with _cache_lock:
+		if _cache is None:
+			_cache = LedgerCache()
+	return _cache
+
+
+################################
+# Version stamps
+################################
+def stamp_policies(session, policy_ids):
+	"""
+	 Gives the policies a new version stamp, for
+	 the writes that don't go through the ORM.
+	"""
+	policies = Policy.__table__
+	policy_ids = list(policy_ids)
+	for i in range(0, len(policy_ids), IN_CLAUSE_CHUNK):
+		session.execute(policies.update()
+			.where(policies.c.id.in_(policy_ids[i:i + IN_CLAUSE_CHUNK]))
+			.values(version=new_version()))
+
+@event.listens_for(orm.Session, 'before_flush')
+def _stamp_flushed_policies(session, flush_context, instances):
+	policy_ids = set()
+	modified = [instance for instance in session.dirty
+				if session.is_modified(instance, include_collections=False)]
+	for instance in list(session.new) + modified + list(session.deleted):
+		if isinstance(instance, Policy):
+			if instance not in session.deleted:
+				instance.version = new_version()
+		elif isinstance(instance, (Invoice, Payment)) and instance.policy_id is not None:
+			policy_ids.add(instance.policy_id)
+
+	if policy_ids:
+		stamp_policies(session, policy_ids)
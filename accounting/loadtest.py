@@ -0,0 +1,278 @@
+#!/user/bin/env python2.7
+
+import httplib
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+import urlparse
+from datetime import date
+
+from accounting import db
+from models import Payment
+from onboarding import onboard_policies
+from utils import BILLING_SCHEDULES
+
+"""
+#######################################################
+HTTP load-testing harness for the accounting API.
+
+It seeds a scratch database with synthetic policies,
+serves the app from it in a separate process, replays a
+weighted mix of requests at each concurrency level and
+reports throughput, latency percentiles, a latency
+histogram and error rates as JSON.
+#######################################################
+"""
+
+# Default traffic mix: request kind -> weight
+DEFAULT_MIX = {'list': 1, 'policy': 8, 'payment': 2, 'schedule': 0.5}
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+def parse_mix(value):
+	"""
+	 Parses a mix like 'list=1,policy=8,payment=2'.
+	"""
+	mix = {}
+	for item in value.split(','):
+		kind, weight = item.split('=')
+		if kind not in DEFAULT_MIX:
+			raise ValueError('Unknown request kind %s!' % kind)
+		mix[kind] = float(weight)
+	return mix
+
+
+################################
+# Synthetic data and server
+################################
+def seed_database(database_uri, policies=1000, payments=2000, seed=0):
+	"""
+	 Creates the schema and fills it with synthetic policies,
+	 their invoices and some payments. Returns the policy ids.
+	"""
+	db.configure(database_uri)
+	db.drop_all()
+	db.create_all()
+
+	rand = random.Random(seed)
+	records = [{
+		'policy_number': 'Load Policy %d' % i,
+		'effective_date': date(2015, rand.randint(1, 12), 1),
+		'billing_schedule': rand.choice(BILLING_SCHEDULES.keys()),
+		'annual_premium': rand.randint(1, 50) * 120,
+		'named_insured': 'Load Insured %d' % i,
+		'agent': 'Load Agent %d' % (i % 50),
+	} for i in range(policies)]
+	policy_ids = onboard_policies(records)['policies']
+
+	db.session.execute(Payment.__table__.insert(), [{
+		'policy_id': rand.choice(policy_ids),
+		'contact_id': 1,
+		'amount_paid': rand.randint(1, 10) * 10,
+		'transaction_date': date(2015, rand.randint(1, 12), rand.randint(1, 28)),
+	} for i in range(payments)])
+	db.session.commit()
+	db.session.remove()
+
+	return policy_ids
+
+def _serve(database_uri, ready):
+	from werkzeug.serving import WSGIRequestHandler, make_server
+	from accounting import create_app
+
+	# Logging every request would skew the latencies
+	class QuietRequestHandler(WSGIRequestHandler):
+		def log_request(self, *args, **kwargs):
+			pass
+
+	app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri})
+	server = make_server('127.0.0.1', 0, app, threaded=True,
+						request_handler=QuietRequestHandler)
+	ready.put(server.server_port)
+	server.serve_forever()
+
+def start_server(database_uri):
+	"""
+	 Serves the app from its own process.
+	 Returns the process and the base url.
+	"""
+	ready = multiprocessing.Queue()
+	process = multiprocessing.Process(target=_serve, args=(database_uri, ready))
+	process.daemon = True
+	process.start()
+	return process, 'http://127.0.0.1:%d' % ready.get(timeout=30)
+
+
+################################
+# Traffic
+################################
+class Client(object):
+	"""
+	 Sends the requests of one simulated user.
+	"""
+	def __init__(self, base_url, policy_ids, rand):
+		url = urlparse.urlparse(base_url)
+		self.host = url.hostname
+		self.port = url.port or 80
+		self.policy_ids = policy_ids
+		self.rand = rand
+
+	def request(self, kind):
+		"""
+		 Sends a request of the given kind and returns
+		 whether it succeeded.
+		"""
+		policy_id = self.rand.choice(self.policy_ids)
+		body = None
+
+		if kind == 'list':
+			method, path = 'GET', '/api/policies'
+		elif kind == 'policy':
+			method, path = 'GET', '/api/policy/%d?date=2015-%02d-01' % (
+				policy_id, self.rand.randint(1, 12))
+		elif kind == 'payment':
+			method, path = 'POST', '/api/policy/%d/payments' % policy_id
+			body = {'amount': self.rand.randint(1, 10) * 10, 'date': '2015-06-01'}
+		else:
+			method, path = 'POST', '/api/policy/%d/schedule' % policy_id
+			body = {'billing_schedule': self.rand.choice(BILLING_SCHEDULES.keys())}
+
+		connection = httplib.HTTPConnection(self.host, self.port, timeout=30)
+		try:
+			if body is None:
+				connection.request(method, path)
+			else:
+				connection.request(method, path, json.dumps(body),
+									{'Content-Type': 'application/json'})
+			response = connection.getresponse()
+			response.read()
+			return response.status < 400
+		finally:
+			connection.close()
+
+
+def _percentile(latencies, percent):
+	if not latencies:
+		return None
+	index = int(round(percent / 100.0 * (len(latencies) - 1)))
+	return round(latencies[index], 3)
+
+def summarize(samples, elapsed):
+	"""
+	 Returns the throughput, latency percentiles, histogram
+	 and error rate of (latency in ms, succeeded) samples.
+	"""
+	latencies = sorted(latency for latency, succeeded in samples)
+	errors = len([succeeded for latency, succeeded in samples if not succeeded])
+
+	# [upper bound, count] pairs, the last bucket has no bound
+	histogram = [[bucket, 0] for bucket in HISTOGRAM_BUCKETS] + [[None, 0]]
+	for latency in latencies:
+		for bucket in histogram:
+			if bucket[0] is None or latency <= bucket[0]:
+				bucket[1] += 1
+				break
+
+	return {
+		'requests': len(samples),
+		'errors': errors,
+		'error_rate': round(float(errors) / len(samples), 4) if samples else 0.0,
+		'throughput': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+		'latency_ms': {
+			'p50': _percentile(latencies, 50),
+			'p95': _percentile(latencies, 95),
+			'p99': _percentile(latencies, 99),
+			'max': round(latencies[-1], 3) if latencies else None,
+		},
+		'histogram_ms': histogram,
+	}
+
+def run_level(base_url, policy_ids, mix, concurrency, duration, seed=0):
+	"""
+	 Replays the mix with `concurrency` simultaneous users
+	 for `duration` seconds and summarizes the results.
+	"""
+	kinds = sorted(kind for kind, weight in mix.items() if weight > 0)
+	weights = [mix[kind] for kind in kinds]
+	total_weight = sum(weights)
+
+	samples = dict((kind, []) for kind in kinds)
+	lock = threading.Lock()
+	deadline = time.time() + duration
+
+	def user(number):
+		rand = random.Random(seed * 1000 + number)
+		client = Client(base_url, policy_ids, rand)
+		while time.time() < deadline:
+			# Pick a request kind by weight
+			point = rand.uniform(0, total_weight)
+			for kind, weight in zip(kinds, weights):
+				point -= weight
+				if point <= 0:
+					break
+
+			start = time.time()
+			try:
+				succeeded = client.request(kind)
+			except Exception:
+				succeeded = False
+			latency = (time.time() - start) * 1000
+
+			with lock:
+				samples[kind].append((latency, succeeded))
+
+	start = time.time()
+	users = [threading.Thread(target=user, args=(number,)) for number in range(concurrency)]
+	for thread in users:
+		thread.start()
+	for thread in users:
+		thread.join()
+	elapsed = time.time() - start
+
+	report = summarize([sample for kind in kinds for sample in samples[kind]], elapsed)
+	report['concurrency'] = concurrency
+	report['duration'] = round(elapsed, 3)
+	report['by_kind'] = dict((kind, summarize(samples[kind], elapsed)) for kind in kinds)
+	return report
+
+def run(concurrency_levels=(1, 4, 16), duration=10, mix=None, policies=1000,
+		payments=2000, base_url=None, seed=0):
+	"""
+	 Runs every concurrency level against a seeded local
+	 instance (or base_url) and returns the report.
+	"""
+	mix = mix or DEFAULT_MIX
+	server = None
+	scratch = None
+
+	if base_url is None:
+		scratch = tempfile.NamedTemporaryFile(suffix='.sqlite', delete=False)
+		scratch.close()
+		database_uri = 'sqlite:///' + scratch.name
+		policy_ids = seed_database(database_uri, policies, payments, seed)
+		server, base_url = start_server(database_uri)
+	else:
+		policy_ids = range(1, policies + 1)
+
+	try:
+		levels = [run_level(base_url, policy_ids, mix, concurrency, duration, seed)
+					for concurrency in concurrency_levels]
+	finally:
+		if server is not None:
+			server.terminate()
+			server.join()
+		if scratch is not None:
+			os.remove(scratch.name)
+
+	return {
+		'mix': mix,
+		'policies': len(policy_ids),
+		'payments': payments if scratch is not None else None,
+		'duration': duration,
+		'levels': levels,
+	}
@@ -1,12 +1,27 @@
+import random
+from datetime import datetime
+
 from accounting import db
 # from sqlalchemy.ext.declarative import declarative_base
 # 
 # DeclarativeBase = declarative_base()
 
+# Version stamps only need to differ from the previous one, and
+# SystemRandom doesn't repeat its sequence in forked workers
+_stamps = random.SystemRandom()
+
+def new_version():
+	"""
+	 Returns a new version stamp for a policy's ledger.
+	"""
+	return _stamps.getrandbits(62)
+
+
 class Policy(db.Model):
 	__tablename__ = 'policies'
 
-	__table_args__ = {}
+	# Stored in the policy's shard
+	__table_args__ = {'info': {'sharded': True}}
 
 	#column definitions
 	id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -21,6 +36,9 @@ class Policy(db.Model):
 	cancellation_date = db.Column(u'cancellation_date', db.DATE(), nullable=True)
 	cancellation_description = db.Column(u'cancellation_description', db.VARCHAR(length=128), nullable=True)
 
+	# Changes on every write to the policy, its invoices or payments
+	version = db.Column(u'version', db.INTEGER(), default=new_version, server_default='0', nullable=False)
+
 	def __init__(self, policy_number, effective_date, annual_premium):
 		self.policy_number = policy_number
 		self.effective_date = effective_date
@@ -36,7 +54,7 @@ class Contact(db.Model):
 
 	#column definitions
 	id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
-	name = db.Column(u'name', db.VARCHAR(length=128), nullable=False)
+	name = db.Column(u'name', db.VARCHAR(length=128), nullable=False, index=True)
 	role = db.Column(u'role', db.Enum(u'Named Insured', u'Agent'), nullable=False)
 
 	def __init__(self, name, role):
@@ -47,14 +65,17 @@ class Contact(db.Model):
 class Invoice(db.Model):
 	__tablename__ = 'invoices'
 
-	__table_args__ = {}
+	# Stored in the policy's shard. The ledger reads a policy's
+	# invoices in bill date order straight from the index
+	__table_args__ = (db.Index('ix_invoices_policy_id_bill_date', 'policy_id', 'bill_date'),
+						{'info': {'sharded': True}})
 
 	#column definitions
 	id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
 	policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
-	bill_date = db.Column(u'bill_date', db.DATE(), nullable=False)
-	due_date = db.Column(u'due_date', db.DATE(), nullable=False)
-	cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
+	bill_date = db.Column(u'bill_date', db.DATE(), nullable=False, index=True)
+	due_date = db.Column(u'due_date', db.DATE(), nullable=False, index=True)
+	cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False, index=True)
 	amount_due = db.Column(u'amount_due', db.INTEGER(), nullable=False)
 	deleted = db.Column(u'deleted', db.Boolean, default=False, server_default='0', nullable=False)
 
@@ -69,7 +90,10 @@ class Invoice(db.Model):
 class Payment(db.Model):
 	__tablename__ = 'payments'
 
-	__table_args__ = {}
+	# Stored in the policy's shard. The ledger reads a policy's
+	# payments in transaction date order straight from the index
+	__table_args__ = (db.Index('ix_payments_policy_id_transaction_date', 'policy_id', 'transaction_date'),
+						{'info': {'sharded': True}})
 
 	#column definitions
 	id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -77,9 +101,91 @@ class Payment(db.Model):
 	contact_id = db.Column(u'contact_id', db.INTEGER(), db.ForeignKey('contacts.id'), nullable=False)
 	amount_paid = db.Column(u'amount_paid', db.INTEGER(), nullable=False)
 	transaction_date = db.Column(u'transaction_date', db.DATE(), nullable=False)
+	idempotency_key = db.Column(u'idempotency_key', db.VARCHAR(length=64), nullable=True, unique=True)
 
 	def __init__(self, policy_id, contact_id, amount_paid, transaction_date):
 		self.policy_id = policy_id
 		self.contact_id = contact_id
 		self.amount_paid = amount_paid
 		self.transaction_date = transaction_date
+
+
+class Job(db.Model):
+	__tablename__ = 'jobs'
+
+	__table_args__ = {}
+
+	#column definitions
+	id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+	operation = db.Column(u'operation', db.VARCHAR(length=64), nullable=False)
+	arguments = db.Column(u'arguments', db.Text(), nullable=False)
+	status = db.Column(u'status', db.Enum(u'Queued', u'Running', u'Done', u'Failed'), default=u'Queued', nullable=False, index=True)
+	progress = db.Column(u'progress', db.INTEGER(), default=0, nullable=False)
+	result = db.Column(u'result', db.Text(), nullable=True)
+	error = db.Column(u'error', db.Text(), nullable=True)
+	attempts = db.Column(u'attempts', db.INTEGER(), default=0, nullable=False)
+	max_attempts = db.Column(u'max_attempts', db.INTEGER(), default=3, nullable=False)
+	worker = db.Column(u'worker', db.VARCHAR(length=64), nullable=True)
+	lease_expires = db.Column(u'lease_expires', db.DateTime(), nullable=True)
+	created_at = db.Column(u'created_at', db.DateTime(), nullable=False)
+	started_at = db.Column(u'started_at', db.DateTime(), nullable=True)
+	finished_at = db.Column(u'finished_at', db.DateTime(), nullable=True)
+
+	def __init__(self, operation, arguments, max_attempts=3):
+		self.operation = operation
+		self.arguments = arguments
+		self.max_attempts = max_attempts
+		self.status = u'Queued'
+		self.progress = 0
+		self.attempts = 0
+		self.created_at = datetime.now()
+
+
+class IdSequence(db.Model):
+	__tablename__ = 'sequences'
+
+	__table_args__ = {}
+
+	#column definitions
+	name = db.Column(u'name', db.VARCHAR(length=64), primary_key=True, nullable=False)
+	next_value = db.Column(u'next_value', db.INTEGER(), nullable=False)
+
+	def __init__(self, name, next_value=1):
+		self.name = name
+		self.next_value = next_value
+
+
+class IdempotencyKey(db.Model):
+	__tablename__ = 'idempotency_keys'
+
+	# In the main database, so a key is unique across the shards
+	__table_args__ = {}
+
+	#column definitions
+	key = db.Column(u'key', db.VARCHAR(length=64), primary_key=True, nullable=False)
+	policy_id = db.Column(u'policy_id', db.INTEGER(), nullable=False)
+	amount_paid = db.Column(u'amount_paid', db.INTEGER(), nullable=False)
+
+	def __init__(self, key, policy_id, amount_paid):
+		self.key = key
+		self.policy_id = policy_id
+		self.amount_paid = amount_paid
+
+
+class Change(db.Model):
+	__tablename__ = 'changes'
+
+	# Stored in the shard of the changed rows, in the same transaction.
+	# AUTOINCREMENT, so sequence numbers are never reused
+	__table_args__ = {'info': {'sharded': True}, 'sqlite_autoincrement': True}
+
+	#column definitions
+	seq = db.Column(u'seq', db.INTEGER(), primary_key=True, nullable=False)
+	policy_id = db.Column(u'policy_id', db.INTEGER(), nullable=False)
+	table_name = db.Column(u'table_name', db.Enum(u'policies', u'invoices', u'payments'), nullable=False)
+	row_id = db.Column(u'row_id', db.INTEGER(), nullable=False)
+
+	def __init__(self, policy_id, table_name, row_id):
+		self.policy_id = policy_id
+		self.table_name = table_name
+		self.row_id = row_id
@@ -0,0 +1,182 @@
+#!/user/bin/env python2.7
+
+from datetime import date, datetime
+
+from accounting import db
+from database import IN_CLAUSE_CHUNK
+from changes import record_policies
+from models import Contact, Invoice, Policy
+from sharding import allocate_policy_ids
+from utils import BILLING_SCHEDULES, invoice_schedule
+
+"""
+#######################################################
+Bulk policy onboarding.
+
+Contacts are resolved through a single (name, role) -> id
+map, under the main database's write lock, so existing
+contacts are reused instead of duplicated, and the policies and their invoices are inserted with
+executemany, in one transaction per database. With shards,
+the batch isn't atomic across databases: a failure after
+the first commit leaves the earlier databases written.
+#######################################################
+"""
+
+def _parse_date(value):
+	"""
+	 Accepts a date or a YYYY-MM-DD string.
+	"""
+	if isinstance(value, date):
+		return value
+	return datetime.strptime(value, '%Y-%m-%d').date()
+
+def _normalize_record(index, record):
+	"""
+	 Validates an onboarding record and
+	 returns it with parsed values.
+	"""
+	try:
+		policy = {
+			'policy_number': record['policy_number'],
+			'effective_date': _parse_date(record['effective_date']),
+			'billing_schedule': record.get('billing_schedule') or 'Annual',
+			'annual_premium': int(record['annual_premium']),
+			'named_insured': record['named_insured'],
+			'agent': record['agent'],
+		}
+	except KeyError as e:
+		raise ValueError('Record %d: %s is required!' % (index, e.args[0]))
+	except (TypeError, ValueError) as e:
+		raise ValueError('Record %d: %s' % (index, e))
+
+	for field in ('policy_number', 'named_insured', 'agent'):
+		if not isinstance(policy[field], basestring) or not policy[field].strip():
+			raise ValueError('Record %d: %s must be a non-empty string!' % (index, field))
+
+	if policy['billing_schedule'] not in BILLING_SCHEDULES:
+		raise ValueError('Record %d: bad billing schedule %s!'
+						% (index, policy['billing_schedule']))
+
+	return policy
+
+def _load_contact_ids(names):
+	"""
+	 Returns the (name, role) -> id map of the existing
+	 contacts, keeping the oldest one of any duplicates.
+	"""
+	contacts = Contact.__table__
+	names = list(names)
+
+	contact_ids = {}
+	for i in range(0, len(names), IN_CLAUSE_CHUNK):
+		query = db.select([contacts.c.id, contacts.c.name, contacts.c.role])\
+					.where(contacts.c.name.in_(names[i:i + IN_CLAUSE_CHUNK]))\
+					.order_by(contacts.c.id.desc())
+		for contact_id, name, role in db.session.execute(query):
+			contact_ids[(name, role)] = contact_id
+
+	return contact_ids
+
+def resolve_contacts(wanted):
+	"""
+	 Returns the (name, role) -> id map for the wanted contacts,
+	 creating the ones that don't exist yet, and the number created.
+	 Starts the session's transaction with the write lock, which
+	 is held until the caller commits.
+	"""
+	# Two batches reading before either writes would both
+	# create the contacts they miss
+	db.session.execute('BEGIN IMMEDIATE')
+
+	names = set(name for name, role in wanted)
+	contact_ids = _load_contact_ids(names)
+
+	# Create the missing contacts at once
+	missing = [{'name': name, 'role': role}
+				for name, role in wanted if (name, role) not in contact_ids]
+	if missing:
+		db.session.execute(Contact.__table__.insert(), missing)
+		contact_ids = _load_contact_ids(names)
+
+	return contact_ids, len(missing)
+
+def onboard_policies(records):
+	"""
+	 Creates the policies and their invoices, resolving or
+	 creating the insured and agent contacts by name.
+	 Returns the new policy ids, in the records order.
+	"""
+	policies = [_normalize_record(index, record)
+				for index, record in enumerate(records)]
+
+	# With shards, the ids come from the main database's sequence
+	if db.sharded:
+		policy_ids = allocate_policy_ids(len(policies))
+	else:
+		policy_ids = [None] * len(policies)
+
+	sessions = [db.session]
+	try:
+		# Resolve every contact through a single lookup map
+		wanted = set()
+		for policy in policies:
+			wanted.add((policy['named_insured'], 'Named Insured'))
+			wanted.add((policy['agent'], 'Agent'))
+		contact_ids, contacts_created = resolve_contacts(wanted)
+
+		# Insert the policies in their shards, collecting their ids
+		insert_policy = Policy.__table__.insert()
+		for index, policy in enumerate(policies):
+			row = {
+				'policy_number': policy['policy_number'],
+				'effective_date': policy['effective_date'],
+				'billing_schedule': policy['billing_schedule'],
+				'annual_premium': policy['annual_premium'],
+				'named_insured': contact_ids[(policy['named_insured'], 'Named Insured')],
+				'agent': contact_ids[(policy['agent'], 'Agent')],
+			}
+			if policy_ids[index] is None:
+				policy_ids[index] = db.session.execute(insert_policy, row).lastrowid
+			else:
+				row['id'] = policy_ids[index]
+				session = db.session_for(row['id'])
+				session.execute(insert_policy, row)
+				if session not in sessions:
+					sessions.append(session)
+
+		# Insert all the invoices of each shard at once
+		invoices = {}
+		for policy_id, policy in zip(policy_ids, policies):
+			for bill_date, due_date, cancel_date, amount_due in invoice_schedule(
+					policy['effective_date'], policy['billing_schedule'],
+					policy['annual_premium']):
+				invoices.setdefault(db.shard_for(policy_id), []).append({
+					'policy_id': policy_id,
+					'bill_date': bill_date,
+					'due_date': due_date,
+					'cancel_date': cancel_date,
+					'amount_due': amount_due,
+				})
+		for shard, shard_invoices in invoices.items():
+			db.shard_session(shard).execute(Invoice.__table__.insert(), shard_invoices)
+
+		# Add the new policies and invoices to the change feed
+		by_shard = {}
+		for policy_id in policy_ids:
+			by_shard.setdefault(db.shard_for(policy_id), []).append(policy_id)
+		for shard, shard_policy_ids in by_shard.items():
+			record_policies(db.shard_session(shard), shard_policy_ids)
+
+		# Contacts first, so no policy points to a missing contact
+		for session in sessions:
+			session.commit()
+	except:
+		for session in sessions:
+			session.rollback()
+		raise
+
+	return {
+		'policies': policy_ids,
+		'contacts_created': contacts_created,
+		'invoices_created': sum(len(shard_invoices) for shard_invoices in invoices.values()),
+	}
@@ -0,0 +1,307 @@
+#!/user/bin/env python2.7
+
+import Queue
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from accounting import db
+from database import IN_CLAUSE_CHUNK
+from models import Payment, Policy
+from changes import record_changes
+from ledger import stamp_policies
+from utils import IdempotencyConflict, check_idempotent, claim_idempotency_keys
+
+"""
+#######################################################
+Group-commit payment writer.
+
+Concurrent payments are queued and written by a single
+thread, which collects them for a few milliseconds and
+commits them in one transaction per shard. Every caller still gets
+its own payment id back, and idempotency keys make
+retries safe: a retry gets the payment already made,
+and a key reused for another policy or amount fails.
+Keys are claimed in the main database before the
+payments are written, so they hold across the shards.
+#######################################################
+"""
+
+# A payment of a batch, new or made earlier with the same key
+PaidPayment = namedtuple('PaidPayment', 'id policy_id amount_paid transaction_date')
+
+class PaymentTimeout(Exception):
+	"""
+	 Raised when a payment wasn't confirmed in time.
+	"""
+	pass
+
+
+class PaymentRequest(object):
+	"""
+	 A queued payment and its confirmation.
+	"""
+	def __init__(self, policy_id, contact_id, amount, transaction_date, idempotency_key=None):
+		self.policy_id = int(policy_id)
+		self.contact_id = contact_id
+		self.amount = amount
+		self.transaction_date = transaction_date
+		self.idempotency_key = idempotency_key
+
+		self.payment_id = None
+		self.duplicate = False
+		self.error = None
+		self._done = threading.Event()
+
+	def resolve(self, payment_id=None, duplicate=False, error=None, transaction_date=None):
+		self.payment_id = payment_id
+		self.duplicate = duplicate
+		self.error = error
+		# A retry gets the date of the payment already made
+		if transaction_date is not None:
+			self.transaction_date = transaction_date
+		self._done.set()
+
+	def wait(self, timeout=None):
+		"""
+		 Blocks until the payment is committed and
+		 returns its id, or raises its error.
+		"""
+		if not self._done.wait(timeout):
+			raise PaymentTimeout('Payment for policy %s wasn\'t confirmed!' % self.policy_id)
+		if self.error is not None:
+			raise self.error
+		return self.payment_id
+
+
+class PaymentWriter(object):
+	"""
+	 Collects the payments submitted during a commit window
+	 and writes them in a single transaction.
+	"""
+	def __init__(self, window=0.005, max_batch=500):
+		self.window = window
+		self.max_batch = max_batch
+		self.stats = {'batches': 0, 'payments': 0, 'duplicates': 0, 'errors': 0}
+
+		self._queue = Queue.Queue()
+		self._thread = None
+
+	def start(self):
+		if self._thread is None or not self._thread.is_alive():
+			self._thread = threading.Thread(target=self._run, name='payment-writer')
+			self._thread.daemon = True
+			self._thread.start()
+		return self
+
+	def stop(self):
+		"""
+		 Writes the queued payments and stops the thread.
+		"""
+		if self._thread is not None:
+			self._queue.put(None)
+			self._thread.join()
+			self._thread = None
+
+	def submit(self, policy_id, contact_id=None, amount=0, transaction_date=None, idempotency_key=None):
+		"""
+		 Queues a payment and returns its PaymentRequest.
+		"""
+		if not transaction_date:
+			transaction_date = datetime.now().date()
+
+		request = PaymentRequest(policy_id, contact_id, amount,
+								transaction_date, idempotency_key)
+		self.start()
+		self._queue.put(request)
+		return request
+
+	def make_payment(self, policy_id, contact_id=None, amount=0, transaction_date=None,
+					idempotency_key=None, timeout=10):
+		"""
+		 Queues a payment and waits for its id.
+		"""
+		return self.submit(policy_id, contact_id, amount, transaction_date,
+							idempotency_key).wait(timeout)
+
+	def _run(self):
+		while True:
+			# Wait for a payment, then collect the ones
+			# arriving during the commit window
+			request = self._queue.get()
+			if request is None:
+				return
+
+			batch = [request]
+			deadline = time.time() + self.window
+			stopping = False
+			while len(batch) < self.max_batch:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				try:
+					request = self._queue.get(timeout=remaining)
+				except Queue.Empty:
+					break
+				if request is None:
+					stopping = True
+					break
+				batch.append(request)
+
+			# Each shard commits its own payments
+			by_shard = {}
+			for request in self.claim_keys(batch):
+				by_shard.setdefault(db.shard_for(request.policy_id), []).append(request)
+			for shard in sorted(by_shard):
+				self.write_batch(by_shard[shard])
+
+			if stopping:
+				return
+
+	def claim_keys(self, batch):
+		"""
+		 Claims the idempotency keys of a batch in the main
+		 database, which holds them for every shard. Fails
+		 the payments whose key was used for another payment
+		 and returns the ones to write.
+		"""
+		keyed = [request for request in batch if request.idempotency_key]
+		if not keyed:
+			return batch
+
+		try:
+			claims = claim_idempotency_keys([(request.idempotency_key, request.policy_id, request.amount)
+											for request in keyed])
+		except Exception:
+			db.session.rollback()
+			error = sys.exc_info()[1]
+			for request in keyed:
+				self.stats['errors'] += 1
+				request.resolve(error=error)
+			return [request for request in batch if not request.idempotency_key]
+		finally:
+			db.session.remove()
+
+		pending = []
+		for request in batch:
+			if request.idempotency_key:
+				try:
+					check_idempotent(claims[request.idempotency_key], request.policy_id, request.amount)
+				except IdempotencyConflict:
+					self.stats['errors'] += 1
+					request.resolve(error=sys.exc_info()[1])
+					continue
+			pending.append(request)
+		return pending
+
+	def write_batch(self, batch):
+		"""
+		 Writes a batch of payments of the same shard in one
+		 transaction. If the transaction fails, the payments are
+		 retried one by one so a bad payment only fails its own caller.
+		"""
+		session = db.session_for(batch[0].policy_id)
+		try:
+			self._commit(session, batch)
+			self.stats['batches'] += 1
+		except Exception:
+			session.rollback()
+			if len(batch) == 1:
+				self.stats['errors'] += 1
+				batch[0].resolve(error=sys.exc_info()[1])
+			else:
+				for request in batch:
+					self.write_batch([request])
+		finally:
+			session.remove()
+
+	def _commit(self, session, batch):
+		policies = Policy.__table__
+		payments = Payment.__table__
+
+		# Load the named insured of every policy in the batch
+		policy_ids = list(set(request.policy_id for request in batch))
+		named_insureds = {}
+		for i in range(0, len(policy_ids), IN_CLAUSE_CHUNK):
+			query = db.select([policies.c.id, policies.c.named_insured])\
+						.where(policies.c.id.in_(policy_ids[i:i + IN_CLAUSE_CHUNK]))
+			named_insureds.update(session.execute(query).fetchall())
+
+		# Load the payments already made for the idempotency keys
+		keys = list(set(request.idempotency_key for request in batch
+						if request.idempotency_key))
+		paid = {}
+		for i in range(0, len(keys), IN_CLAUSE_CHUNK):
+			query = db.select([payments.c.idempotency_key,
+								payments.c.id,
+								payments.c.policy_id,
+								payments.c.amount_paid,
+								payments.c.transaction_date])\
+						.where(payments.c.idempotency_key.in_(keys[i:i + IN_CLAUSE_CHUNK]))
+			for row in session.execute(query):
+				paid[row.idempotency_key] = PaidPayment(row.id, row.policy_id,
+														row.amount_paid, row.transaction_date)
+
+		# Insert the new payments
+		results = []
+		conflicts = []
+		paid_policies = set()
+		insert_payment = payments.insert()
+		for request in batch:
+			key = request.idempotency_key
+			if key and key in paid:
+				try:
+					check_idempotent(paid[key], request.policy_id, request.amount)
+				except IdempotencyConflict:
+					conflicts.append((request, sys.exc_info()[1]))
+				else:
+					results.append((request, paid[key], True))
+				continue
+
+			if request.policy_id not in named_insureds:
+				raise ValueError('Policy %s not found!' % request.policy_id)
+
+			result = session.execute(insert_payment, {
+				'policy_id': request.policy_id,
+				'contact_id': request.contact_id or named_insureds[request.policy_id],
+				'amount_paid': request.amount,
+				'transaction_date': request.transaction_date,
+				'idempotency_key': key,
+			})
+			payment = PaidPayment(result.lastrowid, request.policy_id,
+									request.amount, request.transaction_date)
+			if key:
+				paid[key] = payment
+			paid_policies.add(request.policy_id)
+			results.append((request, payment, False))
+
+		# The cached ledgers of these policies are outdated
+		stamp_policies(session, paid_policies)
+		record_changes(session, [(request.policy_id, u'payments', payment.id)
+								for request, payment, duplicate in results if not duplicate])
+		session.commit()
+
+		# Confirm every caller once the batch is committed
+		for request, payment, duplicate in results:
+			self.stats['payments'] += 1
+			if duplicate:
+				self.stats['duplicates'] += 1
+			request.resolve(payment.id, duplicate, transaction_date=payment.transaction_date)
+		for request, error in conflicts:
+			self.stats['errors'] += 1
+			request.resolve(error=error)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_payment_writer():
+	"""
+	 Returns the process-wide payment writer.
+	"""
+	global _writer
+	with _writer_lock:
+		if _writer is None:
+			_writer = PaymentWriter().start()
+	return _writer
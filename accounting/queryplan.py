@@ -0,0 +1,301 @@
+#!/user/bin/env python2.7
+
+import atexit
+import json
+import re
+import threading
+from collections import OrderedDict
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+#######################################################
+Query-plan audit.
+
+The recorder captures every distinct statement the app
+sends to SQLite, from any engine, with a sample of its
+parameters and how often it ran. The audit runs EXPLAIN
+QUERY PLAN on each against a realistically sized database
+and flags full scans of filtered tables, temp B-trees
+(ORDER BY, GROUP BY, DISTINCT) and the indexes no plan
+uses. Set ACCOUNTING_QUERY_LOG to a file to record a run
+of the test suite, then feed it to audit_queries.py.
+#######################################################
+"""
+
+# Statements run at least this often are on a hot path
+HOT_EXECUTIONS = 10
+
+# Statements worth explaining
+EXPLAINED = ('SELECT', 'UPDATE', 'DELETE')
+
+_IN_LIST = re.compile(r'IN \((\?(, )?)+\)')
+_SCAN = re.compile(r'^SCAN (TABLE )?(\w+)')
+_TEMP_BTREE = re.compile(r'USE TEMP B-TREE FOR (.+)$')
+_WHERE = re.compile(r'\bWHERE\b', re.IGNORECASE)
+_INDEX = re.compile(r'(?:USING|COVERING) (?:COVERING )?INDEX (\w+)')
+
+def normalize(statement):
+	"""
+	 Collapses whitespace and IN lists, so the chunks
+	 of a chunked query count as one statement.
+	"""
+	return _IN_LIST.sub('IN (?...)', ' '.join(statement.split()))
+
+
+class QueryRecorder(object):
+	"""
+	 Records the statements executed by every engine
+	 while it is started.
+	"""
+	def __init__(self):
+		self.statements = OrderedDict()
+		self.recording = False
+		self._lock = threading.Lock()
+
+		# Engine listeners can't be removed, so it stays
+		# registered and only records while started
+		event.listen(Engine, 'before_cursor_execute', self._record)
+
+	def start(self):
+		self.recording = True
+		return self
+
+	def stop(self):
+		self.recording = False
+		return self
+
+	def _record(self, conn, cursor, statement, parameters, context, executemany):
+		if not self.recording:
+			return
+		if not statement.lstrip().upper().startswith(EXPLAINED):
+			return
+
+		# Keep one parameter set, executemany sends a list
+		if executemany:
+			parameters = parameters[0] if parameters else ()
+
+		key = normalize(statement)
+		with self._lock:
+			entry = self.statements.get(key)
+			if entry is None:
+				entry = self.statements[key] = {
+					'statement': statement,
+					'parameters': list(parameters),
+					'executions': 0,
+				}
+			entry['executions'] += 1
+
+	def merge(self, statements):
+		"""
+		 Adds the statements of another recording.
+		"""
+		with self._lock:
+			for key, recorded in statements.items():
+				entry = self.statements.setdefault(key, dict(recorded, executions=0))
+				entry['executions'] += recorded['executions']
+
+	def save(self, path):
+		with open(path, 'w') as log:
+			json.dump(self.statements, log, indent=2, default=str)
+
+	@staticmethod
+	def load(path):
+		with open(path) as log:
+			return json.load(log, object_pairs_hook=OrderedDict)
+
+
+_recorder = None
+
+def get_recorder():
+	"""
+	 Returns the process-wide recorder.
+	"""
+	global _recorder
+	if _recorder is None:
+		_recorder = QueryRecorder()
+	return _recorder
+
+def record_to(path):
+	"""
+	 Records every statement of this process into
+	 `path`, merging with what the file already has.
+	"""
+	recorder = get_recorder().start()
+
+	def save():
+		try:
+			recorder.merge(QueryRecorder.load(path))
+		except (IOError, ValueError):
+			pass
+		recorder.save(path)
+	atexit.register(save)
+
+
+################################
+# Audit
+################################
+def explain(connection, statement, parameters):
+	"""
+	 Returns the detail lines of the statement's query plan.
+	"""
+	rows = connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+	return [row[-1] for row in rows]
+
+def scanned_table(detail):
+	"""
+	 Returns the table a plan line scans in full, or None.
+	 SQLite 3.36+ prints "SCAN t", older ones "SCAN TABLE t".
+	"""
+	scan = _SCAN.match(detail)
+	if scan and 'CONSTANT ROW' not in detail:
+		return scan.group(2)
+	return None
+
+def plan_findings(statement, plan):
+	"""
+	 Returns the problems in a plan: full scans of tables
+	 the statement filters, and temp B-trees.
+	"""
+	findings = []
+	filtered = _WHERE.search(statement) is not None
+	for detail in plan:
+		table = scanned_table(detail)
+		if table and filtered:
+			findings.append('scan %s' % table)
+
+		temp_btree = _TEMP_BTREE.search(detail)
+		if temp_btree:
+			findings.append('temp b-tree for %s' % temp_btree.group(1).lower())
+	return findings
+
+def audit(statements, database_uri, hot_executions=HOT_EXECUTIONS):
+	"""
+	 Explains the recorded statements against a database.
+	 Returns the report with the findings of each statement
+	 and the indexes no plan used.
+	"""
+	engine = sqlalchemy.create_engine(database_uri)
+	connection = engine.raw_connection()
+	try:
+		indexes = [name for name, in connection.execute(
+			"SELECT name FROM sqlite_master WHERE type = 'index' "
+			"AND name NOT LIKE 'sqlite_autoindex_%' ORDER BY name")]
+
+		results = []
+		used = set()
+		for key, entry in statements.items():
+			try:
+				plan = explain(connection, entry['statement'], entry['parameters'])
+			except Exception as e:
+				# E.g. tables the audit database doesn't have
+				results.append({'statement': key, 'executions': entry['executions'],
+								'hot': entry['executions'] >= hot_executions,
+								'plan': [], 'findings': [], 'error': str(e)})
+				continue
+
+			for detail in plan:
+				used.update(_INDEX.findall(detail))
+
+			results.append({
+				'statement': key,
+				'executions': entry['executions'],
+				'hot': entry['executions'] >= hot_executions,
+				'plan': plan,
+				'findings': plan_findings(entry['statement'], plan),
+			})
+	finally:
+		connection.close()
+		engine.dispose()
+
+	return {
+		'statements': results,
+		'unused_indexes': [name for name in indexes if name not in used],
+	}
+
+def regressions(report, baseline=()):
+	"""
+	 Returns the (statement, finding) pairs of hot
+	 statements that aren't accepted by the baseline.
+	"""
+	accepted = set(tuple(item) for item in baseline)
+	return [(result['statement'], finding)
+			for result in report['statements'] if result['hot']
+			for finding in result['findings']
+			if (result['statement'], finding) not in accepted]
+
+def accept(report, baseline=()):
+	"""
+	 Returns the baseline plus the regressions of the
+	 report, as sorted [statement, finding] pairs.
+	"""
+	accepted = set(tuple(item) for item in baseline) | set(regressions(report))
+	return [list(item) for item in sorted(accepted)]
+
+
+################################
+# Workload
+################################
+def run_workload(policy_ids, rounds=20):
+	"""
+	 Runs the app's read and write paths in this process
+	 against the bound database, for the recorder.
+	"""
+	import random
+	from datetime import date
+
+	from accounting import create_app, db
+	from billing import billing_run
+	from jobs import enqueue, work
+	from ledger import get_ledger_cache
+	from onboarding import onboard_policies
+	from payments import PaymentWriter
+	from utils import BILLING_SCHEDULES, PolicyAccounting
+
+	rand = random.Random(0)
+	client = create_app({'SQLALCHEMY_DATABASE_URI': db.uri,
+						'SHARD_DATABASE_URIS': db.shard_uris}).test_client()
+	writer = PaymentWriter().start()
+
+	try:
+		for i in range(rounds):
+			policy_id = rand.choice(policy_ids)
+			date_cursor = date(2015, rand.randint(1, 12), 1)
+
+			# Reads, with and without the ledger cache
+			get_ledger_cache().clear()
+			pa = PolicyAccounting.for_reading(policy_id)
+			pa.generate_policy_dict(date_cursor)
+			pa.evaluate_cancellation_pending_due_to_non_pay(date_cursor)
+			pa.evaluate_cancel(date_cursor)
+			client.get('/api/policy/%d?date=2015-06-01' % policy_id)
+
+			# Writes
+			writer.make_payment(policy_id, amount=10, transaction_date=date_cursor)
+			pa = PolicyAccounting(policy_id)
+			pa.make_payment(amount=10, date_cursor=date_cursor)
+			pa.change_schedule(rand.choice(BILLING_SCHEDULES.keys()))
+			client.post('/api/policy/%d/schedule' % policy_id, data=json.dumps(
+				{'billing_schedule': rand.choice(BILLING_SCHEDULES.keys())}),
+				content_type='application/json')
+
+		client.get('/api/policies')
+		client.get('/api/policies?format=compact')
+		list(billing_run(date(2015, 2, 1), date(2015, 2, 28)))
+
+		onboard_policies([{
+			'policy_number': 'Audit Policy %d' % i,
+			'effective_date': '2015-01-01',
+			'billing_schedule': 'Monthly',
+			'annual_premium': 1200,
+			'named_insured': 'Audit Insured %d' % i,
+			'agent': 'Audit Agent',
+		} for i in range(10)])
+
+		enqueue('balance_report', {'policy_ids': policy_ids[:20], 'date': '2015-06-01'})
+		work('audit-worker', once=True)
+	finally:
+		writer.stop()
+		db.remove()
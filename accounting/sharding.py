@@ -0,0 +1,173 @@
+#!/user/bin/env python2.7
+
+import sqlalchemy
+
+from accounting import db
+from changes import record_policies
+from models import Change, IdSequence, Invoice, Payment, Policy
+
+"""
+#######################################################
+Policy id allocation and resharding.
+
+Policies are routed to shard policy_id % number of shards.
+Their ids come from a sequence in the main database, so
+they stay unique across shards. Invoices and payments keep
+per-shard ids and are always looked up through their policy.
+#######################################################
+"""
+
+# Rows copied per statement when resharding
+COPY_CHUNK = 500
+
+def allocate_policy_ids(count=1):
+	"""
+	 Reserves `count` consecutive policy ids
+	 from the sequence of the main database.
+	"""
+	sequences = IdSequence.__table__
+
+	# A single UPDATE, so SQLite's write lock makes the reservation atomic
+	result = db.session.execute(sequences.update()
+		.where(sequences.c.name == u'policies')
+		.values(next_value=sequences.c.next_value + count))
+	if result.rowcount == 0:
+		db.session.execute(sequences.insert(), {'name': u'policies', 'next_value': 1 + count})
+	next_value = db.session.execute(db.select([sequences.c.next_value])
+		.where(sequences.c.name == u'policies')).scalar()
+	db.session.commit()
+
+	return range(next_value - count, next_value)
+
+def set_policy_sequence(next_value):
+	"""
+	 Makes the next allocated policy id `next_value`.
+	"""
+	sequences = IdSequence.__table__
+
+	db.session.execute(sequences.delete().where(sequences.c.name == u'policies'))
+	db.session.execute(sequences.insert(), {'name': u'policies', 'next_value': next_value})
+	db.session.commit()
+
+def add_policies(policies):
+	"""
+	 Adds new Policy rows to the sessions of their shards
+	 and commits them. Without shards, ids are left to SQLite.
+	"""
+	if db.sharded:
+		for policy, policy_id in zip(policies, allocate_policy_ids(len(policies))):
+			policy.id = policy_id
+
+	sessions = []
+	for policy in policies:
+		session = db.session_for(policy.id) if db.sharded else db.session
+		session.add(policy)
+		if session not in sessions:
+			sessions.append(session)
+
+	for session in sessions:
+		session.commit()
+
+def _copy_policies(connection, targets):
+	"""
+	 Copies the policies of a source connection, with their
+	 invoices and payments, to the target shard connections.
+	 Returns the copied (policies, invoices, payments) counts.
+	"""
+	counts = [0, 0, 0]
+	for position, model in enumerate((Policy, Invoice, Payment)):
+		table = model.__table__
+		key = table.c.id if model is Policy else table.c.policy_id
+
+		# Invoice and payment ids are only unique within a shard
+		columns = [column for column in table.c
+					if model is Policy or column.name != 'id']
+
+		result = connection.execute(db.select(columns).order_by(table.c.id))
+		while True:
+			rows = result.fetchmany(COPY_CHUNK)
+			if not rows:
+				break
+
+			by_shard = {}
+			for row in rows:
+				shard = row[key.name] % len(targets)
+				by_shard.setdefault(shard, []).append(dict(row))
+			for shard, shard_rows in by_shard.items():
+				targets[shard].execute(table.insert(), shard_rows)
+
+			counts[position] += len(rows)
+
+	return counts
+
+def reshard(shard_uris):
+	"""
+	 Copies the policies, invoices and payments of the current
+	 databases into the new shards, routing each policy to
+	 policy_id % len(shard_uris), and moves the policy sequence
+	 past the copied ids. The source data is left untouched,
+	 point SHARD_DATABASE_URIS to the new shards afterwards.
+	"""
+	shard_uris = list(shard_uris)
+	if not shard_uris:
+		raise ValueError('At least one shard is required!')
+
+	sources = set([db.uri] + [str(db.shard_engine(shard).url) for shard in range(db.shards)])
+	if sources.intersection(shard_uris):
+		raise ValueError('The new shards must be new databases!')
+
+	tables = [model.__table__ for model in (Policy, Invoice, Payment, Change)]
+
+	# Create the schema of the new shards
+	engines = [sqlalchemy.create_engine(uri) for uri in shard_uris]
+	for engine in engines:
+		db.Model.metadata.create_all(bind=engine, tables=tables)
+
+	# Each new shard must be empty, or the ids would clash
+	for engine in engines:
+		if engine.execute(db.select([db.func.count()]).select_from(tables[0])).scalar():
+			for new_engine in engines:
+				new_engine.dispose()
+			raise ValueError('Shard %s already has policies!' % engine.url)
+
+	targets = [engine.connect() for engine in engines]
+	transactions = [target.begin() for target in targets]
+	counts = [0, 0, 0]
+	try:
+		for shard in range(db.shards):
+			connection = db.shard_engine(shard).connect()
+			try:
+				copied = _copy_policies(connection, targets)
+			finally:
+				connection.close()
+			counts = [total + count for total, count in zip(counts, copied)]
+
+		# The rows got new ids, so the feeds of the new shards
+		# start with every row and the old cursors are refused
+		for target in targets:
+			record_policies(target)
+
+		for transaction in transactions:
+			transaction.commit()
+	except:
+		for transaction in transactions:
+			transaction.rollback()
+		raise
+	finally:
+		for target in targets:
+			target.close()
+		for engine in engines:
+			engine.dispose()
+
+	# Ids allocated from now on follow the copied ones
+	last_ids = db.fan_out(lambda session: session.execute(
+		db.select([db.func.max(tables[0].c.id)])).scalar())
+	IdSequence.__table__.create(bind=db.engine, checkfirst=True)
+	set_policy_sequence(max([0] + [last_id for last_id in last_ids if last_id]) + 1)
+
+	return {
+		'shards': len(shard_uris),
+		'policies': counts[0],
+		'invoices': counts[1],
+		'payments': counts[2],
+	}
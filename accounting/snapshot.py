@@ -0,0 +1,537 @@
+#!/user/bin/env python2.7
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+from accounting import db
+from ledger import aging
+from models import Invoice, Payment, Policy
+
+"""
+#######################################################
+Read-only ledger snapshot shared across processes.
+
+The exporter writes the policies, invoices and payments
+as fixed-width little-endian columns into one versioned
+file, with the invoice and payment running totals of each
+policy precomputed. Workers memory-map the file read-only,
+so every process shares the same pages from the OS cache,
+and read values straight from the mapping with
+struct.unpack_from. A new snapshot is written next to the
+current one and renamed over it, readers pick it up on
+their next check and keep the old mapping until then.
+
+Layout: the header, then each column of POLICY_COLUMNS,
+INVOICE_COLUMNS and PAYMENT_COLUMNS in order, then the
+policy numbers in UTF-8. Every section is 8-byte aligned.
+Dates are stored as ordinals, with 0 for no date, and
+missing contact ids as 0.
+#######################################################
+"""
+
+MAGIC = 'ACCTSNAP'
+
+# Bumped on any change of the layout
+FORMAT_VERSION = 1
+
+# magic, format version, snapshot version, created at,
+# number of policies, invoices and payments, text bytes
+HEADER = struct.Struct('<8sIqdqqqq')
+
+POLICY_COLUMNS = [
+	('id', 'q'),
+	('version', 'q'),
+	('effective_date', 'i'),
+	('cancellation_date', 'i'),
+	('status', 'B'),
+	('billing_schedule', 'B'),
+	('annual_premium', 'q'),
+	('named_insured', 'q'),
+	('agent', 'q'),
+	# Ranges of the policy's rows in the other sections
+	('invoices_start', 'q'),
+	('invoices_end', 'q'),
+	('payments_start', 'q'),
+	('payments_end', 'q'),
+	('policy_number_start', 'q'),
+	('policy_number_end', 'q'),
+]
+
+# Sorted by policy, then by date. Totals run within each policy
+INVOICE_COLUMNS = [
+	('bill_date', 'i'),
+	('due_date', 'i'),
+	('cancel_date', 'i'),
+	('amount_due', 'q'),
+	('due_total', 'q'),
+]
+PAYMENT_COLUMNS = [
+	('transaction_date', 'i'),
+	('amount_paid', 'q'),
+	('paid_total', 'q'),
+]
+
+STATUSES = list(Policy.__table__.c.status.type.enums)
+SCHEDULES = list(Policy.__table__.c.billing_schedule.type.enums)
+
+# How often readers look for a newly published snapshot, in seconds
+CHECK_INTERVAL = 1.0
+
+def _align(offset):
+	return (offset + 7) & ~7
+
+def _layout(policies, invoices, payments):
+	"""
+	 Returns the offset of each column and of
+	 the policy numbers for the given counts.
+	"""
+	offsets = {}
+	offset = _align(HEADER.size)
+	for columns, count in ((POLICY_COLUMNS, policies),
+							(INVOICE_COLUMNS, invoices),
+							(PAYMENT_COLUMNS, payments)):
+		for name, code in columns:
+			offsets[name] = offset
+			offset = _align(offset + count * struct.calcsize('<' + code))
+	offsets['policy_number'] = offset
+	return offsets
+
+
+################################
+# Export
+################################
+def _read_shard(session):
+	"""
+	 Returns the policy, invoice and payment rows of a shard
+	 as plain tuples, sorted as the snapshot stores them.
+	"""
+	policies = Policy.__table__
+	invoices = Invoice.__table__
+	payments = Payment.__table__
+
+	policy_rows = session.execute(db.select([policies.c.id,
+											policies.c.version,
+											policies.c.effective_date,
+											policies.c.cancellation_date,
+											policies.c.status,
+											policies.c.billing_schedule,
+											policies.c.annual_premium,
+											policies.c.named_insured,
+											policies.c.agent,
+											policies.c.policy_number])
+		.order_by(policies.c.id)).fetchall()
+
+	invoice_rows = session.execute(db.select([invoices.c.policy_id,
+											invoices.c.bill_date,
+											invoices.c.due_date,
+											invoices.c.cancel_date,
+											invoices.c.amount_due])
+		.where(invoices.c.deleted == False)
+		.order_by(invoices.c.policy_id, invoices.c.bill_date, invoices.c.id)).fetchall()
+
+	payment_rows = session.execute(db.select([payments.c.policy_id,
+											payments.c.transaction_date,
+											payments.c.amount_paid])
+		.order_by(payments.c.policy_id, payments.c.transaction_date, payments.c.id)).fetchall()
+
+	return ([tuple(row) for row in policy_rows],
+			[tuple(row) for row in invoice_rows],
+			[tuple(row) for row in payment_rows])
+
+def _group(rows):
+	"""
+	 Groups (policy_id, ...) rows by policy id.
+	"""
+	groups = {}
+	for row in rows:
+		groups.setdefault(row[0], []).append(row[1:])
+	return groups
+
+def _ordinal(value):
+	return value.toordinal() if value else 0
+
+def write_snapshot(output, version=None):
+	"""
+	 Writes a snapshot of every shard to a file object.
+	 Returns its (version, policies, invoices, payments).
+	"""
+	shards = db.fan_out(_read_shard)
+
+	policy_rows = sorted(row for policy_rows, invoice_rows, payment_rows in shards
+						for row in policy_rows)
+	invoices = {}
+	payments = {}
+	for policy_rows, invoice_rows, payment_rows in shards:
+		invoices.update(_group(invoice_rows))
+		payments.update(_group(payment_rows))
+
+	columns = dict((name, []) for name, code in
+					POLICY_COLUMNS + INVOICE_COLUMNS + PAYMENT_COLUMNS)
+	text = []
+	text_size = 0
+	for (policy_id, policy_version, effective_date, cancellation_date, status,
+			billing_schedule, annual_premium, named_insured, agent, policy_number) in policy_rows:
+		columns['id'].append(policy_id)
+		columns['version'].append(policy_version)
+		columns['effective_date'].append(_ordinal(effective_date))
+		columns['cancellation_date'].append(_ordinal(cancellation_date))
+		columns['status'].append(STATUSES.index(status))
+		columns['billing_schedule'].append(SCHEDULES.index(billing_schedule))
+		columns['annual_premium'].append(annual_premium)
+		columns['named_insured'].append(named_insured or 0)
+		columns['agent'].append(agent or 0)
+
+		columns['invoices_start'].append(len(columns['bill_date']))
+		due_total = 0
+		for bill_date, due_date, cancel_date, amount_due in invoices.get(policy_id, []):
+			due_total += amount_due
+			columns['bill_date'].append(bill_date.toordinal())
+			columns['due_date'].append(due_date.toordinal())
+			columns['cancel_date'].append(cancel_date.toordinal())
+			columns['amount_due'].append(amount_due)
+			columns['due_total'].append(due_total)
+		columns['invoices_end'].append(len(columns['bill_date']))
+
+		columns['payments_start'].append(len(columns['transaction_date']))
+		paid_total = 0
+		for transaction_date, amount_paid in payments.get(policy_id, []):
+			paid_total += amount_paid
+			columns['transaction_date'].append(transaction_date.toordinal())
+			columns['amount_paid'].append(amount_paid)
+			columns['paid_total'].append(paid_total)
+		columns['payments_end'].append(len(columns['transaction_date']))
+
+		encoded = policy_number.encode('utf-8')
+		columns['policy_number_start'].append(text_size)
+		text.append(encoded)
+		text_size += len(encoded)
+		columns['policy_number_end'].append(text_size)
+
+	counts = (len(policy_rows), len(columns['bill_date']), len(columns['transaction_date']))
+	if version is None:
+		version = int(time.time() * 1000000)
+
+	output.write(HEADER.pack(MAGIC, FORMAT_VERSION, version, time.time(),
+								counts[0], counts[1], counts[2], text_size))
+
+	# Sections are zero-padded to their aligned offsets
+	offsets = _layout(*counts)
+	written = HEADER.size
+	for column_list in POLICY_COLUMNS, INVOICE_COLUMNS, PAYMENT_COLUMNS:
+		for name, code in column_list:
+			values = columns[name]
+			data = struct.pack('<%d%s' % (len(values), code), *values)
+			output.write('\0' * (offsets[name] - written) + data)
+			written = offsets[name] + len(data)
+	output.write('\0' * (offsets['policy_number'] - written) + ''.join(text))
+
+	return (version,) + counts
+
+def publish_snapshot(path, version=None):
+	"""
+	 Writes a new snapshot next to `path` and renames it
+	 over the current one, so readers never see a partial
+	 file. Returns the version and the row counts.
+	"""
+	path = os.path.abspath(path)
+	descriptor, temporary = tempfile.mkstemp(prefix='.snapshot-', dir=os.path.dirname(path))
+	try:
+		with os.fdopen(descriptor, 'wb') as output:
+			version, policies, invoices, payments = write_snapshot(output, version)
+			output.flush()
+			os.fsync(output.fileno())
+		os.chmod(temporary, 0644)
+		os.rename(temporary, path)
+	except:
+		os.unlink(temporary)
+		raise
+
+	return {
+		'version': version,
+		'policies': policies,
+		'invoices': invoices,
+		'payments': payments,
+		'bytes': os.path.getsize(path),
+	}
+
+
+################################
+# Reading
+################################
+class SnapshotError(Exception):
+	"""
+	 Raised when a file isn't a snapshot this code can read.
+	"""
+	pass
+
+
+class Column(object):
+	"""
+	 Read-only view of a column of the mapping. Values are
+	 unpacked on access, so slicing and bisecting copy nothing.
+	"""
+	def __init__(self, buffer, offset, code, start, stop):
+		self._buffer = buffer
+		self._struct = struct.Struct('<' + code)
+		self._offset = offset + start * self._struct.size
+		self._length = stop - start
+
+	def __len__(self):
+		return self._length
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			start, stop, step = index.indices(self._length)
+			return Column(self._buffer, self._offset, self._struct.format[1:],
+							start, max(start, stop))
+		if index < 0:
+			index += self._length
+		if not 0 <= index < self._length:
+			raise IndexError(index)
+		return self._struct.unpack_from(self._buffer, self._offset + index * self._struct.size)[0]
+
+	def __iter__(self):
+		for index in xrange(self._length):
+			yield self[index]
+
+
+class Snapshot(object):
+	"""
+	 A published snapshot, memory-mapped read-only.
+	 ledger(policy_id) gives the reads of a policy.
+	"""
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as snapshot_file:
+			self.identity = _identity(os.fstat(snapshot_file.fileno()))
+			try:
+				self._buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+			except (ValueError, mmap.error):
+				raise SnapshotError('%s is not a ledger snapshot!' % path)
+
+		if len(self._buffer) < HEADER.size:
+			raise SnapshotError('%s is not a ledger snapshot!' % path)
+		(magic, format_version, self.version, self.created_at, self.policy_count,
+			self.invoice_count, self.payment_count, text_size) = HEADER.unpack_from(self._buffer)
+		if magic != MAGIC:
+			raise SnapshotError('%s is not a ledger snapshot!' % path)
+		if format_version != FORMAT_VERSION:
+			raise SnapshotError('%s has format %d, expected %d!' % (
+				path, format_version, FORMAT_VERSION))
+
+		self._offsets = _layout(self.policy_count, self.invoice_count, self.payment_count)
+		if len(self._buffer) < self._offsets['policy_number'] + text_size:
+			raise SnapshotError('%s is truncated!' % path)
+
+		self.columns = {}
+		for column_list, count in ((POLICY_COLUMNS, self.policy_count),
+									(INVOICE_COLUMNS, self.invoice_count),
+									(PAYMENT_COLUMNS, self.payment_count)):
+			for name, code in column_list:
+				self.columns[name] = Column(self._buffer, self._offsets[name], code, 0, count)
+
+	def __len__(self):
+		return self.policy_count
+
+	def __contains__(self, policy_id):
+		return self._position(policy_id) is not None
+
+	@property
+	def policy_ids(self):
+		return self.columns['id']
+
+	def info(self):
+		return {
+			'path': self.path,
+			'version': self.version,
+			'created_at': self.created_at,
+			'policies': self.policy_count,
+			'invoices': self.invoice_count,
+			'payments': self.payment_count,
+			'bytes': len(self._buffer),
+		}
+
+	def text(self, start, end):
+		offset = self._offsets['policy_number']
+		return self._buffer[offset + start:offset + end].decode('utf-8')
+
+	def _position(self, policy_id):
+		ids = self.columns['id']
+		position = bisect_left(ids, int(policy_id))
+		if position < len(ids) and ids[position] == int(policy_id):
+			return position
+		return None
+
+	def ledger(self, policy_id):
+		"""
+		 Returns the policy's ledger as read from the
+		 mapping. Raises KeyError if it isn't in the snapshot.
+		"""
+		position = self._position(policy_id)
+		if position is None:
+			raise KeyError(policy_id)
+		return SnapshotLedger(self, position)
+
+
+class SnapshotLedger(object):
+	"""
+	 A policy's ledger in a snapshot, with the Ledger
+	 reads. The dates and amounts stay in the mapping,
+	 the totals are bisected in place.
+	"""
+	def __init__(self, snapshot, position):
+		self.snapshot = snapshot
+		self.position = position
+
+		columns = snapshot.columns
+		self.version = columns['version'][position]
+		self.invoices_range = (columns['invoices_start'][position],
+								columns['invoices_end'][position])
+		self.payments_range = (columns['payments_start'][position],
+								columns['payments_end'][position])
+
+	@property
+	def policy(self):
+		"""
+		 The policy fields, as in Ledger.policy.
+		"""
+		columns = self.snapshot.columns
+		value = lambda name: columns[name][self.position]
+		return {
+			'id': value('id'),
+			'version': value('version'),
+			'policy_number': self.snapshot.text(value('policy_number_start'),
+												value('policy_number_end')),
+			'effective_date': date.fromordinal(value('effective_date')),
+			'cancellation_date': date.fromordinal(value('cancellation_date'))
+									if value('cancellation_date') else None,
+			'status': STATUSES[value('status')],
+			'billing_schedule': SCHEDULES[value('billing_schedule')],
+			'annual_premium': value('annual_premium'),
+			'named_insured': value('named_insured') or None,
+			'agent': value('agent') or None,
+		}
+
+	@property
+	def invoices(self):
+		"""
+		 (bill_date, due_date, cancel_date, amount_due) sorted by bill date.
+		"""
+		columns = self.snapshot.columns
+		return [(date.fromordinal(columns['bill_date'][i]),
+				date.fromordinal(columns['due_date'][i]),
+				date.fromordinal(columns['cancel_date'][i]),
+				columns['amount_due'][i]) for i in xrange(*self.invoices_range)]
+
+	@property
+	def payments(self):
+		"""
+		 (transaction_date, amount_paid) sorted by transaction date.
+		"""
+		columns = self.snapshot.columns
+		return [(date.fromordinal(columns['transaction_date'][i]),
+				columns['amount_paid'][i]) for i in xrange(*self.payments_range)]
+
+	def _count(self, date_column, rows, date_cursor):
+		# Rows of the range dated by date_cursor
+		start, end = rows
+		return bisect_right(self.snapshot.columns[date_column][start:end], date_cursor.toordinal())
+
+	def due_amount(self, date_cursor):
+		"""
+		 Total of the invoices billed by date_cursor.
+		"""
+		count = self._count('bill_date', self.invoices_range, date_cursor)
+		return self.snapshot.columns['due_total'][self.invoices_range[0] + count - 1] if count else 0
+
+	def paid_amount(self, date_cursor):
+		"""
+		 Total of the payments made by date_cursor.
+		"""
+		count = self._count('transaction_date', self.payments_range, date_cursor)
+		return self.snapshot.columns['paid_total'][self.payments_range[0] + count - 1] if count else 0
+
+	def balance(self, date_cursor):
+		return self.due_amount(date_cursor) - self.paid_amount(date_cursor)
+
+	def aging(self, date_cursor):
+		"""
+		 Open amounts of the invoices billed by date_cursor,
+		 by days past their due date.
+		"""
+		columns = self.snapshot.columns
+		start = self.invoices_range[0]
+		billed = self._count('bill_date', self.invoices_range, date_cursor)
+		cursor = date_cursor.toordinal()
+		return aging([(cursor - columns['due_date'][i], columns['amount_due'][i])
+						for i in xrange(start, start + billed)],
+					self.paid_amount(date_cursor))
+
+
+def _identity(stat):
+	# A rename gives the path a new inode
+	return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+class SnapshotReader(object):
+	"""
+	 Follows the snapshot published at a path. current()
+	 returns the latest snapshot, re-mapping the file when
+	 a new one was renamed over it. Callers keep using the
+	 snapshot they got, the old mapping is released once
+	 nothing refers to it.
+	"""
+	def __init__(self, path, check_interval=CHECK_INTERVAL):
+		self.path = path
+		self.check_interval = check_interval
+
+		self._snapshot = None
+		self._checked = 0
+		self._lock = threading.Lock()
+
+	def current(self):
+		"""
+		 Returns the latest snapshot, or None if
+		 none was published yet.
+		"""
+		with self._lock:
+			if time.time() - self._checked >= self.check_interval:
+				self._checked = time.time()
+				try:
+					identity = _identity(os.stat(self.path))
+				except OSError:
+					self._snapshot = None
+				else:
+					if self._snapshot is None or self._snapshot.identity != identity:
+						self._snapshot = Snapshot(self.path)
+			return self._snapshot
+
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+def snapshot_path():
+	"""
+	 Returns the snapshot path of config.py.
+	"""
+	import config
+	return getattr(config, 'LEDGER_SNAPSHOT_PATH', None)
+
+def get_snapshot(path=None):
+	"""
+	 Returns the latest snapshot published at the path
+	 (config.py's by default) or None, through a reader
+	 shared by the whole process.
+	"""
+	path = os.path.abspath(path or snapshot_path())
+	with _readers_lock:
+		reader = _readers.get(path)
+		if reader is None:
+			reader = _readers[path] = SnapshotReader(path)
+	return reader.current()
@@ -0,0 +1,314 @@
+#!/user/bin/env python2.7
+
+import multiprocessing
+import os
+import tarfile
+import time
+from cStringIO import StringIO
+from datetime import datetime
+
+from jinja2 import Environment, FileSystemLoader
+
+from accounting import db
+from billing import contact_names
+from database import IN_CLAUSE_CHUNK
+from ledger import load_ledgers
+from models import Policy
+from utils import policy_dict
+
+"""
+#######################################################
+Statement run for the whole book.
+
+Renders a statement per policy, with the invoices,
+payments and amounts of generate_policy_dict, in HTML
+and plain text. Policies are split in chunks that a pool
+of processes renders: each chunk loads its ledgers with
+a few bulk queries per shard, and the templates are
+compiled once before the pool forks. Statements go to a
+directory, written by the workers, or to a .tar archive,
+written by the parent. A run skips the statements the
+output already has, so an interrupted run is resumed by
+running it again.
+#######################################################
+"""
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'statements')
+
+# Template and file extension of each format
+FORMATS = {
+	'html': ('statement.html', 'html'),
+	'text': ('statement.txt', 'txt'),
+}
+
+# Policies rendered per pool task
+CHUNK_SIZE = IN_CLAUSE_CHUNK
+
+_templates = None
+
+def get_templates():
+	"""
+	 Returns the compiled templates by format,
+	 compiling them on first use.
+	"""
+	global _templates
+	if _templates is None:
+		environment = Environment(loader=FileSystemLoader(TEMPLATES),
+									autoescape=lambda name: name.endswith('.html'))
+		_templates = dict((statement_format, environment.get_template(template))
+							for statement_format, (template, extension) in FORMATS.items())
+	return _templates
+
+def statement_name(policy_id, statement_format):
+	return 'policy-%d.%s' % (policy_id, FORMATS[statement_format][1])
+
+
+################################
+# Rendering
+################################
+def render_statements(policy_ids, date_cursor, formats):
+	"""
+	 Yields (file name, content) for each policy and format,
+	 loading the ledgers in bulk from their shards.
+	"""
+	templates = get_templates()
+
+	by_shard = {}
+	for policy_id in policy_ids:
+		by_shard.setdefault(db.shard_for(policy_id), []).append(policy_id)
+
+	ledgers = {}
+	for shard, shard_ids in sorted(by_shard.items()):
+		ledgers.update(load_ledgers(shard_ids, db.shard_session(shard)))
+
+	names = contact_names([contact_id for ledger in ledgers.values()
+							for contact_id in (ledger.policy['named_insured'], ledger.policy['agent'])])
+
+	for policy_id in policy_ids:
+		ledger = ledgers.get(policy_id)
+		if ledger is None:
+			continue
+
+		context = {
+			'policy': policy_dict(ledger, date_cursor),
+			'named_insured': names.get(ledger.policy['named_insured']),
+			'agent': names.get(ledger.policy['agent']),
+			'statement_date': str(date_cursor),
+		}
+		for statement_format in formats:
+			yield (statement_name(policy_id, statement_format),
+					templates[statement_format].render(context).encode('utf-8'))
+
+def _write_file(directory, name, content):
+	# Renamed into place, so a statement is either complete or missing
+	path = os.path.join(directory, name)
+	temporary = os.path.join(directory, '.%s.%d' % (name, os.getpid()))
+	with open(temporary, 'wb') as statement_file:
+		statement_file.write(content)
+	os.rename(temporary, path)
+
+def _render_chunk(task):
+	"""
+	 Pool task: renders a chunk of policies. Writes them to
+	 the directory, or returns them when there is none.
+	 Returns (policies, statements).
+	"""
+	policy_ids, date_cursor, formats, directory = task
+	try:
+		statements = []
+		for name, content in render_statements(policy_ids, date_cursor, formats):
+			if directory:
+				_write_file(directory, name, content)
+				statements.append((name, None))
+			else:
+				statements.append((name, content))
+		return len(policy_ids), statements
+	finally:
+		# Workers don't keep a read transaction between chunks
+		if _worker:
+			db.remove()
+
+_worker = False
+
+def _init_worker(database_uri, shard_uris):
+	global _worker
+	_worker = True
+	db.configure(database_uri, shard_uris)
+
+
+################################
+# Outputs
+################################
+class DirectoryOutput(object):
+	"""
+	 One file per statement, written by the workers.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.directory = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+	def existing(self):
+		return set(name for name in os.listdir(self.path) if not name.startswith('.'))
+
+	def add(self, statements):
+		# Already written by the workers
+		pass
+
+	def close(self):
+		pass
+
+
+def _complete_end(path):
+	"""
+	 Returns the offset after the last complete member of
+	 an archive, which may have been cut off by a kill.
+	"""
+	size = os.path.getsize(path)
+	end = 0
+	try:
+		archive = tarfile.open(path, 'r')
+	except tarfile.ReadError:
+		return end
+
+	try:
+		while True:
+			try:
+				member = archive.next()
+			except tarfile.ReadError:
+				break
+			if member is None:
+				break
+
+			blocks = (member.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+			member_end = member.offset_data + blocks * tarfile.BLOCKSIZE
+			if member_end > size:
+				break
+			end = member_end
+	finally:
+		archive.close()
+	return end
+
+def _repair_archive(path):
+	"""
+	 Drops what follows the last complete member and ends
+	 the archive there, so that it can be appended to.
+	"""
+	end = _complete_end(path)
+	with open(path, 'r+b') as archive_file:
+		archive_file.truncate(end)
+		archive_file.seek(end)
+		archive_file.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+
+
+class ArchiveOutput(object):
+	"""
+	 An uncompressed .tar, appended to by the parent so
+	 a resumed run adds the missing statements. The
+	 archive of a killed run is cut back to its last
+	 complete statement first.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.directory = None
+		if os.path.exists(path):
+			_repair_archive(path)
+		self.archive = tarfile.open(path, 'a')
+
+	def existing(self):
+		return set(self.archive.getnames())
+
+	def add(self, statements):
+		for name, content in statements:
+			info = tarfile.TarInfo(name)
+			info.size = len(content)
+			info.mtime = time.time()
+			self.archive.addfile(info, StringIO(content))
+		self.archive.fileobj.flush()
+
+	def close(self):
+		self.archive.close()
+
+
+def open_output(path):
+	"""
+	 Returns the output for a directory or a .tar file.
+	"""
+	if path.endswith('.tar'):
+		return ArchiveOutput(path)
+	if os.path.splitext(path)[1] in ('.gz', '.bz2', '.tgz', '.zip'):
+		raise ValueError('Statements can only be archived to an uncompressed .tar!')
+	return DirectoryOutput(path)
+
+
+################################
+# Run
+################################
+def statement_run(path, date_cursor=None, policy_ids=None, formats=('html', 'text'),
+					processes=None, progress=None, chunk_size=CHUNK_SIZE):
+	"""
+	 Renders the statements of the given policies (the whole
+	 book by default) into a directory or a .tar, with a pool
+	 of `processes` (one per CPU by default). Calls
+	 progress(done, total) after each chunk. Returns the
+	 rendered, skipped and total counts.
+	"""
+	if not date_cursor:
+		date_cursor = datetime.now().date()
+	for statement_format in formats:
+		if statement_format not in FORMATS:
+			raise ValueError('Unknown statement format %s!' % statement_format)
+
+	if policy_ids is None:
+		policy_ids = sorted(policy_id for shard_ids in db.fan_out(
+								lambda session: session.query(Policy.id).all())
+							for policy_id, in shard_ids)
+
+	output = open_output(path)
+	try:
+		# Resume: skip the policies with all their statements
+		existing = output.existing()
+		pending = [policy_id for policy_id in policy_ids
+					if any(statement_name(policy_id, statement_format) not in existing
+							for statement_format in formats)]
+
+		tasks = [(pending[i:i + chunk_size], date_cursor, tuple(formats), output.directory)
+					for i in range(0, len(pending), chunk_size)]
+
+		# Compiled before forking, so the workers inherit them
+		get_templates()
+
+		if processes == 1 or len(tasks) <= 1:
+			pool = None
+			results = (_render_chunk(task) for task in tasks)
+		else:
+			# Workers get their own connections
+			db.remove()
+			db.dispose()
+			pool = multiprocessing.Pool(processes, _init_worker, (db.uri, db.shard_uris))
+			results = pool.imap_unordered(_render_chunk, tasks)
+
+		done = 0
+		rendered = 0
+		try:
+			for policies, statements in results:
+				output.add(statements)
+				done += policies
+				rendered += len(statements)
+				if progress:
+					progress(done, len(pending))
+			if pool is not None:
+				pool.close()
+		finally:
+			if pool is not None:
+				pool.terminate()
+				pool.join()
+	finally:
+		output.close()
+
+	return {
+		'statements': rendered,
+		'skipped': len(policy_ids) - len(pending),
+		'policies': len(policy_ids),
+	}
@@ -1,12 +1,36 @@
 #!/user/bin/env python2.7
 
+import json
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import threading
 import unittest
-from datetime import date, datetime
+import zlib
+from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
-from accounting import db
-from models import Contact, Invoice, Payment, Policy
-from utils import PolicyAccounting
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm.exc import NoResultFound
+
+from accounting import create_app, db
+from models import Contact, IdempotencyKey, Invoice, Job, Payment, Policy
+from utils import IdempotencyConflict, PolicyAccounting, ReadOnlyError, insert_data, upgrade_db
+from onboarding import onboard_policies
+from payments import PaymentWriter
+import jobs
+import billing
+from billing import DATE_COLUMNS, billing_run, billing_run_query, contact_names
+from loadtest import parse_mix, summarize
+from sharding import allocate_policy_ids, reshard
+from ledger import LedgerCache, aging, get_ledger_cache, load_ledger, load_ledgers
+from wire import msgpack
+from queryplan import QueryRecorder, accept, audit, explain, normalize, regressions, scanned_table
+from snapshot import SnapshotError, SnapshotReader, get_snapshot, publish_snapshot
+from statements import ArchiveOutput, render_statements, statement_run
+from changes import changes_since
 
 """
 #######################################################
@@ -416,3 +440,1364 @@ class TestPolicyCancellation(unittest.TestCase):
 		cancellation = self.pa.cancel_policy("Cancellation Description", date_cursor)
 		self.assertTrue(cancellation)
 
+
+class TestReadOnlyPolicyAccounting(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.test_agent = Contact('Test Agent', 'Agent')
+		cls.test_insured = Contact('Test Insured', 'Named Insured')
+		db.session.add(cls.test_agent)
+		db.session.add(cls.test_insured)
+		db.session.commit()
+
+		cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+		cls.policy.named_insured = cls.test_insured.id
+		cls.policy.agent = cls.test_agent.id
+		cls.policy.billing_schedule = "Quarterly"
+		db.session.add(cls.policy)
+		db.session.commit()
+
+	@classmethod
+	def tearDownClass(cls):
+		db.session.delete(cls.test_insured)
+		db.session.delete(cls.test_agent)
+		db.session.delete(cls.policy)
+		db.session.commit()
+
+	def tearDown(self):
+		for invoice in self.policy.invoices:
+			db.session.delete(invoice)
+		db.session.commit()
+
+	def test_read_only_does_not_make_invoices(self):
+		pa = PolicyAccounting.for_reading(self.policy)
+		self.assertEquals(pa.return_account_balance(self.policy.effective_date), 0)
+		self.assertFalse(self.policy.invoices)
+
+	def test_read_only_uses_loaded_policy(self):
+		pa = PolicyAccounting.for_reading(self.policy)
+		self.assertTrue(pa.policy is self.policy)
+
+	def test_read_only_loads_policy_lazily(self):
+		pa = PolicyAccounting.for_reading(self.policy.id)
+		self.assertTrue(pa._policy is None)
+		self.assertEquals(pa.policy.id, self.policy.id)
+
+	def test_read_only_refuses_writes(self):
+		pa = PolicyAccounting.for_reading(self.policy)
+		self.assertRaises(ReadOnlyError, pa.make_payment, amount=100)
+		self.assertRaises(ReadOnlyError, pa.make_invoices)
+		self.assertRaises(ReadOnlyError, pa.change_schedule, "Monthly")
+		self.assertRaises(ReadOnlyError, pa.cancel_policy, "Description")
+
+	def test_explicit_write_path_makes_invoices(self):
+		pa = PolicyAccounting.for_reading(self.policy)
+		PolicyAccounting(self.policy.id)
+		self.assertEquals(pa.return_account_balance(self.policy.effective_date), 300)
+
+
+class TestBulkOnboarding(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.test_agent = Contact('Bulk Agent', 'Agent')
+		db.session.add(cls.test_agent)
+		db.session.commit()
+
+	@classmethod
+	def tearDownClass(cls):
+		db.session.delete(cls.test_agent)
+		db.session.commit()
+
+	def setUp(self):
+		self.records = [{
+			'policy_number': 'Bulk Policy %d' % i,
+			'effective_date': '2015-01-01',
+			'billing_schedule': schedule,
+			'annual_premium': 1200,
+			'named_insured': 'Bulk Insured',
+			'agent': 'Bulk Agent',
+		} for i, schedule in enumerate(['Annual', 'Quarterly', 'Monthly'])]
+
+	def tearDown(self):
+		for policy in Policy.query.filter(Policy.policy_number.like('Bulk Policy %')):
+			for invoice in policy.invoices:
+				db.session.delete(invoice)
+			db.session.delete(policy)
+		for contact in Contact.query.filter_by(name='Bulk Insured'):
+			db.session.delete(contact)
+		db.session.commit()
+
+	def test_onboarding_creates_policies_and_invoices(self):
+		result = onboard_policies(self.records)
+		self.assertEquals(len(result['policies']), 3)
+		self.assertEquals(result['invoices_created'], 17)
+
+		policy = Policy.query.filter_by(id=result['policies'][2]).one()
+		self.assertEquals(policy.policy_number, 'Bulk Policy 2')
+		self.assertEquals(len(policy.invoices), 12)
+
+	def test_onboarding_reuses_contacts(self):
+		result = onboard_policies(self.records)
+		self.assertEquals(result['contacts_created'], 1)
+
+		policies = Policy.query.filter(Policy.id.in_(result['policies'])).all()
+		self.assertEquals(set(policy.agent for policy in policies), set([self.test_agent.id]))
+		self.assertEquals(len(set(policy.named_insured for policy in policies)), 1)
+
+		# A second run doesn't create the contacts again
+		self.assertEquals(onboard_policies(self.records)['contacts_created'], 0)
+
+	def test_onboarding_rejects_bad_records(self):
+		self.records[1]['billing_schedule'] = 'Weekly'
+		self.assertRaises(ValueError, onboard_policies, self.records)
+		self.assertEquals(Policy.query.filter(Policy.policy_number.like('Bulk Policy %')).count(), 0)
+
+	def test_onboarding_rejects_missing_names(self):
+		for field, value in (('named_insured', None), ('policy_number', None),
+							('named_insured', ['Bulk Insured']), ('agent', '  ')):
+			records = [dict(record) for record in self.records]
+			records[1][field] = value
+			self.assertRaises(ValueError, onboard_policies, records)
+		self.assertEquals(Policy.query.filter(Policy.policy_number.like('Bulk Policy %')).count(), 0)
+
+	def test_concurrent_onboarding_shares_contacts(self):
+		# Another batch is about to create the named insured
+		other = sqlite3.connect(db.engine.url.database, isolation_level=None)
+		other.execute('BEGIN IMMEDIATE')
+
+		results = []
+		def onboard():
+			try:
+				results.append(onboard_policies(self.records))
+			finally:
+				db.remove()
+		thread = threading.Thread(target=onboard)
+		thread.start()
+		thread.join(0.2)
+
+		other.execute("INSERT INTO contacts (name, role) VALUES ('Bulk Insured', 'Named Insured')")
+		other.execute('COMMIT')
+		other.close()
+		thread.join()
+
+		self.assertEquals(results[0]['contacts_created'], 0)
+		self.assertEquals(Contact.query.filter_by(name='Bulk Insured').count(), 1)
+
+
+class TestPaymentWriter(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.test_agent = Contact('Test Agent', 'Agent')
+		cls.test_insured = Contact('Test Insured', 'Named Insured')
+		db.session.add(cls.test_agent)
+		db.session.add(cls.test_insured)
+		db.session.commit()
+
+		cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+		cls.policy.named_insured = cls.test_insured.id
+		cls.policy.agent = cls.test_agent.id
+		db.session.add(cls.policy)
+		db.session.commit()
+
+	@classmethod
+	def tearDownClass(cls):
+		db.session.delete(cls.test_insured)
+		db.session.delete(cls.test_agent)
+		db.session.delete(cls.policy)
+		db.session.commit()
+
+	def setUp(self):
+		self.writer = PaymentWriter(window=0.05).start()
+
+	def tearDown(self):
+		self.writer.stop()
+		for payment in Payment.query.filter_by(policy_id=self.policy.id):
+			db.session.delete(payment)
+		IdempotencyKey.query.filter(IdempotencyKey.key.like('test-%')).delete(synchronize_session=False)
+		db.session.commit()
+
+	def test_concurrent_payments_share_a_commit(self):
+		requests = [self.writer.submit(self.policy.id, amount=100,
+						transaction_date=date(2015, 2, 1)) for i in range(10)]
+		payment_ids = [request.wait(5) for request in requests]
+
+		self.assertEquals(len(set(payment_ids)), 10)
+		self.assertEquals(self.writer.stats['batches'], 1)
+		self.assertEquals(Payment.query.filter_by(policy_id=self.policy.id).count(), 10)
+
+	def test_payment_defaults_to_named_insured(self):
+		payment_id = self.writer.make_payment(self.policy.id, amount=100)
+		payment = Payment.query.filter_by(id=payment_id).one()
+		self.assertEquals(payment.contact_id, self.test_insured.id)
+
+	def test_retries_with_idempotency_key(self):
+		policy_id = self.policy.id
+		payment_ids = []
+		def pay():
+			payment_ids.append(self.writer.make_payment(policy_id, amount=100,
+										idempotency_key='test-payment-key'))
+		threads = [threading.Thread(target=pay) for i in range(5)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		pay()
+
+		self.assertEquals(len(set(payment_ids)), 1)
+		self.assertEquals(self.writer.stats['duplicates'], 5)
+		self.assertEquals(Payment.query.filter_by(policy_id=self.policy.id).count(), 1)
+
+	def test_bad_payment_only_fails_its_caller(self):
+		good = self.writer.submit(self.policy.id, amount=100)
+		bad = self.writer.submit(self.policy.id + 1000, amount=100)
+
+		self.assertTrue(good.wait(5))
+		self.assertRaises(ValueError, bad.wait, 5)
+
+	def test_make_payment_with_idempotency_key(self):
+		pa = PolicyAccounting(self.policy.id)
+		payment = pa.make_payment(amount=100, idempotency_key='test-make-payment-key')
+		retry = pa.make_payment(amount=100, idempotency_key='test-make-payment-key')
+		self.assertEquals(payment.id, retry.id)
+		self.assertRaises(IdempotencyConflict, pa.make_payment, amount=200,
+							idempotency_key='test-make-payment-key')
+
+		for invoice in self.policy.invoices:
+			db.session.delete(invoice)
+		db.session.commit()
+
+	def test_retry_gets_the_payment_already_made(self):
+		first = self.writer.submit(self.policy.id, amount=100, transaction_date=date(2015, 2, 1),
+									idempotency_key='test-retry-key')
+		first.wait(5)
+		retry = self.writer.submit(self.policy.id, amount=100, transaction_date=date(2015, 3, 1),
+									idempotency_key='test-retry-key')
+
+		self.assertEquals(retry.wait(5), first.payment_id)
+		self.assertTrue(retry.duplicate)
+		self.assertEquals(retry.transaction_date, date(2015, 2, 1))
+
+	def test_key_reused_for_another_payment(self):
+		self.writer.make_payment(self.policy.id, amount=100, idempotency_key='test-reused-key')
+
+		other_amount = self.writer.submit(self.policy.id, amount=200,
+											idempotency_key='test-reused-key')
+		other_policy = self.writer.submit(self.policy.id - 1, amount=100,
+											idempotency_key='test-reused-key')
+		self.assertRaises(IdempotencyConflict, other_amount.wait, 5)
+		self.assertRaises(IdempotencyConflict, other_policy.wait, 5)
+		self.assertEquals(Payment.query.filter_by(idempotency_key='test-reused-key').count(), 1)
+
+	def test_payment_endpoint_retries(self):
+		client = create_app().test_client()
+		path = '/api/policy/%d/payments' % self.policy.id
+		def pay(amount, payment_date):
+			response = client.post(path, data=json.dumps({'amount': amount, 'date': payment_date}),
+									content_type='application/json',
+									headers={'Idempotency-Key': 'test-endpoint-key'})
+			return response.status_code, json.loads(response.data)
+
+		status, first = pay(100, '2015-02-01')
+		self.assertEquals(status, 201)
+
+		status, retry = pay(100, '2015-03-01')
+		self.assertEquals(status, 200)
+		self.assertEquals(retry['payment']['id'], first['payment']['id'])
+		self.assertEquals(retry['payment']['transaction_date'], '2015-02-01')
+
+		status, conflict = pay(200, '2015-02-01')
+		self.assertEquals(status, 422)
+
+
+class TestJobQueue(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.test_agent = Contact('Test Agent', 'Agent')
+		cls.test_insured = Contact('Test Insured', 'Named Insured')
+		db.session.add(cls.test_agent)
+		db.session.add(cls.test_insured)
+		db.session.commit()
+
+		cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+		cls.policy.named_insured = cls.test_insured.id
+		cls.policy.agent = cls.test_agent.id
+		db.session.add(cls.policy)
+		db.session.commit()
+
+	@classmethod
+	def tearDownClass(cls):
+		db.session.delete(cls.test_insured)
+		db.session.delete(cls.test_agent)
+		db.session.delete(cls.policy)
+		db.session.commit()
+
+	def setUp(self):
+		self.policy.billing_schedule = "Quarterly"
+		self.pa = PolicyAccounting(self.policy.id)
+
+		self.job_ids = []
+
+		# Leave the existing jobs out of the way
+		Job.query.filter_by(status=u'Queued').update({'status': u'Failed'})
+		db.session.commit()
+
+	def tearDown(self):
+		for invoice in self.policy.invoices:
+			db.session.delete(invoice)
+		for job in Job.query.filter(Job.id.in_(self.job_ids)):
+			db.session.delete(job)
+		db.session.commit()
+
+	def enqueue(self, operation, arguments):
+		job_id = jobs.enqueue(operation, arguments)
+		self.job_ids.append(job_id)
+		return job_id
+
+	def work(self):
+		# Workers use their own session
+		worker = threading.Thread(target=jobs.work, args=('test-worker',),
+									kwargs={'once': True})
+		worker.start()
+		worker.join()
+
+	def test_job_runs_operation(self):
+		job_id = self.enqueue('change_schedule', {'policy_ids': [self.policy.id],
+												'billing_schedule': 'Monthly'})
+		self.work()
+
+		job = Job.query.filter_by(id=job_id).one()
+		self.assertEquals(job.status, u'Done')
+		self.assertEquals(job.progress, 100)
+		self.assertEquals(jobs.job_dict(job)['result'], {'changed': 1})
+
+		number_of_invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
+			.filter_by(deleted=False).count()
+		self.assertEquals(number_of_invoices, 12)
+
+	def test_failed_job_is_retried(self):
+		job_id = self.enqueue('make_invoices', {'policy_ids': [self.policy.id + 1000]})
+		self.work()
+
+		job = Job.query.filter_by(id=job_id).one()
+		self.assertEquals(job.status, u'Failed')
+		self.assertEquals(job.attempts, 3)
+		self.assertTrue(job.error)
+
+	def test_unknown_operation(self):
+		self.assertRaises(ValueError, jobs.enqueue, 'drop_database')
+
+	def test_bad_arguments_are_rejected(self):
+		for operation, arguments in (('change_schedule', {'foo': 1}),
+									('change_schedule', {'policy_ids': [self.policy.id]}),
+									('change_schedule', {'policy_ids': [self.policy.id],
+														'billing_schedule': 'Weekly'}),
+									('balance_report', {'date': '01/02/2015'})):
+			self.assertRaises(ValueError, jobs.enqueue, operation, arguments)
+
+		client = create_app().test_client()
+		response = client.post('/api/jobs', content_type='application/json',
+								data=json.dumps({'operation': 'change_schedule', 'arguments': {'foo': 1}}))
+		self.assertEquals(response.status_code, 400)
+
+		# The request removed the session
+		db.session.add(self.policy)
+
+	def test_lost_job_is_recovered(self):
+		job_id = self.enqueue('make_invoices', {'policy_ids': [self.policy.id]})
+		self.assertEquals(jobs.claim_job('test-worker'), job_id)
+
+		# The worker died and its lease expired
+		job = Job.query.filter_by(id=job_id).one()
+		job.lease_expires = datetime.now() - timedelta(seconds=1)
+		db.session.commit()
+
+		self.assertEquals(jobs.recover_jobs(), 1)
+		db.session.refresh(job)
+		self.assertEquals(job.status, u'Queued')
+
+		self.work()
+		db.session.refresh(job)
+		self.assertEquals(job.status, u'Done')
+		self.assertEquals(job.attempts, 2)
+
+	def test_concurrency_limit(self):
+		first = self.enqueue('balance_report', {'policy_ids': [self.policy.id]})
+		second = self.enqueue('balance_report', {'policy_ids': [self.policy.id]})
+
+		self.assertEquals(jobs.claim_job('test-worker'), first)
+		self.assertEquals(jobs.claim_job('test-worker-2'), None)
+
+	def take_over(self, job_id, worker):
+		# The lease expired and another worker claimed the job
+		job = Job.query.filter_by(id=job_id).one()
+		job.worker = worker
+		job.attempts += 1
+		db.session.commit()
+		return job
+
+	def test_progress_after_takeover_raises(self):
+		job_id = self.enqueue('make_invoices', {'policy_ids': [self.policy.id]})
+		self.assertEquals(jobs.claim_job('test-worker'), job_id)
+		job = self.take_over(job_id, 'test-worker-2')
+
+		context = jobs.JobContext(job_id, 'test-worker')
+		self.assertRaises(jobs.LeaseLost, context.progress, 1, 2)
+		db.session.refresh(job)
+		self.assertEquals(job.progress, 0)
+
+		jobs.JobContext(job_id, 'test-worker-2').progress(1, 2)
+		db.session.refresh(job)
+		self.assertEquals(job.progress, 50)
+
+	def test_late_worker_does_not_finish_job(self):
+		job_id = self.enqueue('change_schedule', {'policy_ids': [self.policy.id],
+												'billing_schedule': 'Monthly'})
+		self.assertEquals(jobs.claim_job('test-worker'), job_id)
+		job = self.take_over(job_id, 'test-worker-2')
+
+		self.assertFalse(jobs.run_job(job_id, 'test-worker'))
+		db.session.refresh(job)
+		self.assertEquals(job.status, u'Running')
+		self.assertEquals(job.worker, 'test-worker-2')
+		self.assertEquals(job.result, None)
+
+		self.assertTrue(jobs.run_job(job_id, 'test-worker-2'))
+		db.session.refresh(job)
+		self.assertEquals(job.status, u'Done')
+
+
+class TestBillingRun(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.test_agent = Contact('Test Agent', 'Agent')
+		cls.test_insured = Contact('Test Insured', 'Named Insured')
+		db.session.add(cls.test_agent)
+		db.session.add(cls.test_insured)
+		db.session.commit()
+
+		cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+		cls.policy.named_insured = cls.test_insured.id
+		cls.policy.agent = cls.test_agent.id
+		db.session.add(cls.policy)
+		db.session.commit()
+
+	@classmethod
+	def tearDownClass(cls):
+		db.session.delete(cls.test_insured)
+		db.session.delete(cls.test_agent)
+		db.session.delete(cls.policy)
+		db.session.commit()
+
+	def setUp(self):
+		self.policy.billing_schedule = "Monthly"
+		self.pa = PolicyAccounting(self.policy.id)
+
+	def tearDown(self):
+		for invoice in self.policy.invoices:
+			db.session.delete(invoice)
+		db.session.commit()
+
+	def run_for_policy(self, start_date, end_date):
+		return [invoice for invoice in billing_run(start_date, end_date)
+				if invoice['policy']['id'] == self.policy.id]
+
+	def test_invoices_billed_and_due(self):
+		invoices = self.run_for_policy(date(2015, 2, 1), date(2015, 2, 1))
+
+		self.assertEquals(len(invoices), 2)
+		events = dict((invoice['bill_date'], invoice['events']) for invoice in invoices)
+		self.assertEquals(events['2015-01-01'], ['due'])
+		self.assertEquals(events['2015-02-01'], ['billed'])
+		self.assertEquals(invoices[0]['policy']['named_insured_name'], 'Test Insured')
+
+	def test_invoices_hitting_cancel(self):
+		invoices = self.run_for_policy(date(2015, 2, 15), date(2015, 2, 15))
+
+		self.assertEquals(len(invoices), 1)
+		self.assertEquals(invoices[0]['events'], ['cancel'])
+
+	def test_deleted_invoices_are_skipped(self):
+		self.pa.change_schedule("Annual")
+		invoices = self.run_for_policy(date(2015, 1, 1), date(2015, 12, 31))
+
+		self.assertEquals(len(invoices), 1)
+		self.assertEquals(invoices[0]['amount_due'], 1200)
+
+	def test_window_uses_the_date_indexes(self):
+		connection = db.engine.raw_connection()
+		for column in DATE_COLUMNS:
+			for after in (None, (date(2015, 2, 15), self.policy.id)):
+				query = billing_run_query(date(2015, 2, 1), date(2015, 2, 28), column, after)
+				compiled = query.compile(bind=db.engine)
+				params = [compiled.params[name] for name in compiled.positiontup]
+
+				details = explain(connection, unicode(compiled), params)
+				plan = ' '.join(details)
+
+				scanned = [scanned_table(detail) for detail in details]
+				self.assertFalse('invoices' in scanned, plan)
+				self.assertFalse('TEMP B-TREE' in plan, plan)
+				self.assertTrue('ix_invoices_%s' % column in plan, plan)
+		connection.close()
+
+	def test_contact_names(self):
+		names = contact_names([self.test_agent.id, self.test_insured.id, None])
+		self.assertEquals(names, {self.test_agent.id: 'Test Agent',
+								self.test_insured.id: 'Test Insured'})
+
+		# Known names aren't read again
+		names = contact_names([self.test_agent.id], {self.test_agent.id: 'Cached'})
+		self.assertEquals(names, {self.test_agent.id: 'Cached'})
+
+	def test_paused_feed_does_not_block_writers(self):
+		fetch_size = billing.FETCH_SIZE
+		billing.FETCH_SIZE = 2
+		try:
+			feed = billing_run(date(2015, 1, 1), date(2015, 12, 31))
+			first = next(feed)
+
+			# A writer with no busy timeout, while the client is between pages
+			path = db.shard_engine(db.shard_for(self.policy.id)).url.database
+			writer = sqlite3.connect(path, timeout=0)
+			try:
+				writer.execute('UPDATE invoices SET amount_due = amount_due WHERE policy_id = ?',
+								(self.policy.id,))
+				writer.commit()
+			finally:
+				writer.close()
+
+			invoices = [first] + list(feed)
+		finally:
+			billing.FETCH_SIZE = fetch_size
+
+		ids = [invoice['invoice_id'] for invoice in invoices
+				if invoice['policy']['id'] == self.policy.id]
+		self.assertEquals(len(ids), 12)
+		self.assertEquals(len(set(ids)), 12)
+
+
+class TestUpgrade(unittest.TestCase):
+
+	# The schema and data of a database made before the upgrade
+	OLD_DATABASE = """
+		CREATE TABLE contacts (id INTEGER NOT NULL, name VARCHAR(128) NOT NULL,
+			role VARCHAR(13) NOT NULL, PRIMARY KEY (id));
+		CREATE TABLE policies (id INTEGER NOT NULL, policy_number VARCHAR(128) NOT NULL,
+			effective_date DATE NOT NULL, status VARCHAR(8) NOT NULL,
+			billing_schedule VARCHAR(9) NOT NULL, annual_premium INTEGER NOT NULL,
+			named_insured INTEGER, agent INTEGER, cancellation_date DATE,
+			cancellation_description VARCHAR(128), PRIMARY KEY (id));
+		CREATE TABLE invoices (id INTEGER NOT NULL, policy_id INTEGER NOT NULL,
+			bill_date DATE NOT NULL, due_date DATE NOT NULL, cancel_date DATE NOT NULL,
+			amount_due INTEGER NOT NULL, deleted BOOLEAN DEFAULT '0' NOT NULL, PRIMARY KEY (id));
+		CREATE TABLE payments (id INTEGER NOT NULL, policy_id INTEGER NOT NULL,
+			contact_id INTEGER NOT NULL, amount_paid INTEGER NOT NULL,
+			transaction_date DATE NOT NULL, PRIMARY KEY (id));
+
+		INSERT INTO contacts VALUES (1, 'Old Insured', 'Named Insured');
+		INSERT INTO policies VALUES (1, 'Old Policy', '2015-01-01', 'Active', 'Annual', 1200,
+			1, NULL, NULL, NULL);
+		INSERT INTO invoices VALUES (1, 1, '2015-01-01', '2015-02-01', '2015-02-15', 1200, 0);
+		INSERT INTO payments VALUES (1, 1, 1, 200, '2015-01-15');
+	"""
+
+	def setUp(self):
+		self.database = (db.uri, db.shard_uris)
+		self.directory = tempfile.mkdtemp()
+		path = os.path.join(self.directory, 'old.sqlite')
+
+		connection = sqlite3.connect(path)
+		connection.executescript(self.OLD_DATABASE)
+		connection.close()
+
+		db.configure('sqlite:///' + path)
+
+	def tearDown(self):
+		db.configure(*self.database)
+		shutil.rmtree(self.directory)
+
+	def test_upgrade_keeps_the_data(self):
+		created = upgrade_db()
+		self.assertEquals(sorted(created[0]), ['changes', 'idempotency_keys', 'jobs', 'sequences'])
+
+		self.assertEquals(PolicyAccounting(1).return_account_balance(date(2015, 2, 1)), 1000)
+		changes = changes_since()
+		self.assertEquals(changes['count'], 3)
+
+		indexes = [row[0] for row in db.session.execute(
+			"SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'payments'")]
+		self.assertEquals(sorted(indexes), ['ix_payments_policy_id_transaction_date',
+											'uq_payments_idempotency_key'])
+
+		# A second run has nothing to do
+		self.assertEquals(upgrade_db(), {0: []})
+		self.assertEquals(changes_since()['count'], 3)
+
+
+class TestLoadTestReport(unittest.TestCase):
+
+	def test_summarize_latencies(self):
+		samples = [(float(latency), latency != 100) for latency in range(1, 101)]
+		report = summarize(samples, 2.0)
+
+		self.assertEquals(report['requests'], 100)
+		self.assertEquals(report['errors'], 1)
+		self.assertEquals(report['throughput'], 50.0)
+		self.assertEquals(report['latency_ms']['p50'], 51.0)
+		self.assertEquals(report['latency_ms']['p99'], 99.0)
+		self.assertEquals(sum(count for bucket, count in report['histogram_ms']), 100)
+		self.assertEquals(report['histogram_ms'][2], [5, 3])
+
+	def test_parse_mix(self):
+		self.assertEquals(parse_mix('policy=8,payment=2'), {'policy': 8.0, 'payment': 2.0})
+		self.assertRaises(ValueError, parse_mix, 'delete=1')
+
+
+class TestSharding(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.database = (db.uri, db.shard_uris)
+		cls.directory = tempfile.mkdtemp()
+		cls.main_uri = 'sqlite:///' + os.path.join(cls.directory, 'main.sqlite')
+		cls.shard_uris = ['sqlite:///' + os.path.join(cls.directory, 'shard%d.sqlite' % shard)
+							for shard in range(3)]
+
+		db.configure(cls.main_uri, cls.shard_uris)
+		db.create_all()
+		insert_data()
+
+	@classmethod
+	def tearDownClass(cls):
+		db.configure(*cls.database)
+		shutil.rmtree(cls.directory)
+
+	def shard_policy_ids(self, shard):
+		return [policy_id for policy_id, in db.shard_session(shard).query(Policy.id)]
+
+	def test_policies_are_routed_by_id(self):
+		self.assertTrue(db.sharded)
+		self.assertEquals(self.shard_policy_ids(0), [3])
+		self.assertEquals(self.shard_policy_ids(1), [1, 4])
+		self.assertEquals(self.shard_policy_ids(2), [2])
+
+		# Contacts stay in the main database
+		self.assertEquals(Contact.query.filter_by(name='Anna White').count(), 1)
+		self.assertFalse('contacts' in db.shard_engine(0).table_names())
+
+	def test_policy_accounting_uses_the_policy_shard(self):
+		pa = PolicyAccounting(2)
+		self.assertEquals(pa.return_account_balance(date(2015, 2, 1)), 0)
+
+		payment = pa.make_payment(amount=400, date_cursor=date(2015, 5, 1))
+		self.assertEquals(pa.return_account_balance(date(2015, 5, 1)), 0)
+		self.assertEquals(db.shard_session(2).query(Payment).filter_by(id=payment.id).count(), 1)
+		self.assertEquals(db.shard_session(1).query(Payment).count(), 0)
+
+		db.shard_session(2).delete(payment)
+		db.shard_session(2).commit()
+
+	def test_idempotency_keys_hold_across_shards(self):
+		writer = PaymentWriter().start()
+		try:
+			writer.make_payment(1, amount=100, idempotency_key='test-shards-key')
+			other_shard = writer.submit(2, amount=100, idempotency_key='test-shards-key')
+			self.assertRaises(IdempotencyConflict, other_shard.wait, 5)
+			self.assertRaises(IdempotencyConflict, PolicyAccounting(3).make_payment, amount=100,
+								idempotency_key='test-shards-key')
+
+			paid = [db.shard_session(shard).query(Payment)
+						.filter_by(idempotency_key='test-shards-key').count()
+					for shard in range(db.shards)]
+			self.assertEquals(paid, [0, 1, 0])
+		finally:
+			writer.stop()
+			for shard in range(db.shards):
+				db.shard_session(shard).query(Payment)\
+					.filter_by(idempotency_key='test-shards-key').delete()
+				db.shard_session(shard).commit()
+
+	def test_onboarding_allocates_ids_across_shards(self):
+		result = onboard_policies([{
+			'policy_number': 'Sharded Policy %d' % i,
+			'effective_date': '2015-01-01',
+			'billing_schedule': 'Quarterly',
+			'annual_premium': 1200,
+			'named_insured': 'Sharded Insured',
+			'agent': 'Sharded Agent',
+		} for i in range(6)])
+
+		self.assertEquals(len(set(result['policies'])), 6)
+		for policy_id in result['policies']:
+			invoices = db.session_for(policy_id).query(Invoice).filter_by(policy_id=policy_id)
+			self.assertEquals(invoices.count(), 4)
+
+		for policy_id in result['policies']:
+			session = db.session_for(policy_id)
+			session.query(Invoice).filter_by(policy_id=policy_id).delete()
+			session.query(Policy).filter_by(id=policy_id).delete()
+			session.commit()
+
+	def test_payment_writer_commits_per_shard(self):
+		writer = PaymentWriter(window=0.05).start()
+		try:
+			requests = [writer.submit(policy_id, amount=10, transaction_date=date(2015, 3, 1))
+						for policy_id in (1, 2, 3, 4)]
+			for request in requests:
+				request.wait(5)
+		finally:
+			writer.stop()
+
+		self.assertEquals(writer.stats['batches'], 3)
+		for request in requests:
+			session = db.session_for(request.policy_id)
+			session.query(Payment).filter_by(id=request.payment_id).delete()
+			session.commit()
+
+	def test_change_feed_has_a_cursor_per_shard(self):
+		page = changes_since(limit=2)
+		self.assertEquals(page['count'], 2)
+		self.assertEquals(len(page['cursor'].split('.')), 3)
+
+		# The page is shared between the shards
+		self.assertEquals(len([seq for seq in page['cursor'].split('.') if seq != '0']), 2)
+
+		policy_ids = set()
+		while True:
+			policy_ids.update(policy['id'] for policy in page['changes']['policies'])
+			if not page['more']:
+				break
+			page = changes_since(page['cursor'], limit=2)
+		self.assertEquals(policy_ids, set([1, 2, 3, 4]))
+
+		self.assertRaises(ValueError, changes_since, '5')
+
+	def test_list_fans_out(self):
+		client = create_app({'SQLALCHEMY_DATABASE_URI': self.main_uri,
+							'SHARD_DATABASE_URIS': self.shard_uris}).test_client()
+		policies = json.loads(client.get('/api/policies').data)['policies']
+
+		self.assertEquals([policy['id'] for policy in policies], [1, 2, 3, 4])
+		self.assertEquals(policies[1]['named_insured'], 'Anna White')
+
+	def test_billing_run_fans_out(self):
+		invoices = list(billing_run(date(2015, 2, 1), date(2015, 2, 1)))
+
+		self.assertEquals(set(invoice['policy']['id'] for invoice in invoices), set([1, 2, 3, 4]))
+		names = dict((invoice['policy']['id'], invoice['policy']['named_insured_name'])
+					for invoice in invoices)
+		self.assertEquals(names[2], 'Anna White')
+
+	def test_reshard(self):
+		uris = ['sqlite:///' + os.path.join(self.directory, 'new%d.sqlite' % shard)
+				for shard in range(2)]
+		result = reshard(uris)
+		self.assertEquals(result['policies'], 4)
+		self.assertEquals(result['payments'], 1)
+
+		for shard, uri in enumerate(uris):
+			engine = create_engine(uri)
+			policy_ids = [policy_id for policy_id, in engine.execute('SELECT id FROM policies')]
+			self.assertEquals(sorted(policy_ids), [policy_id for policy_id in (1, 2, 3, 4)
+													if policy_id % 2 == shard])
+			engine.dispose()
+
+		# The new shards' feeds start with every copied row
+		engine = create_engine(uris[0])
+		self.assertEquals(engine.execute('SELECT COUNT(*) FROM changes').scalar(),
+							sum(engine.execute('SELECT COUNT(*) FROM %s' % table).scalar()
+								for table in ('policies', 'invoices', 'payments')))
+		engine.dispose()
+
+		self.assertRaises(ValueError, reshard, uris)
+		self.assertEquals(allocate_policy_ids(1), [5])
+
+
+class TestLedgerCache(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.test_agent = Contact('Test Agent', 'Agent')
+		cls.test_insured = Contact('Test Insured', 'Named Insured')
+		db.session.add(cls.test_agent)
+		db.session.add(cls.test_insured)
+		db.session.commit()
+
+		cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+		cls.policy.named_insured = cls.test_insured.id
+		cls.policy.agent = cls.test_agent.id
+		cls.policy.billing_schedule = "Quarterly"
+		db.session.add(cls.policy)
+		db.session.commit()
+
+		# Engine listeners can't be removed, so it only records while needed
+		cls.recording = []
+		def record(conn, cursor, statement, parameters, context, executemany):
+			for statements in cls.recording:
+				statements.append(statement)
+		event.listen(db.engine, 'before_cursor_execute', record)
+
+	@classmethod
+	def tearDownClass(cls):
+		db.session.delete(cls.test_insured)
+		db.session.delete(cls.test_agent)
+		db.session.delete(cls.policy)
+		db.session.commit()
+
+	def setUp(self):
+		self.pa = PolicyAccounting(self.policy.id)
+		self.cache = get_ledger_cache()
+
+	def tearDown(self):
+		for invoice in self.policy.invoices:
+			db.session.delete(invoice)
+		for payment in Payment.query.filter_by(policy_id=self.policy.id):
+			db.session.delete(payment)
+		db.session.commit()
+
+	def count_statements(self, function):
+		statements = []
+		self.recording.append(statements)
+		try:
+			function()
+		finally:
+			self.recording.remove(statements)
+		return statements
+
+	def test_hit_only_checks_the_version(self):
+		pa = PolicyAccounting.for_reading(self.policy.id)
+		pa.return_account_balance(date(2015, 4, 1))
+		hits = self.cache.stats['hits']
+
+		statements = self.count_statements(
+			lambda: pa.generate_policy_dict(date(2015, 7, 1)))
+
+		self.assertEquals(self.cache.stats['hits'], hits + 1)
+		self.assertEquals(len(statements), 1)
+		self.assertTrue('version' in statements[0])
+
+	def test_writes_change_the_version(self):
+		self.assertEquals(self.pa.return_account_balance(date(2015, 4, 1)), 600)
+
+		self.pa.make_payment(amount=300, date_cursor=date(2015, 2, 1))
+		self.assertEquals(self.pa.return_account_balance(date(2015, 4, 1)), 300)
+
+		self.pa.change_schedule("Annual")
+		self.assertEquals(self.pa.return_account_balance(date(2015, 4, 1)), 900)
+
+	def test_payment_writer_changes_the_version(self):
+		self.assertEquals(self.pa.return_account_balance(date(2015, 4, 1)), 600)
+
+		writer = PaymentWriter(window=0.01).start()
+		try:
+			writer.make_payment(self.policy.id, amount=600, transaction_date=date(2015, 3, 1))
+		finally:
+			writer.stop()
+
+		self.assertEquals(self.pa.return_account_balance(date(2015, 4, 1)), 0)
+
+	def test_least_recently_used_are_evicted(self):
+		cache = LedgerCache(max_rows=6)
+		cache.get(self.policy.id, db.session)
+		self.assertEquals(cache.info()['rows'], 5)
+
+		# The policy doesn't fit twice
+		cache.get(1, db.session)
+		self.assertEquals(cache.stats['evictions'], 1)
+		self.assertEquals(cache.info()['entries'], 1)
+		self.assertRaises(NoResultFound, cache.get, self.policy.id + 1000, db.session)
+
+
+class TestWireFormats(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.test_agent = Contact('Test Agent', 'Agent')
+		cls.test_insured = Contact('Test Insured', 'Named Insured')
+		db.session.add(cls.test_agent)
+		db.session.add(cls.test_insured)
+		db.session.commit()
+
+		cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+		cls.policy.named_insured = cls.test_insured.id
+		cls.policy.agent = cls.test_agent.id
+		cls.policy.billing_schedule = "Monthly"
+		db.session.add(cls.policy)
+		db.session.commit()
+
+		PolicyAccounting(cls.policy.id).make_payment(amount=100, date_cursor=date(2015, 1, 15))
+		cls.path = '/api/policy/%d?date=2015-03-01' % cls.policy.id
+
+		# Requests remove the session, so only the ids are kept
+		cls.ids = (cls.policy.id, cls.test_agent.id, cls.test_insured.id)
+		cls.client = create_app().test_client()
+
+	@classmethod
+	def tearDownClass(cls):
+		policy_id, agent_id, insured_id = cls.ids
+		Invoice.query.filter_by(policy_id=policy_id).delete()
+		Payment.query.filter_by(policy_id=policy_id).delete()
+		Policy.query.filter_by(id=policy_id).delete()
+		Contact.query.filter(Contact.id.in_([agent_id, insured_id])).delete(synchronize_session=False)
+		db.session.commit()
+
+	def get(self, path, **headers):
+		return self.client.get(path, headers=headers)
+
+	def test_default_is_jsonify_output(self):
+		response = self.get(self.path)
+		self.assertEquals(response.headers['Content-Type'], 'application/json')
+		self.assertTrue('\n  ' in response.data)
+
+		policy = json.loads(response.data)['policy']
+		self.assertEquals(policy['invoices'][0]['bill_date'], '2015-01-01')
+		self.assertEquals(policy['necessary_amount'], 200)
+
+	def test_compact_json_has_the_same_values(self):
+		expected = json.loads(self.get(self.path).data)['policy']
+		response = self.get(self.path, Accept='application/vnd.accounting.compact+json')
+		self.assertEquals(response.headers['Content-Type'], 'application/vnd.accounting.compact+json')
+		self.assertFalse(': ' in response.data)
+
+		policy = json.loads(response.data)['policy']
+		invoices = [dict(zip(policy['invoices']['columns'], row)) for row in policy['invoices']['rows']]
+		payments = [dict(zip(policy['payments']['columns'], row)) for row in policy['payments']['rows']]
+		self.assertEquals(invoices, expected['invoices'])
+		self.assertEquals(payments, expected['payments'])
+		for key in ('id', 'effective_date', 'due_amount', 'payed_amount', 'necessary_amount'):
+			self.assertEquals(policy[key], expected[key])
+
+	@unittest.skipIf(msgpack is None, 'msgpack is not installed')
+	def test_msgpack(self):
+		expected = json.loads(self.get(self.path + '&format=compact').data)
+		response = self.get(self.path, Accept='application/x-msgpack')
+		self.assertEquals(response.headers['Content-Type'], 'application/x-msgpack')
+		self.assertEquals(msgpack.unpackb(response.data, raw=False), expected)
+
+	def test_compression(self):
+		expected = self.get(self.path).data
+
+		response = self.get(self.path, **{'Accept-Encoding': 'gzip'})
+		self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+		self.assertEquals(zlib.decompress(response.data, 16 + zlib.MAX_WBITS), expected)
+
+		response = self.get(self.path, **{'Accept-Encoding': 'deflate'})
+		self.assertEquals(response.headers['Content-Encoding'], 'deflate')
+		self.assertEquals(zlib.decompress(response.data), expected)
+
+	def test_policies_list_formats(self):
+		expected = json.loads(self.get('/api/policies').data)['policies']
+		policies = json.loads(self.get('/api/policies?format=compact').data)['policies']
+		self.assertEquals([dict(zip(policies['columns'], row)) for row in policies['rows']], expected)
+
+		self.assertEquals(self.get('/api/policies?format=xml').status_code, 406)
+
+
+class TestQueryPlanAudit(unittest.TestCase):
+
+	def setUp(self):
+		self.recorder = QueryRecorder()
+
+	def tearDown(self):
+		self.recorder.stop()
+
+	def test_recorder_keeps_distinct_statements(self):
+		self.recorder.start()
+		for policy_id in (1, 2, 3):
+			PolicyAccounting.for_reading(policy_id).return_account_balance(date(2015, 6, 1))
+		self.recorder.stop()
+		PolicyAccounting.for_reading(4).return_account_balance(date(2015, 6, 1))
+
+		versions = [entry for key, entry in self.recorder.statements.items()
+					if key.startswith('SELECT policies.version ')]
+		self.assertEquals(len(versions), 1)
+		self.assertEquals(versions[0]['executions'], 3)
+
+	def test_in_lists_are_normalized(self):
+		self.assertEquals(normalize('SELECT id FROM policies\nWHERE id IN (?, ?, ?)'),
+							'SELECT id FROM policies WHERE id IN (?...)')
+
+	def test_ledger_queries_use_the_indexes(self):
+		self.recorder.start()
+		get_ledger_cache().clear()
+		PolicyAccounting.for_reading(2).return_account_balance(date(2015, 6, 1))
+		self.recorder.stop()
+
+		report = audit(self.recorder.statements, db.uri, hot_executions=1)
+		for result in report['statements']:
+			self.assertEquals(result['findings'], [], result)
+
+	def test_scans_and_temp_btrees_are_flagged(self):
+		statement = 'SELECT id FROM payments WHERE amount_paid = ? ORDER BY transaction_date'
+		statements = {statement: {'statement': statement, 'parameters': [100], 'executions': 20}}
+
+		report = audit(statements, db.uri)
+		self.assertEquals(report['statements'][0]['findings'],
+							['scan payments', 'temp b-tree for order by'])
+		self.assertTrue('ix_invoices_bill_date' in report['unused_indexes'])
+
+		found = regressions(report)
+		self.assertEquals(len(found), 2)
+		self.assertEquals(regressions(report, found), [])
+
+	def test_scanned_tables(self):
+		self.assertEquals(scanned_table('SCAN invoices'), 'invoices')
+		self.assertEquals(scanned_table('SCAN TABLE invoices'), 'invoices')
+		self.assertEquals(scanned_table('SCAN CONSTANT ROW'), None)
+		self.assertEquals(scanned_table('SEARCH invoices USING INDEX ix_invoices_bill_date (bill_date>?)'),
+							None)
+
+	def test_accept_into_existing_baseline(self):
+		statement = 'SELECT id FROM payments WHERE amount_paid = ? ORDER BY transaction_date'
+		statements = {statement: {'statement': statement, 'parameters': [100], 'executions': 20}}
+		report = audit(statements, db.uri)
+
+		# As read back from the baseline file
+		baseline = json.loads(json.dumps([['SELECT id FROM contacts', 'scan contacts'],
+											[statement, 'scan payments']]))
+		accepted = json.loads(json.dumps(accept(report, baseline)))
+
+		self.assertEquals(accepted, [['SELECT id FROM contacts', 'scan contacts'],
+									[statement, 'scan payments'],
+									[statement, 'temp b-tree for order by']])
+		self.assertEquals(regressions(report, accepted), [])
+
+
+class TestLedgerSnapshot(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'ledger.snapshot')
+		self.job_ids = []
+
+	def tearDown(self):
+		for payment in Payment.query.filter_by(policy_id=2):
+			db.session.delete(payment)
+		for job_id in self.job_ids:
+			db.session.delete(Job.query.filter_by(id=job_id).one())
+		db.session.commit()
+		shutil.rmtree(self.directory)
+
+	def test_snapshot_matches_the_ledgers(self):
+		PolicyAccounting(2).make_payment(amount=150, date_cursor=date(2015, 3, 1))
+		result = publish_snapshot(self.path)
+		snapshot = SnapshotReader(self.path).current()
+
+		self.assertEquals(snapshot.version, result['version'])
+		self.assertEquals(len(snapshot), result['policies'])
+		for policy_id in snapshot.policy_ids:
+			ledger = snapshot.ledger(policy_id)
+			live = PolicyAccounting.for_reading(policy_id).ledger
+
+			for key, value in ledger.policy.items():
+				self.assertEquals(value, live.policy[key])
+			self.assertEquals(ledger.invoices, live.invoices)
+			self.assertEquals(ledger.payments, live.payments)
+			for month in range(1, 13):
+				date_cursor = date(2015, month, 15)
+				self.assertEquals(ledger.balance(date_cursor), live.balance(date_cursor))
+				self.assertEquals(ledger.aging(date_cursor), live.aging(date_cursor))
+
+		self.assertRaises(KeyError, snapshot.ledger, 1000)
+
+	def test_aging_applies_payments_oldest_first(self):
+		buckets = aging([(100, 100), (45, 100), (10, 100), (-5, 100)], 150)
+		self.assertEquals(buckets.items(), [('current', 100), ('1-30', 100), ('31-60', 50),
+											('61-90', 0), ('90+', 0)])
+
+	def test_published_snapshot_is_swapped_in(self):
+		reader = SnapshotReader(self.path, check_interval=0)
+		self.assertEquals(reader.current(), None)
+
+		publish_snapshot(self.path, version=1)
+		first = reader.current()
+		self.assertTrue(reader.current() is first)
+
+		PolicyAccounting(2).make_payment(amount=400, date_cursor=date(2015, 3, 1))
+		publish_snapshot(self.path, version=2)
+		second = reader.current()
+
+		self.assertEquals(second.version, 2)
+		self.assertEquals(second.ledger(2).paid_amount(date(2015, 3, 1)), 400)
+
+		# Readers holding the old snapshot keep reading it
+		self.assertEquals(first.version, 1)
+		self.assertEquals(first.ledger(2).paid_amount(date(2015, 3, 1)), 0)
+		self.assertEquals(os.listdir(self.directory), ['ledger.snapshot'])
+
+	def test_other_files_are_refused(self):
+		with open(self.path, 'wb') as snapshot_file:
+			snapshot_file.write('policy_id,balance\n' * 10)
+		self.assertRaises(SnapshotError, SnapshotReader(self.path).current)
+
+	def test_reports_read_the_snapshot(self):
+		publish_snapshot(self.path, version=7)
+
+		# Written after the snapshot, so only the live report sees it
+		PolicyAccounting(2).make_payment(amount=400, date_cursor=date(2015, 3, 1))
+
+		for snapshot in (self.path, False):
+			job_id = jobs.enqueue('balance_report', {'date': '2015-06-01', 'policy_ids': [2],
+													'snapshot': snapshot})
+			self.job_ids.append(job_id)
+			aging_job_id = jobs.enqueue('aging_report', {'date': '2015-06-01', 'policy_ids': [2],
+														'snapshot': snapshot})
+			self.job_ids.append(aging_job_id)
+
+			worker = threading.Thread(target=jobs.work, args=('test-worker',),
+										kwargs={'once': True})
+			worker.start()
+			worker.join()
+
+			result = jobs.job_dict(Job.query.filter_by(id=job_id).one())['result']
+			aging_result = jobs.job_dict(Job.query.filter_by(id=aging_job_id).one())['result']
+			if snapshot:
+				self.assertEquals(result['snapshot'], 7)
+				self.assertEquals(result['balances'], {'2': 800})
+				self.assertEquals(aging_result['totals']['current'], 400)
+				self.assertEquals(aging_result['totals']['90+'], 400)
+			else:
+				self.assertEquals(result['snapshot'], None)
+				self.assertEquals(result['balances'], {'2': 400})
+				self.assertEquals(aging_result['totals']['current'], 400)
+				self.assertEquals(aging_result['totals']['90+'], 0)
+
+
+class TestStatementRun(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.output = os.path.join(self.directory, 'statements')
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_bulk_ledgers_match_the_single_ones(self):
+		ledgers = load_ledgers([1, 2, 3, 4, 1000], db.session)
+		self.assertEquals(sorted(ledgers), [1, 2, 3, 4])
+		for policy_id, ledger in ledgers.items():
+			single = load_ledger(policy_id, db.session)
+			self.assertEquals(ledger.policy, single.policy)
+			self.assertEquals(ledger.invoices, single.invoices)
+			self.assertEquals(ledger.payments, single.payments)
+
+	def test_statements_have_the_policy_amounts(self):
+		result = statement_run(self.output, date(2015, 6, 1), processes=1)
+		self.assertEquals(result, {'statements': 8, 'skipped': 0, 'policies': 4})
+
+		policy_dict = PolicyAccounting.for_reading(3).generate_policy_dict(date(2015, 6, 1))
+		with open(os.path.join(self.output, 'policy-3.txt')) as statement:
+			text = statement.read()
+		self.assertTrue('Necessary amount: %d\n' % policy_dict['necessary_amount'] in text)
+		self.assertEquals(text.count(' due '), len(policy_dict['invoices']))
+
+		with open(os.path.join(self.output, 'policy-3.html')) as statement:
+			self.assertTrue('<td>$%d</td>' % policy_dict['due_amount'] in statement.read())
+
+	def test_interrupted_run_is_resumed(self):
+		result = statement_run(self.output, date(2015, 6, 1), processes=2, chunk_size=1)
+		self.assertEquals(result['statements'], 8)
+
+		os.remove(os.path.join(self.output, 'policy-2.html'))
+		result = statement_run(self.output, date(2015, 6, 1), processes=2, chunk_size=1)
+		self.assertEquals(result, {'statements': 2, 'skipped': 3, 'policies': 4})
+		self.assertEquals(len(os.listdir(self.output)), 8)
+
+	def test_archive_output(self):
+		archive = os.path.join(self.directory, 'statements.tar')
+		statement_run(archive, date(2015, 6, 1), policy_ids=[1, 2], formats=['text'])
+		result = statement_run(archive, date(2015, 6, 1), formats=['text'])
+		self.assertEquals(result, {'statements': 2, 'skipped': 2, 'policies': 4})
+
+		with tarfile.open(archive) as statements:
+			self.assertEquals(sorted(statements.getnames()),
+								['policy-1.txt', 'policy-2.txt', 'policy-3.txt', 'policy-4.txt'])
+
+	def test_killed_archive_is_resumed(self):
+		archive = os.path.join(self.directory, 'killed.tar')
+		output = ArchiveOutput(archive)
+		output.add(list(render_statements([1, 2], date(2015, 6, 1), ['text'])))
+		# Killed: the archive is never closed
+		size = os.path.getsize(archive)
+
+		# Between two chunks, then in the middle of a statement
+		for cut, skipped in ((size, 2), (size - 100, 1)):
+			resumed = os.path.join(self.directory, 'resumed-%d.tar' % cut)
+			shutil.copy(archive, resumed)
+			with open(resumed, 'r+b') as resumed_file:
+				resumed_file.truncate(cut)
+
+			result = statement_run(resumed, date(2015, 6, 1), formats=['text'])
+			self.assertEquals(result, {'statements': 4 - skipped, 'skipped': skipped, 'policies': 4})
+
+			with tarfile.open(resumed) as statements:
+				self.assertEquals(statements.getnames(),
+									['policy-1.txt', 'policy-2.txt', 'policy-3.txt', 'policy-4.txt'])
+		output.close()
+
+	def test_bad_outputs_and_formats(self):
+		self.assertRaises(ValueError, statement_run, self.output, formats=['pdf'])
+		self.assertRaises(ValueError, statement_run, self.output + '.tar.gz')
+
+
+class TestChangeFeed(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		test_agent = Contact('Test Agent', 'Agent')
+		test_insured = Contact('Test Insured', 'Named Insured')
+		db.session.add(test_agent)
+		db.session.add(test_insured)
+		db.session.commit()
+
+		# Requests remove the session, so only the ids are kept
+		cls.contact_ids = (test_agent.id, test_insured.id)
+
+	@classmethod
+	def tearDownClass(cls):
+		Contact.query.filter(Contact.id.in_(cls.contact_ids)).delete(synchronize_session=False)
+		db.session.commit()
+
+	def setUp(self):
+		self.cursor = self.head()
+
+	def tearDown(self):
+		for policy in Policy.query.filter(Policy.policy_number.like('Feed Policy%')):
+			for invoice in policy.invoices:
+				db.session.delete(invoice)
+			for payment in Payment.query.filter_by(policy_id=policy.id):
+				db.session.delete(payment)
+			db.session.delete(policy)
+		db.session.commit()
+
+	def head(self):
+		page = changes_since(limit=5000)
+		while page['more']:
+			page = changes_since(page['cursor'], limit=5000)
+		return page['cursor']
+
+	def changes(self):
+		page = changes_since(self.cursor)
+		self.assertFalse(page['more'])
+		self.cursor = page['cursor']
+		return page['changes']
+
+	def test_policy_writes_are_recorded(self):
+		policy = Policy('Feed Policy', date(2015, 1, 1), 1200)
+		policy.agent, policy.named_insured = self.contact_ids
+		policy.billing_schedule = 'Quarterly'
+		db.session.add(policy)
+		db.session.commit()
+
+		changes = self.changes()
+		self.assertEquals([item['id'] for item in changes['policies']], [policy.id])
+		self.assertEquals(changes['invoices'], [])
+
+		pa = PolicyAccounting(policy.id)
+		changes = self.changes()
+		self.assertEquals(len(changes['invoices']), 4)
+		self.assertEquals(changes['invoices'][0]['amount_due'], 300)
+
+		pa.make_payment(amount=300, date_cursor=date(2015, 2, 1))
+		changes = self.changes()
+		self.assertEquals([item['amount_paid'] for item in changes['payments']], [300])
+		self.assertEquals(changes['policies'], [])
+
+		pa.change_schedule('Two-Pay')
+		changes = self.changes()
+		self.assertEquals(changes['policies'][0]['billing_schedule'], 'Two-Pay')
+		self.assertEquals(sorted(item['deleted'] for item in changes['invoices']),
+							[False] * 2 + [True] * 4)
+
+		pa.cancel_policy('Feed test', date(2015, 2, 1))
+		changes = self.changes()
+		self.assertEquals(changes['policies'][0]['status'], 'Canceled')
+		self.assertEquals(changes['policies'][0]['cancellation_date'], '2015-02-01')
+
+		self.assertEquals(self.changes(), {'policies': [], 'invoices': [],
+											'payments': [], 'deleted': []})
+
+	def test_schedule_changes_dont_replay_history(self):
+		policy = Policy('Feed Policy', date(2015, 1, 1), 1200)
+		policy.agent, policy.named_insured = self.contact_ids
+		policy.billing_schedule = 'Quarterly'
+		db.session.add(policy)
+		db.session.commit()
+		pa = PolicyAccounting(policy.id)
+		self.changes()
+
+		# The policy plus the 4 and 12 invoices swapped, however
+		# many deleted invoices the policy already has
+		counts = []
+		for billing_schedule in ['Monthly', 'Quarterly'] * 3:
+			pa.change_schedule(billing_schedule)
+			page = changes_since(self.cursor)
+			self.cursor = page['cursor']
+			counts.append(page['count'])
+		self.assertEquals(counts, [17] * 6)
+
+	def test_bulk_writes_are_recorded(self):
+		result = onboard_policies([{
+			'policy_number': 'Feed Policy %d' % i,
+			'effective_date': '2015-01-01',
+			'billing_schedule': 'Monthly',
+			'annual_premium': 1200,
+			'named_insured': 'Test Insured',
+			'agent': 'Test Agent',
+		} for i in range(2)])
+
+		changes = self.changes()
+		self.assertEquals([item['id'] for item in changes['policies']], result['policies'])
+		self.assertEquals(len(changes['invoices']), 24)
+
+		writer = PaymentWriter().start()
+		try:
+			payment_id = writer.make_payment(result['policies'][0], amount=100,
+												transaction_date=date(2015, 2, 1))
+		finally:
+			writer.stop()
+		self.assertEquals([item['id'] for item in self.changes()['payments']], [payment_id])
+
+	def test_pages_are_bounded(self):
+		result = onboard_policies([{
+			'policy_number': 'Feed Policy',
+			'effective_date': '2015-01-01',
+			'billing_schedule': 'Quarterly',
+			'annual_premium': 1200,
+			'named_insured': 'Test Insured',
+			'agent': 'Test Agent',
+		}])
+		policy = Policy.query.filter_by(id=result['policies'][0]).one()
+
+		pages = []
+		page = {'cursor': self.cursor, 'more': True}
+		while page['more']:
+			page = changes_since(page['cursor'], limit=2)
+			pages.append(page['count'])
+		self.assertEquals(pages, [2, 2, 1])
+
+		# Deleted rows are listed as such
+		for invoice in policy.invoices:
+			db.session.delete(invoice)
+		db.session.delete(policy)
+		db.session.commit()
+
+		deleted = changes_since(page['cursor'])['changes']['deleted']
+		self.assertEquals(sorted(item['table'] for item in deleted),
+							['invoices'] * 4 + ['policies'])
+
+	def test_api_pages_and_errors(self):
+		client = create_app().test_client()
+
+		page = json.loads(client.get('/api/changes?since=%s' % self.cursor).data)
+		self.assertEquals(page['count'], 0)
+		self.assertEquals(page['cursor'], self.cursor)
+
+		self.assertEquals(client.get('/api/changes?since=abc').status_code, 400)
+		self.assertEquals(client.get('/api/changes?limit=0').status_code, 400)
+		self.assertEquals(client.get('/api/changes?limit=100000').status_code, 400)
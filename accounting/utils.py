@@ -4,7 +4,11 @@ from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 
 from accounting import db
-from models import Contact, Invoice, Payment, Policy
+from database import IN_CLAUSE_CHUNK
+from models import Change, Contact, IdempotencyKey, Invoice, Payment, Policy
+from changes import record_policies
+from ledger import get_ledger_cache
+from sharding import add_policies
 
 """
 #######################################################
@@ -12,65 +16,216 @@ This is the base code for the engineer project.
 #######################################################
 """
 
+# Define Billing Schedules
+BILLING_SCHEDULES = {'Annual': 1, 'Two-Pay': 2, 'Quarterly': 4, 'Monthly': 12}
+
+def invoice_schedule(effective_date, billing_schedule, annual_premium):
+	"""
+	 Returns the (bill_date, due_date, cancel_date, amount_due)
+	 of every invoice of a policy for the given schedule.
+	"""
+	# Bad schedules get a single invoice for the whole premium
+	if billing_schedule not in BILLING_SCHEDULES:
+		print "You have chosen a bad billing schedule."
+		total_payments = 1
+	else:
+		total_payments = BILLING_SCHEDULES.get(billing_schedule)
+
+	# Calculate amount per invoice
+	amount_due = annual_premium / total_payments
+
+	# Generates the invoices based on the quantity
+	invoices = []
+	for i in range(total_payments):
+
+		# Calculate invoice dates
+		months_after_eff_date = i*(12/total_payments)
+		bill_date = effective_date + relativedelta(months=months_after_eff_date)
+
+		invoices.append((bill_date,
+						bill_date + relativedelta(months=1), #due
+						bill_date + relativedelta(months=1, days=14), #cancel
+						amount_due))
+
+	return invoices
+
+def policy_dict(ledger, date_cursor):
+	"""
+	 Returns the policy, its invoices, payments and
+	 amounts at date_cursor as plain values.
+	"""
+	result = {
+		'id': ledger.policy['id'],
+		'policy_number': ledger.policy['policy_number'],
+		'effective_date': str(ledger.policy['effective_date']),
+		'status': ledger.policy['status'],
+		'billing_schedule': ledger.policy['billing_schedule'],
+		'annual_premium': ledger.policy['annual_premium'],
+		'named_insured': ledger.policy['named_insured'],
+		'agent': ledger.policy['agent'],
+	}
+
+	# Generate invoices dict
+	invoices = [{
+		'bill_date':str(bill_date),
+		'due_date':str(due_date),
+		'cancel_date':str(cancel_date),
+		'amount_due':amount_due,
+	} for bill_date, due_date, cancel_date, amount_due in ledger.invoices]
+
+	# Generate payments dict
+	payments = [{
+		'amount_paid':amount_paid,
+		'transaction_date':str(transaction_date),
+	} for transaction_date, amount_paid in ledger.payments]
+
+	# Set invoices and payments
+	result['invoices'] = invoices
+	result['payments'] = payments
+
+	# Get due amount and payed amount
+	due_amount = ledger.due_amount(date_cursor)
+	payed_amount = ledger.paid_amount(date_cursor)
+
+	# Set due amount, payed amount and necessary amount
+	result['due_amount'] = due_amount
+	result['payed_amount'] = payed_amount
+	result['necessary_amount'] = due_amount - payed_amount
+
+	return result
+
+
+class ReadOnlyError(Exception):
+	"""
+	 Raised when a write is attempted through
+	 a read-only PolicyAccounting instance.
+	"""
+	pass
+
+
+class IdempotencyConflict(Exception):
+	"""
+	 Raised when an idempotency key was already used
+	 for a payment of another policy or amount.
+	"""
+	pass
+
+
+def check_idempotent(payment, policy_id, amount):
+	"""
+	 Raises IdempotencyConflict unless the payment made for
+	 an idempotency key matches the one being retried.
+	"""
+	if payment.policy_id != policy_id or payment.amount_paid != amount:
+		raise IdempotencyConflict('The idempotency key was used for a payment of %s on policy %s!'
+									% (payment.amount_paid, payment.policy_id))
+
+
+def claim_idempotency_keys(claims):
+	"""
+	 Records the (key, policy id, amount) of idempotency
+	 keys in the main database, keeping the first claim of
+	 each key, and returns the claims by key. Commits.
+	"""
+	keys = IdempotencyKey.__table__
+
+	rows = {}
+	for key, policy_id, amount in claims:
+		rows.setdefault(key, {'key': key, 'policy_id': policy_id, 'amount_paid': amount})
+
+	# The insert takes the write lock, so the claims read back are final
+	db.session.execute(keys.insert().prefix_with('OR IGNORE'), rows.values())
+	claimed = {}
+	names = list(rows)
+	for i in range(0, len(names), IN_CLAUSE_CHUNK):
+		claimed.update((row.key, row) for row in db.session.execute(db.select([keys])
+			.where(keys.c.key.in_(names[i:i + IN_CLAUSE_CHUNK]))).fetchall())
+	db.session.commit()
+
+	return claimed
+
+
 class PolicyAccounting(object):
 	"""
 	 Each policy has its own instance of accounting.
+
+	 The policy row is loaded lazily on first use and can be
+	 passed in directly when the caller already has it loaded.
+	 Read-only instances never write to the database, so read
+	 endpoints don't take the SQLite write lock. Every query
+	 goes to the session of the policy's shard, and the reads
+	 are answered from the process-wide ledger cache.
 	"""
-	def __init__(self, policy_id):
-		self.policy = Policy.query.filter_by(id=policy_id).one()
+	def __init__(self, policy_id=None, policy=None, read_only=False):
+		if policy_id is None and policy is None:
+			raise ValueError('A policy_id or a policy is required!')
+
+		self._policy_id = policy.id if policy is not None else policy_id
+		self._policy = policy
+		self.read_only = read_only
+
+		# Writable instances keep generating the missing invoices
+		if not self.read_only:
+			self.ensure_invoices()
+
+	@classmethod
+	def for_reading(cls, policy):
+		"""
+		 Builds a read-only instance from a loaded
+		 policy row (or a policy id) without querying.
+		"""
+		if isinstance(policy, Policy):
+			return cls(policy=policy, read_only=True)
+		return cls(policy_id=policy, read_only=True)
+
+	@property
+	def session(self):
+		"""
+		 Returns the session of the policy's shard.
+		"""
+		return db.session_for(self._policy_id)
+
+	@property
+	def policy(self):
+		"""
+		 Returns the policy, loading it on first access.
+		"""
+		if self._policy is None:
+			self._policy = self.session.query(Policy).filter_by(id=self._policy_id).one()
+		return self._policy
+
+	@property
+	def ledger(self):
+		"""
+		 Returns the cached ledger of the policy, reloaded
+		 whenever the policy's version stamp changed.
+		"""
+		return get_ledger_cache().get(self._policy_id, self.session)
+
+	def _check_writable(self):
+		"""
+		 Refuses writes on read-only instances.
+		"""
+		if self.read_only:
+			raise ReadOnlyError('Policy %s is opened read-only!' % self._policy_id)
+
+	def ensure_invoices(self):
+		"""
+		 Explicit write path: generates the invoices
+		 if the policy doesn't have any yet.
+		"""
+		self._check_writable()
 
 		if not self.policy.invoices:
 			self.make_invoices()
 
 	def generate_policy_dict(self, date_cursor=None):
 
-		policy_dict = {
-			'id': self.policy.id,
-			'policy_number': self.policy.policy_number,
-			'effective_date': str(self.policy.effective_date),
-			'status': self.policy.status,
-			'billing_schedule': self.policy.billing_schedule,
-			'annual_premium': self.policy.annual_premium,
-			'named_insured': self.policy.named_insured,
-			'agent': self.policy.agent,
-		}
-
-		# Query invoices
-		invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-								.filter_by(deleted=False)\
-								.all()
-
-		# Generate invoices dict
-		invoices = [{
-			'bill_date':str(invoice.bill_date),
-			'due_date':str(invoice.due_date),
-			'cancel_date':str(invoice.cancel_date),
-			'amount_due':invoice.amount_due,
-		} for invoice in invoices]
-
-		# Query payments
-		payments = Payment.query.filter_by(policy_id=self.policy.id).all()
-
-		# Generate payments dict
-		payments = [{
-			'amount_paid':payment.amount_paid,
-			'transaction_date':str(payment.transaction_date),
-		} for payment in payments]
-
-		# Set invoices and payments
-		policy_dict['invoices'] = invoices
-		policy_dict['payments'] = payments
-
-		# Get due amount and payed amount
-		due_amount = self.get_due_amount(date_cursor)
-		payed_amount = self.get_payed_amount(date_cursor)
-
-		# Set due amount, payed amount and necessary amount
-		policy_dict['due_amount'] = due_amount
-		policy_dict['payed_amount'] = payed_amount
-		policy_dict['necessary_amount'] = due_amount - payed_amount
-
-		return policy_dict
+		if not date_cursor:
+			date_cursor = datetime.now().date()
+
+		# A single version check for the whole dict
+		return policy_dict(self.ledger, date_cursor)
 
 	def get_due_amount(self, date_cursor=None):
 		"""
@@ -80,19 +235,8 @@ class PolicyAccounting(object):
 		if not date_cursor:
 			date_cursor = datetime.now().date()
 
-		# Select all the invoices
-		invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-								.filter(Invoice.bill_date <= date_cursor)\
-								.filter_by(deleted=False)\
-								.order_by(Invoice.bill_date)\
-								.all()
-
-		# Calculate the total due amount
-		due_amount = 0
-		for invoice in invoices:
-			due_amount += invoice.amount_due
-
-		return due_amount
+		# Invoices are summed by bill date in the ledger
+		return self.ledger.due_amount(date_cursor)
 
 	def get_payed_amount(self, date_cursor=None):
 		"""
@@ -101,17 +245,8 @@ class PolicyAccounting(object):
 		if not date_cursor:
 			date_cursor = datetime.now().date()
 
-		# Select all the payments made
-		payments = Payment.query.filter_by(policy_id=self.policy.id)\
-								.filter(Payment.transaction_date <= date_cursor)\
-								.all()
-
-		# Calculate the due amount without the payments already made
-		total_amount = 0
-		for payment in payments:
-			total_amount += payment.amount_paid
-
-		return total_amount
+		# Payments are summed by transaction date in the ledger
+		return self.ledger.paid_amount(date_cursor)
 
 	def return_account_balance(self, date_cursor=None):
 		"""
@@ -121,18 +256,29 @@ class PolicyAccounting(object):
 			date_cursor = datetime.now().date()
 
 		# Calculate the total due amount
-		due_amount = self.get_due_amount(date_cursor)
-		payed_amount = self.get_payed_amount(date_cursor)
-
-		return due_amount - payed_amount
+		return self.ledger.balance(date_cursor)
 
-	def make_payment(self, contact_id=None, date_cursor=None, amount=0):
+	def make_payment(self, contact_id=None, date_cursor=None, amount=0, idempotency_key=None):
 		"""
 		 This function make a payment to a given insured.
+		 Retrying with the same idempotency key returns
+		 the payment already made, as long as it was for
+		 the same policy and amount.
 		"""
+		self._check_writable()
+
 		if not date_cursor:
 			date_cursor = datetime.now().date()
 
+		# Return the payment already made for this key
+		if idempotency_key:
+			claim = claim_idempotency_keys([(idempotency_key, self.policy.id, amount)])
+			check_idempotent(claim[idempotency_key], self.policy.id, amount)
+			payment = self.session.query(Payment).filter_by(idempotency_key=idempotency_key).first()
+			if payment:
+				check_idempotent(payment, self.policy.id, amount)
+				return payment
+
 		# Evaluate insured
 		if not contact_id:
 			try:
@@ -145,8 +291,9 @@ class PolicyAccounting(object):
 							contact_id,
 							amount,
 							date_cursor)
-		db.session.add(payment)
-		db.session.commit()
+		payment.idempotency_key = idempotency_key
+		self.session.add(payment)
+		self.session.commit()
 
 		return payment
 
@@ -160,17 +307,12 @@ class PolicyAccounting(object):
 		if not date_cursor:
 			date_cursor = datetime.now().date()
 
-		due_amount = self.return_account_balance(date_cursor)
+		ledger = self.ledger
 
-		if due_amount != 0:
-				invoices = Invoice.query\
-					.filter_by(policy_id=self.policy.id)\
-					.filter_by(deleted=False)\
-					.filter(Invoice.due_date < date_cursor)\
-					.filter(Invoice.cancel_date > date_cursor)\
-					.all()
-
-				return len(invoices) > 0
+		if ledger.balance(date_cursor) != 0:
+				return any(due_date < date_cursor < cancel_date
+							for bill_date, due_date, cancel_date, amount_due
+							in ledger.invoices)
 		else:
 			return False
 
@@ -181,23 +323,22 @@ class PolicyAccounting(object):
 		if not date_cursor:
 			date_cursor = datetime.now().date()
 
-		# Select cancelled invoices
-		invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-								.filter(Invoice.cancel_date <= date_cursor)\
-								.filter_by(deleted=False)\
-								.order_by(Invoice.bill_date)\
-								.all()
+		ledger = self.ledger
+
+		# Select cancelled invoices, in bill date order
+		cancel_dates = [cancel_date for bill_date, due_date, cancel_date, amount_due
+						in ledger.invoices if cancel_date <= date_cursor]
 
 		# Evaluate underwriting
-		difference = date_cursor - self.policy.effective_date
+		difference = date_cursor - ledger.policy['effective_date']
 		difference_days = difference.days
 
 		if difference_days <= 60:
 			return True
 
 		# Evaluate policy cancellation
-		for invoice in invoices:
-			if not self.return_account_balance(invoice.cancel_date):
+		for cancel_date in cancel_dates:
+			if not ledger.balance(cancel_date):
 				continue
 			else:
 				return True
@@ -210,54 +351,24 @@ class PolicyAccounting(object):
 		 This function generates the all the policy invoices
 		 based on the chosen schedule.
 		"""
+		self._check_writable()
 
-		# Delete all invoices
+		# Delete the current invoices
 		for invoice in self.policy.invoices:
-			invoice.deleted = True
-
-		# Define Billing Schedules
-		billing_schedules = {'Annual': 1, 'Two-Pay': 2, 'Quarterly': 4, 'Monthly': 12}
-
-		# Generate first invoice
-		invoices = []
-		first_invoice = Invoice(self.policy.id,
-								self.policy.effective_date, #bill_date
-								self.policy.effective_date + relativedelta(months=1), #due
-								self.policy.effective_date + relativedelta(months=1, days=14), #cancel
-								self.policy.annual_premium)
-		invoices.append(first_invoice)
-
-		# Generate more invoices if needed
-		if self.policy.billing_schedule in billing_schedules:
-
-			# Get total number of payments
-			total_payments = billing_schedules.get(self.policy.billing_schedule)
-
-			# Calculate amount per invoice
-			first_invoice.amount_due /= total_payments
-
-			# Generates more invoices based on the quantity
-			for i in range(1, total_payments):
-
-				# Calculate invoice date
-				months_after_eff_date = i*(12/total_payments)
-				bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
+			if not invoice.deleted:
+				invoice.deleted = True
 
-				# Generate Invoice
-				invoice = Invoice(self.policy.id,
-									bill_date,
-									bill_date + relativedelta(months=1),
-									bill_date + relativedelta(months=1, days=14),
-									self.policy.annual_premium / billing_schedules.get(self.policy.billing_schedule))
-				invoices.append(invoice)
-
-		else:
-			print "You have chosen a bad billing schedule."
+		# Generate the invoices for the chosen schedule
+		invoices = [Invoice(self.policy.id, bill_date, due_date, cancel_date, amount_due)
+					for bill_date, due_date, cancel_date, amount_due
+					in invoice_schedule(self.policy.effective_date,
+										self.policy.billing_schedule,
+										self.policy.annual_premium)]
 
 		# Commit Invoices
 		for invoice in invoices:
-			db.session.add(invoice)
-		db.session.commit()
+			self.session.add(invoice)
+		self.session.commit()
 
 	def change_schedule(self, billing_schedule):
 
@@ -266,12 +377,13 @@ class PolicyAccounting(object):
 		 by marking the old ones as deleted and 
 		 creating the new ones.
 		"""
+		self._check_writable()
 
 		# Change Schedule
 		self.policy.billing_schedule = billing_schedule
 		
 		# Commit to Database
-		db.session.commit()
+		self.session.commit()
 
 		# Generate new invoices
 		self.make_invoices()
@@ -281,6 +393,8 @@ class PolicyAccounting(object):
 		 Cancel a policy based on a evaluation
 		 and adds a description about it.
 		"""
+		self._check_writable()
+
 		if not date_cursor:
 			date_cursor = datetime.now().date()
 
@@ -295,7 +409,7 @@ class PolicyAccounting(object):
 			self.policy.cancellation_description = cancellation_description
 
 			# Commit to Database
-			db.session.commit()
+			self.session.commit()
 
 			return True
 
@@ -313,6 +427,22 @@ def build_or_refresh_db():
 	insert_data()
 	print "DB Ready!"
 
+def upgrade_db():
+	"""
+	 Upgrades a database made by an older version in place,
+	 and starts the change feed with the existing rows.
+	"""
+	created = db.upgrade_all()
+
+	# A shard without changes has no feed yet
+	for shard in range(db.shards):
+		session = db.shard_session(shard)
+		if not session.query(Change.seq).first():
+			record_policies(session)
+			session.commit()
+	print "DB Upgraded!"
+	return created
+
 def insert_data():
 	#Contacts
 	contacts = []
@@ -358,14 +488,12 @@ def insert_data():
 	p4.agent = john_doe_agent.id
 	policies.append(p4)
 
-	for policy in policies:
-		db.session.add(policy)
-	db.session.commit()
+	add_policies(policies)
 
 	for policy in policies:
 		PolicyAccounting(policy.id)
 
 	payment_for_p2 = Payment(p2.id, anna_white.id, 400, date(2015, 2, 1))
-	db.session.add(payment_for_p2)
-	db.session.commit()
+	db.session_for(p2.id).add(payment_for_p2)
+	db.session_for(p2.id).commit()
 
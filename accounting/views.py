@@ -1,47 +1,90 @@
 # You will probably need more methods from flask but this one is a good start.
-from flask import render_template, jsonify, request
+from flask import Blueprint, Response, render_template, jsonify, request
 
-# Import things from Flask that we need.
-from accounting import app, db
+# Import the database binding
+from accounting import db
+from database import IN_CLAUSE_CHUNK
 
 # Import our models
-from models import Contact, Invoice, Policy
+from models import Contact, Invoice, Job, Policy
 
 # Import our Utilities
-from utils import PolicyAccounting
+from utils import BILLING_SCHEDULES, IdempotencyConflict, PolicyAccounting
+from onboarding import onboard_policies
+from payments import PaymentTimeout, get_payment_writer
+from jobs import enqueue, job_dict
+from billing import billing_run
+from ledger import get_ledger_cache
+from changes import DEFAULT_LIMIT, changes_since
+from wire import compact_policies, compact_policy, negotiate_format, respond
+
+# Import SQLAlchemy errors
+from sqlalchemy.orm.exc import NoResultFound
+
+# Import JSON
+import json
 
 # Import Date
 from datetime import date, datetime
 
-# Routing for the server.
-@app.route("/")
+# Routing for the server, registered by create_app().
+api = Blueprint('accounting', __name__)
+
+@api.route("/")
 def index():
 	return render_template('index.html')
 
-@app.route("/api/policies", methods=['GET'])
+@api.route("/api/policies", methods=['GET'])
 def policies_json():
 
-	# Query policies
-	policies = Policy.query.all()
+	# Pick the wire format from the Accept header
+	wire_format = negotiate_format(request)
+	if wire_format is None:
+		return jsonify({'error':'Unknown format!'}), 406
+
+	# Query the policies of every shard in parallel
+	policies = Policy.__table__
+	query = db.select([policies.c.id,
+					policies.c.policy_number,
+					policies.c.effective_date,
+					policies.c.status,
+					policies.c.billing_schedule,
+					policies.c.annual_premium,
+					policies.c.named_insured,
+					policies.c.agent])
+	rows = sorted((row for shard_rows in db.fan_out(
+						lambda session: session.execute(query).fetchall())
+					for row in shard_rows), key=lambda row: row.id)
+
+	# Get the contact names from the main database at once
+	contact_ids = list(set([row.named_insured for row in rows] + [row.agent for row in rows]))
+	names = {}
+	for i in range(0, len(contact_ids), IN_CLAUSE_CHUNK):
+		names.update(db.session.query(Contact.id, Contact.name)
+			.filter(Contact.id.in_(contact_ids[i:i + IN_CLAUSE_CHUNK])))
+
+	# Compact formats send the rows as they are
+	if wire_format != 'json':
+		return respond(compact_policies(rows, names), wire_format, request)
 
 	# Generate Dict
 	policies_dict = [{
-		'id': policy.id,
-		'policy_number': policy.policy_number,
-		'effective_date': str(policy.effective_date),
-		'status': policy.status,
-		'billing_schedule': policy.billing_schedule,
-		'annual_premium': policy.annual_premium,
-		'named_insured': Contact.query.filter_by(id=policy.named_insured).one().name,
-		'agent': Contact.query.filter_by(id=policy.agent).one().name,
-	} for policy in policies]
+		'id': row.id,
+		'policy_number': row.policy_number,
+		'effective_date': str(row.effective_date),
+		'status': row.status,
+		'billing_schedule': row.billing_schedule,
+		'annual_premium': row.annual_premium,
+		'named_insured': names.get(row.named_insured),
+		'agent': names.get(row.agent),
+	} for row in rows]
 
 	# Format content
 	content = { 'policies' : policies_dict }
 
-	return jsonify(content)
+	return respond(content, wire_format, request)
 
-@app.route("/api/policy/<policy_id>", methods=['GET'])
+@api.route("/api/policy/<policy_id>", methods=['GET'])
 def policy_json(policy_id):
 
 	# Get date from get parameters
@@ -54,22 +97,177 @@ def policy_json(policy_id):
 	else:
 		year,month,day = date_splitted
 		date_cursor = date(int(year), int(month), int(day))
-	
-	# Get Policy
-	try:
-		policy = Policy.query.filter_by(id=policy_id).one()
-	except:
-		policy = None
 
-	# Show error if policy doesn't exists
-	if not policy:
+	# Pick the wire format from the Accept header
+	wire_format = negotiate_format(request)
+	if wire_format is None:
+		return jsonify({'error':'Unknown format!'}), 406
+
+	# Generate a read-only Policy Accounting, answered from the
+	# ledger cache without loading the policy rows
+	pa = PolicyAccounting.for_reading(policy_id)
+	try:
+		if wire_format == 'json':
+			content = { 'policy' : pa.generate_policy_dict(date_cursor) }
+		else:
+			# Compact formats are built from the ledger tuples
+			content = compact_policy(pa.ledger, date_cursor)
+	except (NoResultFound, ValueError):
+		# Show error if policy doesn't exists
 		return jsonify({'error':'Policy not found!'})
 
-	# Generate Policy Accounting
-	pa = PolicyAccounting(policy.id)
+	return respond(content, wire_format, request)
+
+@api.route("/api/policies/bulk", methods=['POST'])
+def policies_bulk_json():
 
-	# Generate and format content
-	policies_dict = pa.generate_policy_dict(date_cursor)
-	content = { 'policy' : policies_dict }
+	# Get the policy records from the request body
+	records = (request.json or {}).get('policies')
+	if not isinstance(records, list):
+		return jsonify({'error':'A list of policies is required!'}), 400
+
+	# Onboard the policies and their contacts
+	try:
+		content = onboard_policies(records)
+	except ValueError as e:
+		return jsonify({'error':str(e)}), 400
 
 	return jsonify(content)
+
+@api.route("/api/policy/<int:policy_id>/payments", methods=['POST'])
+def payment_json(policy_id):
+
+	# Get the payment from the request body
+	data = request.json or {}
+	try:
+		amount = int(data['amount'])
+		contact_id = data.get('contact_id')
+		transaction_date = datetime.strptime(data['date'], '%Y-%m-%d').date() \
+			if data.get('date') else None
+	except (KeyError, TypeError, ValueError):
+		return jsonify({'error':'A valid amount and date are required!'}), 400
+
+	if amount <= 0:
+		return jsonify({'error':'The amount must be positive!'}), 400
+
+	# Retries send the same idempotency key
+	idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+
+	# Queue the payment and wait for its group commit
+	payment = get_payment_writer().submit(policy_id, contact_id, amount,
+											transaction_date, idempotency_key)
+	try:
+		payment.wait(timeout=10)
+	except PaymentTimeout as e:
+		return jsonify({'error':str(e)}), 503
+	except IdempotencyConflict as e:
+		return jsonify({'error':str(e)}), 422
+	except ValueError as e:
+		return jsonify({'error':str(e)}), 404
+	except Exception:
+		return jsonify({'error':'The payment couldn\'t be made!'}), 500
+
+	# A retry gets the payment made by the first request
+	content = { 'payment' : {
+		'id': payment.payment_id,
+		'policy_id': payment.policy_id,
+		'amount_paid': payment.amount,
+		'transaction_date': str(payment.transaction_date),
+		'duplicate': payment.duplicate,
+	}}
+
+	return jsonify(content), 200 if payment.duplicate else 201
+
+@api.route("/api/policy/<int:policy_id>/schedule", methods=['POST'])
+def schedule_json(policy_id):
+
+	# Get the new billing schedule from the request body
+	billing_schedule = (request.json or {}).get('billing_schedule')
+	if billing_schedule not in BILLING_SCHEDULES:
+		return jsonify({'error':'A valid billing schedule is required!'}), 400
+
+	# Get Policy from its shard
+	policy = db.session_for(policy_id).query(Policy).filter_by(id=policy_id).first()
+	if not policy:
+		return jsonify({'error':'Policy not found!'}), 404
+
+	# Change the schedule and generate the new invoices
+	pa = PolicyAccounting(policy=policy)
+	pa.change_schedule(billing_schedule)
+
+	return jsonify({ 'policy' : {
+		'id': policy.id,
+		'billing_schedule': policy.billing_schedule,
+	}})
+
+@api.route("/api/jobs", methods=['POST'])
+def jobs_json():
+
+	# Get the operation from the request body
+	data = request.json or {}
+	arguments = data.get('arguments') or {}
+	if not isinstance(arguments, dict):
+		return jsonify({'error':'The arguments must be an object!'}), 400
+
+	# Queue the job for the workers
+	try:
+		job_id = enqueue(data.get('operation'), arguments)
+	except ValueError as e:
+		return jsonify({'error':str(e)}), 400
+
+	job = Job.query.filter_by(id=job_id).one()
+	return jsonify({ 'job' : job_dict(job) }), 202
+
+@api.route("/api/jobs/<int:job_id>", methods=['GET'])
+def job_json(job_id):
+
+	# Get Job
+	job = Job.query.filter_by(id=job_id).first()
+	if not job:
+		return jsonify({'error':'Job not found!'}), 404
+
+	return jsonify({ 'job' : job_dict(job) })
+
+@api.route("/api/changes", methods=['GET'])
+def changes_json():
+
+	# Pick the wire format from the Accept header
+	wire_format = negotiate_format(request)
+	if wire_format is None:
+		return jsonify({'error':'Unknown format!'}), 406
+
+	# Changes after the cursor of the previous page, the
+	# whole feed without one
+	try:
+		limit = int(request.args.get('limit', DEFAULT_LIMIT))
+		content = changes_since(request.args.get('since'), limit)
+	except ValueError as e:
+		return jsonify({'error':str(e)}), 400
+
+	return respond(content, wire_format, request)
+
+@api.route("/api/ledger-cache", methods=['GET'])
+def ledger_cache_json():
+
+	# Hits, misses, evictions and size of this process' cache
+	return jsonify({ 'ledger_cache' : get_ledger_cache().info() })
+
+@api.route("/api/billing-run", methods=['GET'])
+def billing_run_json():
+
+	# Get the date window from get parameters
+	try:
+		start_date = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+		end_date = datetime.strptime(request.args.get('end', request.args['start']), '%Y-%m-%d').date()
+	except (KeyError, ValueError):
+		return jsonify({'error':'A valid start and end date are required!'}), 400
+
+	if end_date < start_date:
+		return jsonify({'error':'The end date is before the start date!'}), 400
+
+	# Stream one JSON invoice per line as the rows are read
+	def generate():
+		for invoice in billing_run(start_date, end_date):
+			yield json.dumps(invoice) + '\n'
+
+	return Response(generate(), mimetype='application/x-ndjson')
@@ -0,0 +1,155 @@
+#!/user/bin/env python2.7
+
+import json
+import zlib
+
+from flask import Response
+
+# MessagePack is optional, without it the API only speaks JSON
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+"""
+#######################################################
+Wire formats for the policy API responses.
+
+Clients pick the format with the Accept header (or the
+format parameter) and the compression with Accept-Encoding:
+
+- json: the pretty-printed JSON of jsonify, the default
+- compact: JSON without whitespace, with the invoices,
+  payments and policy lists sent as columns plus rows
+  instead of one object per item
+- msgpack: the compact layout in MessagePack
+
+The compact layouts are built straight from the ledger
+tuples and query rows, without intermediate dicts.
+#######################################################
+"""
+
+MIMETYPES = {
+	'json': 'application/json',
+	'compact': 'application/vnd.accounting.compact+json',
+	'msgpack': 'application/x-msgpack',
+}
+
+# Smaller bodies don't get smaller by compressing them
+MIN_COMPRESSED_SIZE = 1024
+
+# Column names of the compact layouts
+POLICY_COLUMNS = ['id', 'policy_number', 'effective_date', 'status',
+					'billing_schedule', 'annual_premium', 'named_insured', 'agent']
+INVOICE_COLUMNS = ['bill_date', 'due_date', 'cancel_date', 'amount_due']
+PAYMENT_COLUMNS = ['transaction_date', 'amount_paid']
+
+def available_formats():
+	formats = ['json', 'compact']
+	if msgpack is not None:
+		formats.append('msgpack')
+	return formats
+
+def negotiate_format(request):
+	"""
+	 Returns the format asked by the request, or None
+	 when the format parameter asks for an unknown one.
+	"""
+	formats = available_formats()
+
+	wire_format = request.args.get('format')
+	if wire_format:
+		return wire_format if wire_format in formats else None
+
+	# Anything else, */* included, gets the default
+	mimetype = request.accept_mimetypes.best_match([MIMETYPES[name] for name in formats])
+	for name in formats:
+		if MIMETYPES[name] == mimetype:
+			return name
+	return 'json'
+
+def negotiate_encoding(request):
+	"""
+	 Returns gzip, deflate or None.
+	"""
+	return request.accept_encodings.best_match(['gzip', 'deflate'])
+
+def columns(names, rows):
+	return {'columns': names, 'rows': rows}
+
+def compact_policy(ledger, date_cursor):
+	"""
+	 Returns the compact content of /api/policy, with
+	 the same values as generate_policy_dict.
+	"""
+	policy = ledger.policy
+	due_amount = ledger.due_amount(date_cursor)
+	payed_amount = ledger.paid_amount(date_cursor)
+
+	return {'policy': {
+		'id': policy['id'],
+		'policy_number': policy['policy_number'],
+		'effective_date': policy['effective_date'].isoformat(),
+		'status': policy['status'],
+		'billing_schedule': policy['billing_schedule'],
+		'annual_premium': policy['annual_premium'],
+		'named_insured': policy['named_insured'],
+		'agent': policy['agent'],
+		'invoices': columns(INVOICE_COLUMNS, [
+			[bill_date.isoformat(), due_date.isoformat(), cancel_date.isoformat(), amount_due]
+			for bill_date, due_date, cancel_date, amount_due in ledger.invoices]),
+		'payments': columns(PAYMENT_COLUMNS, [
+			[transaction_date.isoformat(), amount_paid]
+			for transaction_date, amount_paid in ledger.payments]),
+		'due_amount': due_amount,
+		'payed_amount': payed_amount,
+		'necessary_amount': due_amount - payed_amount,
+	}}
+
+def compact_policies(rows, names):
+	"""
+	 Returns the compact content of /api/policies
+	 from the policy rows and the contact names.
+	"""
+	return {'policies': columns(POLICY_COLUMNS, [
+		[row.id, row.policy_number, row.effective_date.isoformat(), row.status,
+			row.billing_schedule, row.annual_premium,
+			names.get(row.named_insured), names.get(row.agent)]
+		for row in rows])}
+
+def encode(content, wire_format, request):
+	"""
+	 Serializes the content in the given format.
+	"""
+	if wire_format == 'msgpack':
+		return msgpack.packb(content)
+	if wire_format == 'compact':
+		return json.dumps(content, separators=(',', ':'))
+
+	# Same output as jsonify
+	return json.dumps(content, indent=None if request.is_xhr else 2)
+
+def compress(body, encoding):
+	"""
+	 Compresses the body with gzip or deflate.
+	"""
+	if encoding == 'gzip':
+		compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	else:
+		compressor = zlib.compressobj(6)
+	return compressor.compress(body) + compressor.flush()
+
+def respond(content, wire_format, request, status=200):
+	"""
+	 Returns the response for the negotiated format
+	 and encoding.
+	"""
+	body = encode(content, wire_format, request)
+	headers = {'Vary': 'Accept, Accept-Encoding'}
+
+	encoding = negotiate_encoding(request)
+	if encoding and len(body) >= MIN_COMPRESSED_SIZE:
+		body = compress(body, encoding)
+		headers['Content-Encoding'] = encoding
+
+	return Response(body, status=status, mimetype=MIMETYPES[wire_format], headers=headers)
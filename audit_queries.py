@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+ Audits the query plans of every statement the app issues.
+
+ usage: audit_queries.py [LOG ...] [--policies N] [--payments N]
+                         [--baseline FILE] [--accept] [--report FILE]
+
+ Without LOG files, a workload of the read and write paths runs
+ in-process and its statements are recorded. LOG files come from
+ running with ACCOUNTING_QUERY_LOG set, e.g.
+
+   ACCOUNTING_QUERY_LOG=queries.json nosetests accounting/tests.py
+
+ The statements are explained against a scratch database of the
+ given size. Full scans of filtered tables and temp B-trees on hot
+ statements fail the audit (exit 1) unless the baseline accepts
+ them, --accept writes the current ones to the baseline.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from accounting.headless import init
+from accounting.loadtest import seed_database
+from accounting.queryplan import (HOT_EXECUTIONS, QueryRecorder, accept, audit,
+									get_recorder, regressions, run_workload)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Audits the query plans of the app.')
+	parser.add_argument('logs', nargs='*', help='statement logs to audit')
+	parser.add_argument('--policies', type=int, default=20000,
+						help='policies in the scratch database')
+	parser.add_argument('--payments', type=int, default=40000,
+						help='payments in the scratch database')
+	parser.add_argument('--hot', type=int, default=HOT_EXECUTIONS,
+						help='executions that make a statement hot')
+	parser.add_argument('--baseline', help='JSON file of accepted findings')
+	parser.add_argument('--accept', action='store_true',
+						help='write the current hot findings to the baseline')
+	parser.add_argument('--report', help='write the full report as JSON')
+	args = parser.parse_args()
+
+	scratch = tempfile.NamedTemporaryFile(suffix='.sqlite', delete=False)
+	scratch.close()
+	database_uri = 'sqlite:///' + scratch.name
+
+	try:
+		print "Seeding %d policies and %d payments..." % (args.policies, args.payments)
+		policy_ids = seed_database(database_uri, args.policies, args.payments)
+
+		if args.logs:
+			recorder = get_recorder()
+			for path in args.logs:
+				recorder.merge(QueryRecorder.load(path))
+		else:
+			print "Running the workload..."
+			init(database_uri)
+			recorder = get_recorder().start()
+			run_workload(policy_ids)
+			recorder.stop()
+
+		report = audit(recorder.statements, database_uri, args.hot)
+	finally:
+		os.remove(scratch.name)
+
+	# Print the statements with findings, hot ones first
+	results = sorted(report['statements'], key=lambda result: -result['executions'])
+	for result in results:
+		if result['findings'] or result.get('error'):
+			print '%s %5dx  %s' % ('HOT ' if result['hot'] else '    ',
+									result['executions'], result['statement'])
+			for finding in result['findings']:
+				print '            - %s' % finding
+			if result.get('error'):
+				print '            ! %s' % result['error']
+	print "%d statements, %d with findings" % (len(results),
+		len([result for result in results if result['findings']]))
+	for name in report['unused_indexes']:
+		print "Unused index: %s" % name
+
+	if args.report:
+		with open(args.report, 'w') as report_file:
+			json.dump(report, report_file, indent=2)
+
+	baseline = []
+	if args.baseline and os.path.exists(args.baseline):
+		with open(args.baseline) as baseline_file:
+			baseline = json.load(baseline_file)
+
+	if args.accept:
+		if not args.baseline:
+			sys.exit('--accept needs --baseline')
+		with open(args.baseline, 'w') as baseline_file:
+			json.dump(accept(report, baseline), baseline_file, indent=2)
+		sys.exit(0)
+
+	found = regressions(report, baseline)
+	if found:
+		print "%d hot-path regressions:" % len(found)
+		for statement, finding in found:
+			print "  %s: %s" % (finding, statement)
+		sys.exit(1)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+ Load-tests the accounting API and writes a JSON report.
+
+ By default it seeds a scratch database with synthetic policies and
+ serves the app from it; --url targets a running instance instead.
+
+ usage: loadtest.py [--concurrency 1,4,16] [--duration SECONDS]
+                    [--mix list=1,policy=8,payment=2,schedule=0.5]
+                    [--policies N] [--payments N] [--url URL]
+                    [--output report.json]
+"""
+import argparse
+import json
+import sys
+
+from accounting.loadtest import DEFAULT_MIX, parse_mix, run
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Load-tests the accounting API.')
+	parser.add_argument('--concurrency', default='1,4,16',
+						help='comma separated concurrency levels')
+	parser.add_argument('--duration', type=float, default=10,
+						help='seconds per concurrency level')
+	parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+						help='request kinds and weights: list, policy, payment, schedule')
+	parser.add_argument('--policies', type=int, default=1000,
+						help='synthetic policies to seed')
+	parser.add_argument('--payments', type=int, default=2000,
+						help='synthetic payments to seed')
+	parser.add_argument('--url', default=None,
+						help='base url of a running instance instead of a seeded one')
+	parser.add_argument('--seed', type=int, default=0,
+						help='random seed for the data and the traffic')
+	parser.add_argument('--output', default=None,
+						help='report file, stdout by default')
+	args = parser.parse_args()
+
+	report = run([int(level) for level in args.concurrency.split(',')],
+				args.duration, args.mix, args.policies, args.payments,
+				args.url, args.seed)
+
+	output = open(args.output, 'w') if args.output else sys.stdout
+	json.dump(report, output, indent=2, sort_keys=True)
+	output.write('\n')
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+ Bulk policy onboarding from a JSON or CSV file.
+
+ usage: onboard.py policies.json|policies.csv
+
+ Each record needs policy_number, effective_date (YYYY-MM-DD),
+ billing_schedule, annual_premium, named_insured and agent,
+ the last two being contact names.
+"""
+import csv
+import json
+import sys
+import time
+
+from accounting.headless import init
+from accounting.onboarding import onboard_policies
+
+def load_records(path):
+	with open(path) as records_file:
+		if path.endswith('.csv'):
+			return list(csv.DictReader(records_file))
+
+		records = json.load(records_file)
+		if isinstance(records, dict):
+			records = records['policies']
+		return records
+
+if __name__ == "__main__":
+	if len(sys.argv) != 2:
+		sys.exit(__doc__)
+
+	init()
+	records = load_records(sys.argv[1])
+
+	start = time.time()
+	try:
+		result = onboard_policies(records)
+	except ValueError as e:
+		sys.exit(str(e))
+	elapsed = time.time() - start
+
+	print "Onboarded %d policies (%d new contacts, %d invoices) in %.2fs" % (
+		len(result['policies']), result['contacts_created'],
+		result['invoices_created'], elapsed)
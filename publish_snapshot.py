@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+ Publishes the read-only ledger snapshot for the report workers.
+
+ usage: publish_snapshot.py [--path PATH] [--every SECONDS]
+
+ The policies, invoices and payments of the databases in config.py
+ are written to a new file that replaces the snapshot atomically.
+ Workers reading the previous one switch on their next check.
+"""
+import argparse
+import time
+
+from accounting.headless import init
+from accounting.snapshot import publish_snapshot, snapshot_path
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Publishes the ledger snapshot.')
+	parser.add_argument('--path', default=None,
+						help='snapshot file, LEDGER_SNAPSHOT_PATH by default')
+	parser.add_argument('--every', type=float, default=None,
+						help='keep publishing a new snapshot every SECONDS')
+	args = parser.parse_args()
+
+	init()
+	path = args.path or snapshot_path()
+
+	try:
+		while True:
+			start = time.time()
+			result = publish_snapshot(path)
+			elapsed = time.time() - start
+
+			print "Published snapshot %d of %d policies, %d invoices and %d payments (%d bytes) in %.2fs" % (
+				result['version'], result['policies'], result['invoices'],
+				result['payments'], result['bytes'], elapsed)
+
+			if args.every is None:
+				break
+			time.sleep(max(0, args.every - elapsed))
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""
+ Copies the policies, invoices and payments into N shard databases.
+
+ usage: reshard.py SHARD_URI [SHARD_URI ...]
+
+ The policies are read from the databases in config.py and each one
+ goes to shard policy_id % N with its invoices and payments. The new
+ shards must be empty and the current data is left untouched. Set
+ SHARD_DATABASE_URIS in accounting/config.py to the new shards,
+ in the same order, once it's done.
+"""
+import sys
+import time
+
+from accounting.headless import init
+from accounting.sharding import reshard
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		sys.exit(__doc__)
+
+	init()
+
+	start = time.time()
+	try:
+		result = reshard(sys.argv[1:])
+	except ValueError as e:
+		sys.exit(str(e))
+	elapsed = time.time() - start
+
+	print "Copied %d policies, %d invoices and %d payments into %d shards in %.2fs" % (
+		result['policies'], result['invoices'], result['payments'],
+		result['shards'], elapsed)
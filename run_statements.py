@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+ Renders the billing statement of every policy.
+
+ usage: run_statements.py OUTPUT [--date YYYY-MM-DD] [--format html,text]
+                          [--processes N]
+
+ OUTPUT is a directory (one file per statement) or an uncompressed
+ .tar archive. Statements already in OUTPUT are skipped, so running
+ the same command again resumes an interrupted run.
+"""
+import argparse
+import sys
+import time
+from datetime import datetime
+
+from accounting.headless import init
+from accounting.statements import statement_run
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Renders the statement of every policy.')
+	parser.add_argument('output', help='directory or .tar archive')
+	parser.add_argument('--date', default=None,
+						help='statement date (YYYY-MM-DD), today by default')
+	parser.add_argument('--format', default='html,text',
+						help='comma-separated formats: html, text')
+	parser.add_argument('--processes', type=int, default=None,
+						help='rendering processes, one per CPU by default')
+	args = parser.parse_args()
+
+	date_cursor = datetime.strptime(args.date, '%Y-%m-%d').date() if args.date else None
+
+	init()
+	start = time.time()
+
+	def progress(done, total):
+		sys.stdout.write('\r%d/%d policies (%.0f/s)' % (
+			done, total, done / max(time.time() - start, 0.001)))
+		sys.stdout.flush()
+
+	try:
+		result = statement_run(args.output, date_cursor, formats=args.format.split(','),
+								processes=args.processes, progress=progress)
+	except ValueError as e:
+		sys.exit(str(e))
+	elapsed = time.time() - start
+
+	print "\nRendered %d statements for %d policies (%d already done) in %.2fs" % (
+		result['statements'], result['policies'] - result['skipped'],
+		result['skipped'], elapsed)
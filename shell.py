@@ -1,8 +1,5 @@
 #!/usr/bin/env python
-from accounting import *
-from accounting.models import *
-from accounting.utils import *
-from flask import *
+from accounting.headless import *
 
 try:
     from IPython import embed
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+"""
+ Upgrades the databases in config.py in place, keeping their data.
+
+ usage: upgrade_db.py
+
+ Adds the tables, columns and indexes that the models have and the
+ databases lack (policies.version, payments.idempotency_key, the jobs,
+ sequences, idempotency_keys and changes tables, the lookup indexes)
+ and records the existing rows in the new change feed. Running it
+ again does nothing.
+"""
+from accounting.headless import init
+from accounting.utils import upgrade_db
+
+if __name__ == "__main__":
+	init()
+	created = upgrade_db()
+
+	for shard, tables in sorted(created.items()):
+		if tables:
+			print "%s: created %s" % ('main' if shard is None else 'shard %d' % shard,
+										', '.join(tables))
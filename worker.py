@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+ Runs the worker pool for the queued accounting jobs.
+
+ usage: worker.py [--concurrency N] [--poll-interval SECONDS] [--once]
+"""
+import argparse
+
+from accounting.headless import init
+from accounting.jobs import run_pool, work
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Runs the queued accounting jobs.')
+	parser.add_argument('--concurrency', type=int, default=2,
+						help='number of worker processes')
+	parser.add_argument('--poll-interval', type=float, default=1.0,
+						help='seconds between queue polls when idle')
+	parser.add_argument('--once', action='store_true',
+						help='run the queued jobs in this process and exit')
+	args = parser.parse_args()
+
+	init()
+	if args.once:
+		work(poll_interval=args.poll_interval, once=True)
+	else:
+		try:
+			run_pool(args.concurrency, args.poll_interval)
+		except KeyboardInterrupt:
+			pass